@@ -0,0 +1,457 @@
+"""
+Persistent on-disk cache, shared between bleanser runs
+
+Normalising is by far the most expensive part of pruning, and typically only a few new files arrive between runs.
+So we keep normalised outputs keyed by the input content and the normaliser code, and reuse them next time.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import inspect
+import os
+import shutil
+import sqlite3
+import sys
+import threading
+from collections.abc import Collection, Iterable, Iterator, Sequence
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from time import time
+from types import ModuleType
+from typing import TYPE_CHECKING, Literal
+
+from .common import logger
+
+if TYPE_CHECKING:
+    from .processor import BaseNormaliser
+
+
+# bump this if the layout/semantics of cached entries changes
+_CACHE_VERSION = 1
+
+
+def file_digest(path: Path) -> str:
+    # NOTE: streams the file, so it's fine to use on multi-GB inputs
+    with path.open('rb') as fo:
+        return hashlib.file_digest(fo, 'sha256').hexdigest()
+
+
+# sqlite connections can't be shared between threads, so there is one per thread (and database), reused for all lookups
+_connections = threading.local()
+
+
+def _connect(db: Path, *, schema: Sequence[str]) -> sqlite3.Connection:
+    conns: dict[Path, tuple[int, sqlite3.Connection]] | None = getattr(_connections, 'conns', None)
+    if conns is None:
+        conns = {}
+        _connections.conns = conns
+    pid = os.getpid()
+    cached = conns.get(db)
+    # connections can't be used after fork either, so (process) workers need their own
+    if cached is not None and cached[0] == pid:
+        return cached[1]
+    db.parent.mkdir(parents=True, exist_ok=True)
+    # timeout since it might be shared by multiple worker processes
+    conn = sqlite3.connect(db, timeout=60)
+    for statement in schema:
+        conn.execute(statement)
+    conns[db] = (pid, conn)
+    return conn
+
+
+def _disconnect(db: Path) -> None:
+    conns: dict[Path, tuple[int, sqlite3.Connection]] = getattr(_connections, 'conns', {})
+    cached = conns.pop(db, None)
+    if cached is not None and cached[0] == os.getpid():
+        cached[1].close()
+
+
+class DigestIndex:
+    """
+    Maps file metadata to previously computed content digests.
+
+    Hashing multi-GB inputs costs about as much as some of the work we're trying to skip by caching,
+    so we only rehash when (path, size, mtime, inode) changes. For unchanged files lookups don't read file content at all.
+    """
+
+    def __init__(self, db: Path) -> None:
+        self.db = db
+
+    def _connect(self) -> sqlite3.Connection:
+        return _connect(
+            self.db,
+            schema=[
+                'CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, digest TEXT)'
+            ],
+        )
+
+    def digest(self, path: Path) -> str:
+        path = path.absolute()
+        st = path.stat()
+        meta = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT size, mtime_ns, inode, digest FROM digests WHERE path = ?', (str(path),)
+            ).fetchone()
+        if row is not None and tuple(row[:3]) == meta:
+            return row[3]
+
+        digest = file_digest(path)
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)', (str(path), *meta, digest))
+        return digest
+
+    def prune(self) -> int:
+        """
+        Removes entries for files which don't exist anymore (e.g. pruned inputs), returns the number of removed entries.
+        """
+        with self._connect() as conn:
+            paths = [path for (path,) in conn.execute('SELECT path FROM digests')]
+            gone = [(path,) for path in paths if not Path(path).exists()]
+            conn.executemany('DELETE FROM digests WHERE path = ?', gone)
+        return len(gone)
+
+
+type Relation = Literal['same', 'subset']
+
+
+class Verdicts:
+    """
+    Persistent memo of FileSet comparison results.
+
+    Sets are identified by the content ids of normalised files they consist of, so no need to read the files to look up the verdict.
+    The content id is either the key of the normalised cache entry (which determines its content),
+    or the digest of the file itself for 'identity' normalisers.
+    """
+
+    def __init__(self, db: Path) -> None:
+        self.db = db
+        # normalised file -> its content id
+        self.ids: dict[Path, str] = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        return _connect(
+            self.db,
+            schema=[
+                'CREATE TABLE IF NOT EXISTS verdicts (relation TEXT, left TEXT, right TEXT, result INTEGER, PRIMARY KEY (relation, left, right))',
+                # content ids each set consists of, so verdicts can be removed when the content is evicted from the cache
+                'CREATE TABLE IF NOT EXISTS members (item TEXT, set_id TEXT, PRIMARY KEY (item, set_id))',
+                'CREATE INDEX IF NOT EXISTS members_by_set ON members (set_id)',
+            ],
+        )
+
+    def item_ids(self, items: Iterable[Path]) -> set[str] | None:
+        ids = set()
+        for i in items:
+            iid = self.ids.get(i)
+            if iid is None:
+                # not something we know the content of (e.g. normalised without cache), so can't use verdicts
+                return None
+            ids.add(iid)
+        return ids
+
+    def set_id(self, ids: Iterable[str]) -> str:
+        return hashlib.sha256('\n'.join(sorted(ids)).encode()).hexdigest()
+
+    def get(self, relation: Relation, left: str, right: str) -> bool | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT result FROM verdicts WHERE relation = ? AND left = ? AND right = ?', (relation, left, right)
+            ).fetchone()
+        return None if row is None else bool(row[0])
+
+    def put(
+        self,
+        relation: Relation,
+        left: str,
+        right: str,
+        *,
+        result: bool,
+        members: dict[str, Iterable[str]],
+    ) -> None:
+        """
+        members: content ids for each set id
+        """
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?)', (relation, left, right, int(result)))
+            conn.executemany(
+                'INSERT OR IGNORE INTO members VALUES (?, ?)',
+                [(item, set_id) for set_id, items in members.items() for item in items],
+            )
+
+    def forget(self, items: Collection[str]) -> int:
+        """
+        Removes verdicts about sets containing any of the items, returns the number of removed verdicts.
+        """
+        if len(items) == 0:
+            return 0
+        with self._connect() as conn:
+            conn.execute('CREATE TEMP TABLE forgotten (set_id TEXT PRIMARY KEY)')
+            try:
+                conn.executemany(
+                    'INSERT OR IGNORE INTO forgotten SELECT set_id FROM members WHERE item = ?',
+                    [(item,) for item in items],
+                )
+                removed = conn.execute('DELETE FROM verdicts WHERE left IN forgotten OR right IN forgotten').rowcount
+                conn.execute('DELETE FROM members WHERE set_id IN forgotten')
+            finally:
+                conn.execute('DROP TABLE forgotten')
+        return removed
+
+
+def _core_sources() -> list[Path]:
+    core_dir = Path(__file__).absolute().parent
+    # tests don't impact normalisation, no need to invalidate the cache when they change
+    return sorted(p for p in core_dir.rglob('*.py') if 'tests' not in p.relative_to(core_dir).parts)
+
+
+def _is_hpi(module: str) -> bool:
+    return module == 'my' or module.startswith('my.')
+
+
+def _hpi_sources(modules: Iterable[ModuleType]) -> set[Path]:
+    """
+    Sources of HPI (my.*) modules referenced by the modules, directly or via other HPI modules.
+
+    HPI based normalisers (see bleanser.modules.hpi) call into these to do the actual work, so HPI upgrades might change the output.
+    """
+    seen: dict[str, ModuleType] = {}
+    queue = list(modules)
+    while len(queue) > 0:
+        module = queue.pop()
+        for v in vars(module).values():
+            name = v.__name__ if inspect.ismodule(v) else getattr(v, '__module__', None)
+            if not isinstance(name, str) or not _is_hpi(name) or name in seen:
+                continue
+            referenced = sys.modules.get(name)
+            if referenced is None:
+                continue
+            seen[name] = referenced
+            queue.append(referenced)
+    res = set()
+    for m in seen.values():
+        sourcefile = getattr(m, '__file__', None)
+        if sourcefile is not None:
+            res.add(Path(sourcefile).absolute())
+    return res
+
+
+_fingerprints: dict[type, str] = {}
+
+
+def normaliser_fingerprint(Normaliser: type[BaseNormaliser]) -> str:
+    """
+    Hash of the code which might impact the normalised output.
+
+    That's the modules defining the normaliser and all of its base classes, plus the core bleanser machinery
+    (e.g. sqlite dumbening isn't part of the class hierarchy, but certainly impacts the output),
+    plus HPI modules they use.
+    """
+    res = _fingerprints.get(Normaliser)
+    if res is None:
+        res = _compute_fingerprint(Normaliser)
+        _fingerprints[Normaliser] = res
+    return res
+
+
+def _compute_fingerprint(Normaliser: type[BaseNormaliser]) -> str:
+    sources: set[Path] = set(_core_sources())
+    modules = []
+    for cls in Normaliser.__mro__:
+        if cls is object:
+            continue
+        sourcefile = inspect.getsourcefile(cls)
+        assert sourcefile is not None, cls
+        sources.add(Path(sourcefile).absolute())
+        module = inspect.getmodule(cls)
+        if module is not None:
+            modules.append(module)
+    sources |= _hpi_sources(modules)
+
+    h = hashlib.sha256()
+    h.update(f'{_CACHE_VERSION}\n'.encode())
+    for s in sorted(sources):
+        h.update(f'{s.name}\n'.encode())
+        h.update(s.read_bytes())
+    return h.hexdigest()
+
+
+# namespaces which keep (potentially huge) blobs, these are subject to eviction
+NAMESPACES = (
+    'normalised',  # see processor._do_normalise_cached
+    'dumben',  # see ext.sqlite_dumben
+)
+
+# temporary files older than that are considered leftovers from crashed/killed processes
+_STALE_TMP_SECONDS = 24 * 60 * 60
+
+_SIZE_SUFFIXES = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_size(size: str) -> int:
+    """
+    >>> parse_size('1000')
+    1000
+    >>> parse_size('10M')
+    10485760
+    >>> parse_size('1.5g')
+    1610612736
+    """
+    size = size.strip().upper().removesuffix('B')
+    multiplier = _SIZE_SUFFIXES.get(size[-1:])
+    if multiplier is None:
+        return int(size)
+    return int(float(size[:-1]) * multiplier)
+
+
+@dataclass
+class CacheStats:
+    entries: int
+    bytes: int
+
+
+class Cache:
+    """
+    Content addressed store, entries are immutable once written.
+
+    Layout is <root>/<namespace>/<key[:2]>/<key>, same as e.g. git objects, to avoid huge directories.
+
+    Entries are written atomically, so it's safe to share the cache between parallel workers.
+    Reading an entry bumps its mtime, which is used for LRU eviction (atime is unreliable with noatime/relatime mounts).
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self.digests = DigestIndex(root / 'digests.sqlite')
+        self.verdicts = Verdicts(root / 'verdicts.sqlite')
+
+    def _entry(self, namespace: str, key: str) -> Path:
+        assert namespace in NAMESPACES, namespace
+        return self.root / namespace / key[:2] / key
+
+    def fetch(self, namespace: str, key: str, dst: Path, *, link: bool = True) -> bool:
+        """
+        Places cached entry at dst and returns True, or returns False if there is no such entry.
+
+        link: whether it's fine to hardlink the entry. Only use it if the caller isn't going to modify dst!
+        """
+        entry = self._entry(namespace, key)
+        try:
+            os.utime(entry)
+            if link:
+                link_or_copy(entry, dst)
+            else:
+                shutil.copyfile(entry, dst)
+        except FileNotFoundError:
+            # either missing or just got evicted by another process
+            dst.unlink(missing_ok=True)
+            return False
+        return True
+
+    def contains(self, namespace: str, key: str) -> bool:
+        return self._entry(namespace, key).exists()
+
+    def put(self, namespace: str, key: str, src: Path) -> Path:
+        entry = self._entry(namespace, key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first and rename, so readers never see partially written entries
+        with NamedTemporaryFile(dir=entry.parent, prefix='.tmp-', delete=False) as tmp:
+            tmp_path = Path(tmp.name)
+        try:
+            shutil.copyfile(src, tmp_path)
+            tmp_path.replace(entry)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        return entry
+
+    def _entries(self) -> Iterator[tuple[str, Path, os.stat_result]]:
+        for namespace in NAMESPACES:
+            for entry in (self.root / namespace).glob('*/*'):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    # concurrently evicted
+                    continue
+                yield namespace, entry, st
+
+    def stats(self) -> dict[str, CacheStats]:
+        res = {namespace: CacheStats(entries=0, bytes=0) for namespace in NAMESPACES}
+        for namespace, entry, st in self._entries():
+            if entry.name.startswith('.tmp-'):
+                continue
+            res[namespace].entries += 1
+            res[namespace].bytes += st.st_size
+        return res
+
+    def gc(self, *, max_bytes: int) -> CacheStats:
+        """
+        Evicts least recently used entries until the total size fits in max_bytes.
+        Also removes verdicts about evicted normalised files, and digests of files which don't exist anymore,
+        otherwise these would grow without bound.
+
+        Returns stats for the evicted entries.
+        """
+        now = time()
+        entries = []
+        for namespace, entry, st in self._entries():
+            if entry.name.startswith('.tmp-'):
+                if now - st.st_mtime > _STALE_TMP_SECONDS:
+                    entry.unlink(missing_ok=True)
+                # otherwise might still be written by someone
+                continue
+            entries.append((namespace, entry, st))
+
+        evicted = CacheStats(entries=0, bytes=0)
+        evicted_keys: set[str] = set()
+        total = sum(st.st_size for _, _, st in entries)
+        # oldest first
+        for namespace, entry, st in sorted(entries, key=lambda e: e[2].st_mtime_ns):
+            if total <= max_bytes:
+                break
+            entry.unlink(missing_ok=True)
+            total -= st.st_size
+            evicted.entries += 1
+            evicted.bytes += st.st_size
+            if namespace == 'normalised':
+                # the key is the content id, see processor._do_normalise_cached
+                evicted_keys.add(entry.name)
+        verdicts = self.verdicts.forget(evicted_keys)
+        digests = self.digests.prune()
+        logger.info(
+            'cache gc: evicted %d entries (%d bytes), %d verdicts and %d digests, cache size is %d bytes',
+            evicted.entries,
+            evicted.bytes,
+            verdicts,
+            digests,
+            total,
+        )
+        return evicted
+
+    def clear(self) -> None:
+        for namespace in NAMESPACES:
+            shutil.rmtree(self.root / namespace, ignore_errors=True)
+        for db in [self.digests.db, self.verdicts.db]:
+            _disconnect(db)
+            db.unlink(missing_ok=True)
+
+    def normalised_key(self, normaliser: BaseNormaliser) -> str:
+        Normaliser = type(normaliser)
+        parts = [
+            str(Normaliser._relative_base_tmp_dir()),
+            # qualname in case there are multiple normalisers with the same name in a module (e.g. in tests)
+            Normaliser.__qualname__,
+            normaliser_fingerprint(Normaliser),
+            self.digests.digest(normaliser.original),
+        ]
+        return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+def link_or_copy(src: Path, dst: Path) -> None:
+    # hardlinking is much cheaper for big dumps, but won't work across filesystems
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        logger.debug("couldn't hardlink %s -> %s (%s), copying instead", src, dst, e)
+        shutil.copyfile(src, dst)
@@ -10,8 +10,25 @@ from typing import cast
 
 import click
 
+from .cache import Cache, parse_size
 from .common import Dry, Instruction, Keep, Mode, Move, Prune, Remove, logger
-from .processor import BaseNormaliser, FileSet, apply_instructions, bleanser_tmp_directory, compute_instructions
+from .incremental import journal_path
+from .jobqueue import distribute as distribute_jobs
+from .jobqueue import run_workers
+from .modules.sqlite import SqliteCheck, SqliteNormaliser
+from .processor import (
+    BaseNormaliser,
+    Engine,
+    FileSet,
+    Lookahead,
+    Parallel,
+    PoolKind,
+    _make_pool,
+    apply_instructions,
+    bleanser_tmp_directory,
+    compute_instructions,
+    compute_instructions_shared,
+)
 
 
 @click.group(context_settings={'max_content_width': 120, 'show_default': True})
@@ -52,6 +69,23 @@ Using multiple normalisers is an advanced/experimental feature, will be document
 )
 
 
+option_cache_dir = click.option(
+    '--cache-dir',
+    type=Path,
+    envvar='BLEANSER_CACHE_DIR',
+    default=None,
+    help='Directory to keep normalised files in between runs, so unchanged inputs do not need to be normalised again.',
+)
+
+option_cache_max_size = click.option(
+    '--cache-max-size',
+    type=str,
+    envvar='BLEANSER_CACHE_MAX_SIZE',
+    default=None,
+    help='Evict least recently used cache entries to keep the cache within this size, e.g. 20G.',
+)
+
+
 @main.command(name='prune', short_help='process & prune files')
 @option_normaliser
 @click.argument('path', type=str)
@@ -80,10 +114,67 @@ Using multiple normalisers is an advanced/experimental feature, will be document
     default=None,
     help="Number of threads (processes) to use. Without the flag won't use any, with the flag will try using all available, can also take a specific value. Passed down to PoolExecutor.",
 )
+@click.option(
+    '--parallel',
+    type=click.Choice(['pipeline', 'chunks']),
+    default='pipeline',
+    help="How to use threads. 'pipeline' normalises files in parallel and compares them in order, same results as a serial run. 'chunks' processes contiguous chunks independently, and then recomputes groups at chunk boundaries.",
+)
+@click.option(
+    '--executor',
+    type=click.Choice(['thread', 'process']),
+    default=None,
+    help="What runs the workers. 'thread' avoids pickling and per-process imports, and works well for sqlite/subprocess bound normalisers. Defaults to 'thread' on free-threaded python, otherwise 'process'.",
+)
+@click.option(
+    '--lookahead',
+    type=int,
+    default=None,
+    help="Max number of normalised files kept around in 'pipeline' mode (including ones normalised ahead of time). Default is two per thread, plus three.",
+)
+@click.option(
+    '--lookahead-size',
+    type=str,
+    default=None,
+    help="Max total size of normalised files kept around in 'pipeline' mode, e.g. '5G'. Useful to bound temporary disk usage with many threads.",
+)
+@click.option(
+    '--speculate',
+    type=int,
+    default=0,
+    help="In 'pipeline' mode, also check that many next files in parallel (as if they were all going to be pruned). Keeps threads busy when comparisons are the bottleneck.",
+)
 ##
+@option_cache_dir
+@option_cache_max_size
+##
+@click.option(
+    '--engine',
+    type=click.Choice(['exact', 'hash']),
+    default='exact',
+    help="How to compare normalised files. 'hash' compares line hashes in-process, which is faster but requires numpy.",
+)
+@click.option(
+    '--sqlite-check',
+    type=click.Choice(['none', 'quick', 'full']),
+    default=None,
+    help="For sqlite based normalisers: how thoroughly to check databases for corruption. 'full' runs integrity_check on the cleaned up copy, 'quick' runs quick_check instead, 'none' skips the checks (useful for huge databases). Default is whatever the normaliser specifies, usually 'full'.",
+)
 @click.option('--from', 'from_', type=int, default=None)
 @click.option('--to', type=int, default=None)
 ##
+@click.option(
+    '--distribute',
+    is_flag=True,
+    default=False,
+    help="Publish normalisation jobs to a queue in --cache-dir first, so 'bleanser worker' processes on other hosts sharing the cache can help.",
+)
+@click.option(
+    '--incremental',
+    is_flag=True,
+    default=False,
+    help='Resume from the last group computed by the previous run (kept in --cache-dir), so only new files are processed.',
+)
 @click.option('--multiway', is_flag=True, default=None, help='force "multiway" cleanup')
 @click.option('--prune-dominated', is_flag=True, default=None)
 @click.option('--prune-empty-dirs', is_flag=True, help='remove leftover empty dirs (useful in glob mode)')
@@ -99,6 +190,17 @@ def prune(
     move: Path | None,
     remove: bool,
     threads: int | None,
+    parallel: Parallel,
+    executor: PoolKind | None,
+    lookahead: int | None,
+    lookahead_size: str | None,
+    speculate: int,
+    cache_dir: Path | None,
+    cache_max_size: str | None,
+    distribute: bool,
+    incremental: bool,
+    engine: Engine,
+    sqlite_check: SqliteCheck | None,
     from_: int | None,
     to: int | None,
     multiway: bool | None,
@@ -130,13 +232,70 @@ def prune(
     if prune_dominated is not None:
         for Normaliser in Normalisers:
             Normaliser.PRUNE_DOMINATED = prune_dominated
+    if sqlite_check is not None:
+        for Normaliser in Normalisers:
+            if issubclass(Normaliser, SqliteNormaliser):
+                Normaliser.CHECK = sqlite_check
 
     # TODO maybe move this logic insode apply_instructions?
     # then can print instructions for different normalisers
+    if incremental:
+        if cache_dir is None:
+            raise click.UsageError('--incremental needs --cache-dir to keep track of previous runs')
+        if sort_by != 'name':
+            raise click.UsageError(
+                "--incremental relies on new files being added at the end, so only works with '--sort-by name'"
+            )
+
+    if distribute:
+        if cache_dir is None:
+            raise click.UsageError('--distribute needs --cache-dir shared with the workers')
+        # after that everything is in the cache, so computing groups doesn't need to normalise anything
+        distribute_jobs(paths, Normalisers=Normalisers, cache_dir=cache_dir, threads=threads, executor=executor)
+
+    lookahead_limits = Lookahead(
+        files=lookahead,
+        bytes=None if lookahead_size is None else parse_size(lookahead_size),
+    )
     all_instructions: list[list[Instruction]] = []
-    for Normaliser in Normalisers:
-        instructions = list(compute_instructions(paths, Normaliser=Normaliser, threads=threads))
-        all_instructions.append(instructions)
+    if len(Normalisers) > 1 and parallel == 'pipeline' and not incremental:
+        # share unpacked inputs between normalisers, and run them concurrently
+        all_instructions = compute_instructions_shared(
+            paths,
+            Normalisers=Normalisers,
+            threads=threads,
+            executor=executor,
+            lookahead=lookahead_limits,
+            speculate=speculate,
+            cache_dir=cache_dir,
+            engine=engine,
+        )
+    else:
+        # same workers for all normalisers, so they only start (and run worker_setup) once
+        with _make_pool(threads=threads, executor=executor, Normalisers=Normalisers) as pool:
+            for Normaliser in Normalisers:
+                journal = None
+                if incremental:
+                    assert cache_dir is not None  # checked above
+                    journal = journal_path(
+                        cache_dir=cache_dir, dataset=str(Path(path).absolute()), Normaliser=Normaliser
+                    )
+                instructions = list(
+                    compute_instructions(
+                        paths,
+                        Normaliser=Normaliser,
+                        threads=threads,
+                        parallel=parallel,
+                        executor=executor,
+                        lookahead=lookahead_limits,
+                        speculate=speculate,
+                        cache_dir=cache_dir,
+                        journal=journal,
+                        engine=engine,
+                        pool=pool,
+                    )
+                )
+                all_instructions.append(instructions)
 
     for path_instructions in zip(*all_instructions, strict=True):
         # just in case
@@ -153,6 +312,9 @@ def prune(
                     f"Inconsistent normalisers! {il.path} is pruned by {Normalisers[i]} but kept by {Normalisers[i + 1]}"
                 )
 
+    if cache_dir is not None and cache_max_size is not None:
+        Cache(cache_dir).gc(max_bytes=parse_size(cache_max_size))
+
     # for actual pruning, use the least 'agnostic'/most efficient normaliser
     instructions = all_instructions[-1]
 
@@ -236,6 +398,75 @@ def normalised(ctx: click.Context, *, normaliser: list[str], path: Path, stdout:
                 click.pause(info="Press any key when you've finished")
 
 
+@main.command(name='worker', short_help='process normalisation jobs published by prune --distribute')
+@option_cache_dir
+@click.option(
+    '--threads',
+    type=int,
+    is_flag=False,
+    flag_value=0,
+    default=None,
+    help="Number of worker processes to run. Without the flag runs a single one, with the flag will use all available cpus.",
+)
+@click.option(
+    '--executor',
+    type=click.Choice(['thread', 'process']),
+    default=None,
+    help="What runs the workers, same as for prune. Defaults to 'thread' on free-threaded python, otherwise 'process'.",
+)
+@click.option(
+    '--exit-when-empty',
+    is_flag=True,
+    default=False,
+    help='Exit when there are no jobs left, rather than waiting for more',
+)
+def worker(*, cache_dir: Path | None, threads: int | None, executor: PoolKind | None, exit_when_empty: bool) -> None:
+    c = _get_cache(cache_dir)
+    processed = run_workers(c.root, threads=threads, executor=executor, exit_when_empty=exit_when_empty)
+    click.echo(f'processed {processed} jobs')
+
+
+@main.group(name='cache', short_help='manage the cache of normalised files')
+def cache() -> None:
+    pass
+
+
+def _get_cache(cache_dir: Path | None) -> Cache:
+    if cache_dir is None:
+        raise click.UsageError('please specify --cache-dir (or set BLEANSER_CACHE_DIR)')
+    return Cache(cache_dir)
+
+
+@cache.command(name='stats', short_help='show cache size')
+@option_cache_dir
+def cache_stats(*, cache_dir: Path | None) -> None:
+    stats = _get_cache(cache_dir).stats()
+    for namespace, st in stats.items():
+        click.echo(f'{namespace:<12}: {st.entries:>6} entries, {st.bytes / 2**20:>10.1f} Mb')
+    total = sum(st.bytes for st in stats.values())
+    click.echo(f'{"total":<12}: {sum(st.entries for st in stats.values()):>6} entries, {total / 2**20:>10.1f} Mb')
+
+
+@cache.command(name='gc', short_help='evict least recently used entries')
+@option_cache_dir
+@option_cache_max_size
+def cache_gc(*, cache_dir: Path | None, cache_max_size: str | None) -> None:
+    if cache_max_size is None:
+        raise click.UsageError('please specify --cache-max-size (or set BLEANSER_CACHE_MAX_SIZE)')
+    evicted = _get_cache(cache_dir).gc(max_bytes=parse_size(cache_max_size))
+    click.echo(f'evicted {evicted.entries} entries, {evicted.bytes / 2**20:.1f} Mb')
+
+
+@cache.command(name='clear', short_help='remove all cache entries')
+@option_cache_dir
+@click.option('--yes', is_flag=True, default=False, help="Do not prompt before clearing")
+def cache_clear(*, cache_dir: Path | None, yes: bool) -> None:
+    c = _get_cache(cache_dir)
+    if not yes:
+        click.confirm(f'Remove everything cached in {c.root}?', abort=True)
+    c.clear()
+
+
 def _get_paths(
     *, path: str, from_: int | None, to: int | None, sort_by: str = "name", glob: bool = False
 ) -> list[Path]:
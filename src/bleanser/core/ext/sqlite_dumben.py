@@ -21,6 +21,7 @@ from contextlib import closing
 from pathlib import Path
 from subprocess import check_call, check_output
 from tempfile import TemporaryDirectory
+from typing import Literal
 
 type Tables = dict[str, dict[str, str]]
 
@@ -29,58 +30,54 @@ def connect_immutable(db: Path) -> sqlite3.Connection:
     return sqlite3.connect(f'file:{db}?immutable=1', uri=True)
 
 
-def _get_tables(db: Path) -> Tables:
+def _tables(conn: sqlite3.Connection) -> Tables:
     res: Tables = {}
-    with closing(connect_immutable(db)) as conn, conn:
-        tables = []
-        for row in conn.execute('SELECT name, type FROM sqlite_master'):
-            (table, type_) = row
-            if type_ in {'index', 'view', 'trigger'}:
-                # todo log what kind of things we are filtering out?
-                continue
-            assert type_ == 'table', (table, type_)
-            tables.append(table)
-
-        for table in tables:
-            schema: dict[str, str] = {}
-            for row in conn.execute(f'PRAGMA table_info({table})'):
-                col = row[1]
-                type_ = row[2]
-                schema[col] = type_
-            res[table] = schema
+    tables = []
+    for row in conn.execute('SELECT name, type FROM sqlite_master'):
+        (table, type_) = row
+        if type_ in {'index', 'view', 'trigger'}:
+            # todo log what kind of things we are filtering out?
+            continue
+        assert type_ == 'table', (table, type_)
+        tables.append(table)
+
+    for table in tables:
+        schema: dict[str, str] = {}
+        for row in conn.execute(f'PRAGMA table_info({table})'):
+            col = row[1]
+            type_ = row[2]
+            schema[col] = type_
+        res[table] = schema
     return res
 
 
+def _get_tables(db: Path) -> Tables:
+    with closing(connect_immutable(db)) as conn, conn:
+        return _tables(conn)
+
+
 def _sqlite(*cmd: Path | str) -> Sequence[Path | str]:
     return ['sqlite3', '-bail', *cmd]
 
 
-def _dumben_db(output_db: Path) -> None:
-    # expected to operate on output_db directly
-    assert output_db.exists(), output_db
+_ALLOW_WRITABLE_SCHEMA = [
+    # seems like some versions of sqlite (e.g. on osx don't allow writable schema without this pragma)
+    # https://github.com/tekartik/sqflite/blob/master/sqflite_common_ffi/doc/custom_pragmas.md?plain=1
+    "PRAGMA sqflite -- db_config_defensive_off",
+    "PRAGMA writable_schema=ON",
+]
+
+# first delete virtual tables -- they might render it impossible to do anything with database at all due to USING
+# e.g. fb messenger android msys database has this CREATE VIRTUAL TABLE msys_experiment_cache USING experiment_cache
+# either way virtual tables are basically views, no need to keep them
+_DELETE_VIRTUAL_TABLES = 'DELETE FROM sqlite_master WHERE sql LIKE "%CREATE VIRTUAL TABLE%"'
 
+
+def _dumben_cmds(tables: Tables) -> list[str]:
     # hmm. CREATE TABLE syntax seems ridiculously complicated https://www.sqlite.org/lang_createtable.html
     # so seems pretty hopeless to sanitize off the constraints purely via sqlite?
     # the only easy win is making it single line
     # "UPDATE sqlite_master SET sql = replace(sql, char(10), ' ');"
-
-    allow_writable_schema = [
-        # seems like some versions of sqlite (e.g. on osx don't allow writable schema without this pragma)
-        # https://github.com/tekartik/sqflite/blob/master/sqflite_common_ffi/doc/custom_pragmas.md?plain=1
-        "PRAGMA sqflite -- db_config_defensive_off",
-        "PRAGMA writable_schema=ON",
-    ]
-
-    # first delete virtual tables -- they might render it impossible to do anything with database at all due to USING
-    # e.g. fb messenger android msys database has this CREATE VIRTUAL TABLE msys_experiment_cache USING experiment_cache
-    # either way virtual tables are basically views, no need to keep them
-    with closing(sqlite3.connect(output_db)) as conn, conn:
-        for cmd in allow_writable_schema:
-            conn.execute(cmd)
-        conn.execute('DELETE FROM sqlite_master WHERE sql LIKE "%CREATE VIRTUAL TABLE%"')
-
-    tables = _get_tables(output_db)
-
     updates = []
     for name, schema in tables.items():
         simple_create = f'CREATE TABLE `{name}` (' + ', '.join(f'`{k}` {v}' for k, v in schema.items()) + ')'
@@ -89,8 +86,8 @@ def _dumben_db(output_db: Path) -> None:
         upd = f'UPDATE sqlite_master SET sql = "{simple_create}" WHERE name = "{name}";'
         updates.append(upd)
 
-    cmds = [
-        *allow_writable_schema,
+    return [
+        *_ALLOW_WRITABLE_SCHEMA,
         # drop table doesn't work for special sqlite_ tables
         # sqlite_sequence is something to do with autoincrement, ends up with some indices noise otherwise
         # sqlite_stat{1,2,3,4} is something to do with ANALYZE query
@@ -103,18 +100,77 @@ def _dumben_db(output_db: Path) -> None:
         'VACUUM',
     ]
 
+
+def _check(conn: sqlite3.Connection, check: Literal['integrity', 'quick'] | None) -> None:
+    # in principle full integrity check may be not really necessary considering we removed all indices etc
+    # but even on big firefox databases it takes just ~50ms, so probably no harm
+    if check is not None:
+        [(check_result,)] = list(conn.execute(f'PRAGMA {check}_check;'))
+        assert check_result == 'ok', check_result
+
+
+def _dumben_db(output_db: Path, *, check: Literal['integrity', 'quick'] | None = 'integrity') -> None:
+    # expected to operate on output_db directly
+    assert output_db.exists(), output_db
+
+    with closing(sqlite3.connect(output_db)) as conn, conn:
+        for cmd in _ALLOW_WRITABLE_SCHEMA:
+            conn.execute(cmd)
+        conn.execute(_DELETE_VIRTUAL_TABLES)
+
+    tables = _get_tables(output_db)
+
     # need to set isolation level to None, otherwise VACUUM fails
     with closing(sqlite3.connect(output_db, isolation_level=None)) as conn, conn:
-        for cmd in cmds:
+        for cmd in _dumben_cmds(tables):
             conn.execute(cmd)
+        _check(conn, check)
+
+
+def dumben_cache_enabled() -> bool:
+    return os.environ.get('SQLITE_DUMBEN_USE_CACHE') is not None
 
-        # in principle full integrity check may be not really necessary considering we removed all indices etc
-        # but even on big firefox databases it takes just ~50ms, so probably no harm
-        [(check_result,)] = list(conn.execute('PRAGMA integrity_check;'))
-        assert check_result == 'ok', check_result
 
+def dumben_in_memory(db: Path, *, check: Literal['integrity', 'quick'] | None = 'integrity') -> sqlite3.Connection:
+    """
+    Same as run(output_as_db=True), but the result is an in-memory database, so nothing is copied or written to disk.
 
-def run(*, db: Path, output: Path | None, output_as_db: bool) -> None:
+    The database is loaded via the backup API, so it needs to fit in memory (VACUUM temporarily needs about as much again).
+    Returns a connection to it, it's up to the caller to close it.
+    """
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    try:
+        # otherwise VACUUM goes through a temporary file
+        conn.execute('PRAGMA temp_store=MEMORY')
+        with closing(connect_immutable(db)) as src:
+            src.backup(conn)
+
+        for cmd in _ALLOW_WRITABLE_SCHEMA:
+            conn.execute(cmd)
+        conn.execute(_DELETE_VIRTUAL_TABLES)
+        # can't reopen an in-memory database like _dumben_db does, so need to reload the schema explicitly
+        # otherwise the connection would keep using cached triggers/constraints
+        conn.execute('PRAGMA writable_schema=RESET')
+
+        for cmd in _dumben_cmds(_tables(conn)):
+            conn.execute(cmd)
+        conn.execute('PRAGMA writable_schema=RESET')
+        _check(conn, check)
+    except BaseException:
+        conn.close()
+        raise
+    # same as the default, so callers get usual implicit transactions
+    conn.isolation_level = 'DEFERRED'
+    return conn
+
+
+def run(
+    *,
+    db: Path,
+    output: Path | None,
+    output_as_db: bool,
+    check: Literal['integrity', 'quick'] | None = 'integrity',
+) -> None:
     if output is not None:
         assert not output.exists(), output
 
@@ -124,29 +180,31 @@ def run(*, db: Path, output: Path | None, output_as_db: bool) -> None:
     if output_as_db:
         assert output is not None
 
-        dumben_cache: Path | None = None
+        from bleanser.core.cache import Cache, file_digest
+
+        dumben_cache: tuple[Cache, str] | None = None
         _DUMBEN_CACHE_BASE = os.environ.get('SQLITE_DUMBEN_USE_CACHE')
         if _DUMBEN_CACHE_BASE is not None:
-            DUMBEN_CACHE_BASE = Path(_DUMBEN_CACHE_BASE)
-            DUMBEN_CACHE_BASE.mkdir(parents=True, exist_ok=True)
-
-            fhash = hashlib.md5(
+            cache = Cache(Path(_DUMBEN_CACHE_BASE))
+            fhash = hashlib.sha256(
                 # add code of sqlite_dumben just in case we change logic
-                db.read_bytes() + Path(__file__).read_bytes()
+                # and the check level, otherwise an unchecked database could be reused by a run which asked for checks
+                (cache.digests.digest(db) + file_digest(Path(__file__)) + f'check={check}').encode()
             ).hexdigest()
 
-            dumben_cache = DUMBEN_CACHE_BASE / fhash
-            if dumben_cache.exists():
+            dumben_cache = (cache, fhash)
+            # NOTE: can't hardlink, the output is going to be modified by the caller
+            if cache.fetch('dumben', fhash, output, link=False):
                 # TODO log it?
-                shutil.copy(dumben_cache, output)
                 return
 
         # if we output as db, just operate on that target database directly
         shutil.copy(db, output)
-        _dumben_db(output)
+        _dumben_db(output, check=check)
 
         if dumben_cache is not None:
-            shutil.copy(output, dumben_cache)
+            (cache, fhash) = dumben_cache
+            cache.put('dumben', fhash, output)
         return
 
     # otherwise, need to create a temporary db to operate on -- and after that can dump it to sql
@@ -154,7 +212,7 @@ def run(*, db: Path, output: Path | None, output_as_db: bool) -> None:
     with TemporaryDirectory() as td:
         tdir = Path(td)
         tdb = Path(tdir) / 'tmp.db'
-        run(db=db, output=tdb, output_as_db=True)
+        run(db=db, output=tdb, output_as_db=True, check=check)
         if output is not None:
             with output.open('w') as out:
                 subprocess.run(_sqlite(tdb, '.dump'), check=True, stdout=out)
@@ -300,6 +358,25 @@ INSERT INTO audit_log VALUES (2, 999, 'keep this sales audit entry');
     assert count(dumb_db, 'audit_log') == 2
 
 
+def test_dumben_cache_check_level(tmp_path: Path) -> None:
+    import pytest
+
+    from bleanser.core.cache import Cache
+
+    db = tmp_path / 'tmp.db'
+    subprocess.run(_sqlite(db), input=b'CREATE TABLE t (x); INSERT INTO t VALUES (1);', check=True)
+
+    cache_dir = tmp_path / 'cache'
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv('SQLITE_DUMBEN_USE_CACHE', str(cache_dir))
+        run(db=db, output=tmp_path / 'unchecked.db', output_as_db=True, check=None)
+        run(db=db, output=tmp_path / 'unchecked2.db', output_as_db=True, check=None)
+        assert Cache(cache_dir).stats()['dumben'].entries == 1
+        # shouldn't reuse the unchecked database
+        run(db=db, output=tmp_path / 'checked.db', output_as_db=True, check='integrity')
+        assert Cache(cache_dir).stats()['dumben'].entries == 2
+
+
 def main() -> None:
     from argparse import ArgumentParser
 
@@ -0,0 +1,126 @@
+"""
+Alternative FileSet engine, which represents normalised files as sorted arrays of 64-bit line hashes.
+
+Unions and subset checks are then done in-process via numpy, without spawning sort/diff and rewriting merged files.
+The price is that it's probabilistic: a hash collision could make a file look like it's contained in another one when it's not.
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterable, Sequence
+from contextlib import AbstractContextManager
+from hashlib import blake2b
+from pathlib import Path
+from typing import Self, override
+
+import more_itertools
+import numpy as np
+import numpy.typing as npt
+
+type LineHashes = npt.NDArray[np.uint64]
+
+
+_EMPTY: LineHashes = np.array([], dtype=np.uint64)
+
+# normalised files can be multiple GB, so they are hashed in chunks rather than read in memory all at once
+_CHUNK_BYTES = 16 * 2**20
+
+
+def _hashes(lines: Iterable[bytes]) -> LineHashes:
+    hashes = b''.join(blake2b(line, digest_size=8).digest() for line in lines)
+    # np.unique sorts and deduplicates, same as sort --unique in exact FileSet
+    return np.unique(np.frombuffer(hashes, dtype=np.uint64))
+
+
+def _line_hashes(path: Path) -> LineHashes:
+    res: list[LineHashes] = [_EMPTY]
+    tail: list[bytes] = []  # incomplete last line of the chunks so far
+    with path.open('rb') as fo:
+        while len(chunk := fo.read(_CHUNK_BYTES)) > 0:
+            # NOTE: split exactly the same way sort does, i.e. only on \n
+            lines = chunk.split(b'\n')
+            if len(lines) == 1:
+                # no newlines at all, e.g. some huge blob
+                tail.append(chunk)
+                continue
+            lines[0] = b''.join([*tail, lines[0]])
+            tail = [lines.pop()]
+            # deduplicating each chunk straight away keeps memory usage down
+            res.append(_hashes(lines))
+    last = b''.join(tail)
+    if len(last) > 0:
+        # no newline at the end of file
+        res.append(_hashes([last]))
+    return np.unique(np.concatenate(res))
+
+
+class HashRegistry:
+    """
+    Memoises line hashes of normalised files, since the same file usually takes part in many comparisons.
+    """
+
+    def __init__(self) -> None:
+        self._hashes: dict[Path, LineHashes] = {}
+
+    def get(self, path: Path) -> LineHashes:
+        res = self._hashes.get(path)
+        if res is None:
+            res = _line_hashes(path)
+            self._hashes[path] = res
+        return res
+
+    def forget(self, path: Path) -> None:
+        self._hashes.pop(path, None)
+
+
+class HashFileSet(AbstractContextManager):
+    def __init__(self, items: Sequence[Path] = (), *, registry: HashRegistry) -> None:
+        self.registry = registry
+        self.items: list[Path] = []
+        self.hashes = _EMPTY
+        self._union(*items)
+
+    def union(self, *paths: Path) -> HashFileSet:
+        u = HashFileSet(registry=self.registry)
+        u.items = list(self.items)
+        u.hashes = self.hashes
+        u._union(*paths)
+        return u
+
+    def _union(self, *paths: Path) -> None:
+        extra = [p for p in paths if p not in self.items]
+        extra = list(more_itertools.unique_everseen(extra))
+        if len(extra) == 0:
+            return
+        self.hashes = np.unique(np.concatenate([self.hashes, *(self.registry.get(p) for p in extra)]))
+        self.items.extend(extra)
+
+    def issame(self, other: HashFileSet) -> bool:
+        return np.array_equal(self.hashes, other.hashes)
+
+    def issubset(self, other: HashFileSet) -> bool:
+        left = self.hashes
+        right = other.hashes
+        if len(left) > len(right):
+            # both are deduplicated, so can't possibly be a subset
+            return False
+        if len(left) == 0:
+            return True
+        idxs = np.searchsorted(right, left)
+        idxs[idxs == len(right)] = 0  # left elements bigger than everything on the right, make sure they don't match
+        return bool(np.all(right[idxs] == left))
+
+    def __repr__(self) -> str:
+        return repr((self.items, len(self.hashes)))
+
+    @override
+    def __enter__(self) -> Self:
+        return self
+
+    @override
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # nothing on disk to clean up
+        pass
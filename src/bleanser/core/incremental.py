@@ -0,0 +1,178 @@
+"""
+Incremental processing: resume group computation from where the previous run has left off.
+
+Group computation is deterministic given its starting point: a group beginning at some file only depends on that file and the ones after it.
+So files before the start of the last group are settled, and only the last group (plus whatever arrived since) needs to be recomputed.
+We keep groups from the previous run in a journal, and reuse them as long as the settled part of the archive is intact.
+If any file in it was modified since, computation resumes from the first group containing it.
+
+NOTE: results don't necessarily match a full run over the current files.
+Once files pruned by the previous run are gone, a full run might merge groups the journal keeps apart.
+But it's conservative, i.e. it never prunes anything a full run wouldn't.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any
+
+from .cache import normaliser_fingerprint
+from .common import Group, logger
+from .processor import BaseNormaliser, Engine, Lookahead, Parallel, PoolKind, compute_groups
+
+_JOURNAL_VERSION = 2
+
+
+def journal_path(*, cache_dir: Path, dataset: str, Normaliser: type[BaseNormaliser]) -> Path:
+    """
+    dataset: something identifying the inputs, e.g. the path/glob passed to the cli
+    """
+    key = '\n'.join([dataset, str(Normaliser._relative_base_tmp_dir()), Normaliser.__qualname__])
+    return cache_dir / 'state' / (hashlib.sha256(key.encode()).hexdigest() + '.json')
+
+
+def _settings(Normaliser: type[BaseNormaliser]) -> dict[str, Any]:
+    # if any of these change, previous groups aren't valid anymore
+    return {
+        'version': _JOURNAL_VERSION,
+        'fingerprint': normaliser_fingerprint(Normaliser),
+        'multiway': Normaliser.MULTIWAY,
+        'prune_dominated': Normaliser.PRUNE_DOMINATED,
+    }
+
+
+def _file_meta(p: Path) -> list[int]:
+    st = p.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _load(journal: Path, *, Normaliser: type[BaseNormaliser]) -> tuple[list[Group], dict[Path, list[int]]] | None:
+    if not journal.exists():
+        return None
+    j = json.loads(journal.read_text())
+    if j['settings'] != _settings(Normaliser):
+        logger.info('%s: normaliser settings changed since the previous run, ignoring the journal', journal)
+        return None
+    groups = [
+        Group(items=[Path(p) for p in g['items']], pivots=[Path(p) for p in g['pivots']], error=g['error'])
+        for g in j['groups']
+    ]
+    meta = {Path(p): m for p, m in j['meta'].items()}
+    return groups, meta
+
+
+def _save(journal: Path, *, Normaliser: type[BaseNormaliser], groups: Sequence[Group]) -> None:
+    items = {i for g in groups for i in g.items}
+    j = {
+        'settings': _settings(Normaliser),
+        'groups': [
+            {'items': [str(p) for p in g.items], 'pivots': [str(p) for p in g.pivots], 'error': g.error} for g in groups
+        ],
+        # used to detect if someone messed with the files
+        'meta': {str(p): _file_meta(p) for p in sorted(items)},
+    }
+    journal.parent.mkdir(parents=True, exist_ok=True)
+    tmp = journal.with_suffix('.tmp')
+    tmp.write_text(json.dumps(j, indent=1))
+    tmp.replace(journal)
+
+
+def _settled(
+    paths: Sequence[Path], *, groups: Sequence[Group], meta: dict[Path, list[int]]
+) -> tuple[list[Group], int] | None:
+    """
+    Returns groups which are still valid (with items pruned since the previous run filtered out),
+    and the index in paths to resume computation from.
+    """
+    if len(groups) == 0:
+        return None
+    # the last group might be extended by new files, so it needs to be recomputed
+    # errors might be transient (or fixed since), so they are recomputed as well
+    first_error = next((i for i, g in enumerate(groups) if g.error), None)
+    if first_error is None:
+        rgroup = len(groups) - 1
+    elif first_error == 0:
+        rgroup = 0
+    else:
+        # groups before the error were cut short by it, so need to be recomputed too
+        # (groups overlap on pivots, so it might be more than one group)
+        before = groups[first_error - 1].items[0]
+        rgroup = next(i for i, g in enumerate(groups) if before in g.items)
+    # modified files might change any group they took part in
+    changed = {p for p in paths if _file_meta(p) != meta.get(p)}
+    first_changed = next((i for i, g in enumerate(groups) if any(p in changed for p in g.items)), None)
+    if first_changed is not None:
+        rgroup = min(rgroup, first_changed)
+    settled = groups[:rgroup]
+    restart = groups[rgroup].items[0]
+    try:
+        ridx = paths.index(restart)
+    except ValueError:
+        return None
+
+    prefix = set(paths[:ridx])
+    known = {i for g in settled for i in g.items}
+    if not prefix <= known:
+        # some files we haven't seen before appeared in the middle of the archive
+        return None
+
+    res = []
+    for g in settled:
+        for p in g.pivots:
+            if p not in prefix and p != restart:
+                # kept file disappeared, so the groups relying on it aren't valid anymore
+                return None
+        items = [i for i in g.items if i in prefix or i == restart]
+        res.append(Group(items=items, pivots=g.pivots, error=False))
+    return res, ridx
+
+
+def compute_groups_incremental(
+    paths: Sequence[Path],
+    *,
+    Normaliser: type[BaseNormaliser],
+    journal: Path,
+    threads: int | None = None,
+    cache_dir: Path | None = None,
+    engine: Engine = 'exact',
+    parallel: Parallel = 'pipeline',
+    lookahead: Lookahead | None = None,
+    speculate: int = 0,
+    executor: PoolKind | None = None,
+    pool: Executor | None = None,
+) -> Iterator[Group]:
+    settled: list[Group] = []
+    ridx = 0
+    loaded = _load(journal, Normaliser=Normaliser)
+    if loaded is not None:
+        (groups, meta) = loaded
+        res = _settled(paths, groups=groups, meta=meta)
+        if res is None:
+            logger.info('%s: inputs changed since the previous run, processing from scratch', journal)
+        else:
+            (settled, ridx) = res
+    logger.info('incremental mode: %d files are settled, processing %d files', ridx, len(paths) - ridx)
+
+    yield from settled
+
+    new_groups = []
+    for g in compute_groups(
+        paths[ridx:],
+        Normaliser=Normaliser,
+        threads=threads,
+        cache_dir=cache_dir,
+        engine=engine,
+        parallel=parallel,
+        lookahead=lookahead,
+        speculate=speculate,
+        executor=executor,
+        pool=pool,
+    ):
+        new_groups.append(g)
+        yield g
+
+    _save(journal, Normaliser=Normaliser, groups=[*settled, *new_groups])
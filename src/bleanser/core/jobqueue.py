@@ -0,0 +1,318 @@
+"""
+Distributing normalisation between multiple hosts, via a job queue in the (shared, e.g. over NFS) cache directory.
+
+The coordinator (prune --distribute) publishes a job for each input which isn't in the cache yet,
+and `bleanser worker` processes (on any host which can access the inputs and the cache) claim them and put normalised files in the cache.
+Once all jobs are done, the coordinator computes groups as usual, with all inputs normalised already.
+
+The queue is just a directory, and claiming a job is an atomic rename, so there is no need for any extra services.
+A job id is the key of the normalised cache entry, so the same input is never normalised twice, even by different coordinators.
+"""
+
+from __future__ import annotations
+
+import importlib
+import inspect
+import json
+import os
+import socket
+import threading
+from collections.abc import Iterator, Sequence
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from time import sleep, time
+from typing import cast
+
+from .cache import Cache
+from .common import logger
+from .processor import (
+    BaseNormaliser,
+    PoolKind,
+    _do_normalise_cached,
+    _make_pool,
+    _worker_setup,
+    bleanser_tmp_directory,
+)
+
+# claimed jobs are touched that often while they are processed
+_HEARTBEAT_SECONDS = 30
+# claimed jobs which haven't been touched for that long are considered abandoned (e.g. worker host went down)
+_STALE_SECONDS = 10 * _HEARTBEAT_SECONDS
+
+_POLL_SECONDS = 1.0
+
+# failed jobs are kept in done/ for that long, other coordinators might still be waiting for them
+_DONE_EXPIRE_SECONDS = 7 * 24 * 60 * 60
+
+
+@dataclass
+class Job:
+    key: str  # see Cache.normalised_key
+    module: str
+    qualname: str
+    path: Path
+
+    def Normaliser(self) -> type[BaseNormaliser]:
+        res: object = importlib.import_module(self.module)
+        for part in self.qualname.split('.'):
+            res = getattr(res, part)
+        return cast(type[BaseNormaliser], res)
+
+
+def _normaliser_ref(Normaliser: type[BaseNormaliser]) -> tuple[str, str]:
+    mm = inspect.getmodule(Normaliser)
+    assert mm is not None, Normaliser
+    # same as in _relative_base_tmp_dir, spec is set even when it's ran as python3 -m bleanser.modules.<module>
+    spec = mm.__spec__
+    assert spec is not None, Normaliser
+    qualname = Normaliser.__qualname__
+    if '<locals>' in qualname:
+        raise RuntimeError(f"{Normaliser} is defined inside a function, so workers can't import it")
+    return spec.name, qualname
+
+
+class JobQueue:
+    """
+    Layout is <root>/{pending,claimed,done}/<job key>.json, a job moves between these as it's processed.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        for d in [self.pending, self.claimed, self.done]:
+            d.mkdir(parents=True, exist_ok=True)
+
+    @property
+    def pending(self) -> Path:
+        return self.root / 'pending'
+
+    @property
+    def claimed(self) -> Path:
+        return self.root / 'claimed'
+
+    @property
+    def done(self) -> Path:
+        return self.root / 'done'
+
+    def _write(self, dst: Path, data: dict) -> None:
+        # write to a temporary file first and rename, so no one sees partially written files
+        with NamedTemporaryFile('w', dir=self.root, prefix='.tmp-', delete=False) as fo:
+            json.dump(data, fo)
+        Path(fo.name).replace(dst)
+
+    def publish(self, job: Job) -> bool:
+        """
+        Returns False if someone (e.g. another coordinator) is already on it.
+        """
+        name = job.key + '.json'
+        if (self.claimed / name).exists() or (self.done / name).exists():
+            return False
+        self._write(
+            self.pending / name,
+            {'module': job.module, 'qualname': job.qualname, 'path': str(job.path)},
+        )
+        return True
+
+    def claim(self) -> Job | None:
+        for pending in sorted(self.pending.glob('*.json')):
+            claimed = self.claimed / pending.name
+            try:
+                # atomic, so only one worker can succeed
+                pending.rename(claimed)
+            except FileNotFoundError:
+                # claimed by someone else in the meantime
+                continue
+            # rename keeps mtime, bump it so it's not considered stale right away
+            os.utime(claimed)
+            j = json.loads(claimed.read_text())
+            return Job(key=claimed.stem, module=j['module'], qualname=j['qualname'], path=Path(j['path']))
+        return None
+
+    @contextmanager
+    def heartbeat(self, job: Job) -> Iterator[None]:
+        claimed = self.claimed / (job.key + '.json')
+        stop = threading.Event()
+
+        def beat() -> None:
+            while not stop.wait(_HEARTBEAT_SECONDS):
+                try:
+                    os.utime(claimed)
+                except FileNotFoundError:
+                    # requeued, nothing we can do about it now
+                    return
+
+        t = threading.Thread(target=beat, daemon=True)
+        t.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            t.join()
+
+    def complete(self, job: Job, *, error: str | None) -> None:
+        name = job.key + '.json'
+        self._write(self.done / name, {'host': socket.gethostname(), 'error': error})
+        (self.claimed / name).unlink(missing_ok=True)
+
+    def result(self, key: str) -> dict | None:
+        try:
+            return json.loads((self.done / (key + '.json')).read_text())
+        except FileNotFoundError:
+            return None
+
+    def requeue_stale(self) -> int:
+        now = time()
+        requeued = 0
+        for claimed in self.claimed.glob('*.json'):
+            try:
+                stale = now - claimed.stat().st_mtime > _STALE_SECONDS
+                if stale:
+                    claimed.rename(self.pending / claimed.name)
+            except FileNotFoundError:
+                # completed in the meantime
+                continue
+            if stale:
+                logger.warning('%s: job was abandoned by its worker, requeuing', claimed.stem)
+                requeued += 1
+        return requeued
+
+    def forget(self, key: str) -> None:
+        (self.done / (key + '.json')).unlink(missing_ok=True)
+
+    def expire_done(self) -> int:
+        now = time()
+        expired = 0
+        for done in self.done.glob('*.json'):
+            try:
+                if now - done.stat().st_mtime > _DONE_EXPIRE_SECONDS:
+                    done.unlink()
+                    expired += 1
+            except FileNotFoundError:
+                # expired by someone else in the meantime
+                continue
+        return expired
+
+
+def queue_path(cache_dir: Path) -> Path:
+    return cache_dir / 'queue'
+
+
+def work(cache_dir: Path, *, exit_when_empty: bool) -> int:
+    """
+    Processes jobs from the queue, returns the number of processed jobs.
+    """
+    queue = JobQueue(queue_path(cache_dir))
+    cache = Cache(cache_dir)
+    processed = 0
+    with bleanser_tmp_directory() as base_tmp_dir:
+        while True:
+            job = queue.claim()
+            if job is None:
+                if exit_when_empty:
+                    return processed
+                sleep(_POLL_SECONDS)
+                continue
+
+            logger.info('%s: normalising %s', job.key, job.path)
+            error: str | None = None
+            with queue.heartbeat(job):
+                try:
+                    Normaliser = job.Normaliser()
+                    # don't know in advance which normalisers the jobs are going to need, so set up on the first use
+                    _worker_setup([Normaliser])
+                    normaliser = Normaliser(original=job.path, base_tmp_dir=base_tmp_dir)
+                    key = cache.normalised_key(normaliser)
+                    if key != job.key:
+                        # e.g. different bleanser version on this host, result would be useless for the coordinator
+                        raise RuntimeError(f"cache key mismatch: expected {job.key}, got {key}")  # noqa: TRY301
+                    with _do_normalise_cached(normaliser, cache=cache):
+                        pass
+                except Exception as e:
+                    logger.exception(e)
+                    error = repr(e)
+            queue.complete(job, error=error)
+            processed += 1
+
+
+def _run_workers(pool: Executor, cache_dir: Path, *, exit_when_empty: bool) -> int:
+    workers = getattr(pool, '_max_workers')
+    futures = [pool.submit(work, cache_dir, exit_when_empty=exit_when_empty) for _ in range(workers)]
+    return sum(f.result() for f in futures)
+
+
+def run_workers(
+    cache_dir: Path,
+    *,
+    threads: int | None,
+    executor: PoolKind | None = None,
+    exit_when_empty: bool,
+) -> int:
+    """
+    threads/executor: same as --threads/--executor, i.e. threads=None means running in the current process
+    """
+    with _make_pool(threads=threads, executor=executor) as pool:
+        return _run_workers(pool, cache_dir, exit_when_empty=exit_when_empty)
+
+
+def distribute(
+    paths: Sequence[Path],
+    *,
+    Normalisers: Sequence[type[BaseNormaliser]],
+    cache_dir: Path,
+    threads: int | None = None,
+    executor: PoolKind | None = None,
+) -> None:
+    """
+    Makes sure all inputs are normalised and in the cache, with help of any `bleanser worker` processes sharing the cache.
+
+    The coordinator processes jobs as well (using threads, if specified), so it doesn't matter if there are no other workers.
+
+    The cache entry is what tells that a job succeeded, so done markers of successful jobs are removed right away.
+    Failed ones are kept for a while (other coordinators sharing the cache might be waiting for them), and expire by age.
+    """
+    queue = JobQueue(queue_path(cache_dir))
+    cache = Cache(cache_dir)
+
+    # includes jobs published by someone else (e.g. another coordinator), still need to wait for them
+    keys: list[str] = []
+    published = 0
+    with bleanser_tmp_directory() as base_tmp_dir:
+        for Normaliser in Normalisers:
+            (module, qualname) = _normaliser_ref(Normaliser)
+            for path in paths:
+                normaliser = Normaliser(original=path, base_tmp_dir=base_tmp_dir)
+                key = cache.normalised_key(normaliser)
+                if cache.contains('normalised', key):
+                    continue
+                if queue.publish(Job(key=key, module=module, qualname=qualname, path=path)):
+                    published += 1
+                keys.append(key)
+    logger.info('published %d jobs to %s (%d already in progress)', published, queue.root, len(keys) - published)
+
+    def is_done(key: str) -> bool:
+        return cache.contains('normalised', key) or queue.result(key) is not None
+
+    # same workers for all rounds, so they only start (and run worker_setup) once
+    with _make_pool(threads=threads, executor=executor, Normalisers=Normalisers) as pool:
+        while True:
+            _run_workers(pool, cache_dir, exit_when_empty=True)
+
+            remaining = [k for k in keys if not is_done(k)]
+            if len(remaining) == 0:
+                break
+            logger.info('waiting for %d jobs claimed by other workers', len(remaining))
+            sleep(_POLL_SECONDS)
+            queue.requeue_stale()
+
+    errors = 0
+    for key in keys:
+        res = queue.result(key)
+        if res is not None and res['error'] is not None:
+            # these will be normalised again while computing groups, and end up as error groups
+            errors += 1
+        elif cache.contains('normalised', key):
+            queue.forget(key)
+    queue.expire_done()
+    logger.info('all jobs are done (%d failed)', errors)
@@ -4,16 +4,21 @@ Helpers for processing sqlite databases
 
 from __future__ import annotations
 
+import heapq
 import re
 import shutil
 import sqlite3
 import subprocess
 from collections.abc import Iterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing, contextmanager
+from functools import cache
 from pathlib import Path
 from sqlite3 import Connection
-from typing import Literal
+from tempfile import TemporaryDirectory
+from typing import Literal, assert_never
 
+from ..common import logger
 from ..processor import (
     BaseNormaliser,
     Normalised,
@@ -23,6 +28,11 @@ from ..processor import (
 
 AllowedBlobs = frozenset[tuple[str, str]]
 
+type SqliteCheck = Literal['none', 'quick', 'full']
+"""
+How thoroughly databases are checked for corruption, see SqliteNormaliser.CHECK
+"""
+
 
 _SQLITE_HEX_BLOB_PREFIX = b"X'"
 _JSON_OBJECT_START_HEX = f'{ord("{"):02x}'.encode()
@@ -99,14 +109,21 @@ def _check_allowed_blobs(*, conn: Connection, allowed_blobs: AllowedBlobs) -> No
     schemas = tool.get_tables()
     bad_blobs = []
     for table, schema in schemas.items():
-        for col, type_ in schema.items():
-            if type_ != 'BLOB':
-                continue
-            key     = (table, col)  # fmt: skip
-            any_key = (table, '*')
-            if (key in allowed_blobs) or (any_key in allowed_blobs):
-                continue
-            actual_types: set[str] = {at for (at,) in conn.execute(f'SELECT DISTINCT typeof(`{col}`) FROM `{table}`')}
+        cols = [
+            col
+            for col, type_ in schema.items()
+            if type_ == 'BLOB' and (table, col) not in allowed_blobs and (table, '*') not in allowed_blobs
+        ]
+        if len(cols) == 0:
+            continue
+        # collect types for all columns in a single pass over the table, rather than scanning it for each column
+        # typeof() is one of null/integer/real/text/blob, so joining on comma is unambiguous
+        query = ', '.join(f'group_concat(DISTINCT typeof(`{col}`))' for col in cols)
+        [row] = list(conn.execute(f'SELECT {query} FROM `{table}`'))
+        for col, types in zip(cols, row, strict=True):
+            key = (table, col)
+            # group_concat returns NULL if there are no rows
+            actual_types: set[str] = set() if types is None else set(types.split(','))
             actual_types.discard('null')  # nulls are harmless, worst case dumped as empty string
 
             if actual_types == {'blob'}:
@@ -130,44 +147,371 @@ def _check_allowed_blobs(*, conn: Connection, allowed_blobs: AllowedBlobs) -> No
         )
 
 
+def _check_conn(
+    conn: Connection,
+    *,
+    check: Literal['integrity', 'quick'] | None,
+    allowed_blobs: AllowedBlobs | None,
+    custom_tokenizers: frozenset[str] = frozenset(),
+) -> None:
+    # note: .execute only does statement at a time?
+    # TODO what does schema_version do?
+    list(conn.execute('PRAGMA schema_version;'))
+    try:
+        check_results = [] if check is None else [r for (r,) in conn.execute(f'PRAGMA {check}_check;')]
+    except sqlite3.OperationalError as e:
+        unknown_tokenizer_errors = {f'unknown tokenizer: {tokenizer}' for tokenizer in custom_tokenizers}
+        if str(e) not in unknown_tokenizer_errors:
+            raise
+        # A custom tokenizer can make quick_check unusable before dumben removes virtual tables.
+        # The copied, dumbed-down database still receives a full integrity check below.
+        assert check == 'quick', check
+        check_results = []
+    # PRAGMA *_check returns one row per problem, or a single "ok" row. Ignore malformed FTS indexes: they are derived search data and dumben strips virtual tables anyway. Seen with PodcastAddict.
+    bad_results = [r for r in check_results if r != 'ok' and not r.startswith(_MALFORMED_FTS_CHECK_PREFIX)]
+    assert len(bad_results) == 0, '\n'.join(bad_results)
+    if allowed_blobs is not None:
+        _check_allowed_blobs(conn=conn, allowed_blobs=allowed_blobs)
+
+
 def _checked_db(
     db: Path,
     *,
-    check: Literal['integrity', 'quick'],
+    check: Literal['integrity', 'quick'] | None,
     allowed_blobs: AllowedBlobs | None,
     custom_tokenizers: frozenset[str] = frozenset(),
 ) -> Path:
     """
     check: 'integrity' can be quite slow, O(N log N) in number of rows, because it checks all indices and UNIQUE constraints.
            'quick' is O(N), and mostly achieves same result.
+           None skips it (blobs are still checked if allowed_blobs is passed).
     """
     db = _checked_no_wal(db)
     # NOTE: with immutable=1, SQLite can skip some checks; e.g. integrity_check can return ok even if a normal
     # connection reports CHECK constraint violations. Here this is mostly a cheap readonly sanity check.
     with closing(sqlite3.connect(f'file:{db}?immutable=1', uri=True)) as conn, conn:
-        # note: .execute only does statement at a time?
-        # TODO what does schema_version do?
-        list(conn.execute('PRAGMA schema_version;'))
-        try:
-            check_results = [r for (r,) in conn.execute(f'PRAGMA {check}_check;')]
-        except sqlite3.OperationalError as e:
-            unknown_tokenizer_errors = {f'unknown tokenizer: {tokenizer}' for tokenizer in custom_tokenizers}
-            if str(e) not in unknown_tokenizer_errors:
-                raise
-            # A custom tokenizer can make quick_check unusable before dumben removes virtual tables.
-            # The copied, dumbed-down database still receives a full integrity check below.
-            assert check == 'quick', check
-            check_results = []
-        # PRAGMA *_check returns one row per problem, or a single "ok" row. Ignore malformed FTS indexes: they are derived search data and dumben strips virtual tables anyway. Seen with PodcastAddict.
-        bad_results = [r for r in check_results if r != 'ok' and not r.startswith(_MALFORMED_FTS_CHECK_PREFIX)]
-        assert len(bad_results) == 0, '\n'.join(bad_results)
-        if allowed_blobs is not None:
-            _check_allowed_blobs(conn=conn, allowed_blobs=allowed_blobs)
+        _check_conn(conn, check=check, allowed_blobs=allowed_blobs, custom_tokenizers=custom_tokenizers)
 
     db = _checked_no_wal(db)
     return db
 
 
+# .dump wraps everything in these, regardless of which tables are dumped
+_DUMP_HEADER = b'PRAGMA foreign_keys=OFF;\nBEGIN TRANSACTION;\n'
+_DUMP_FOOTER = b'COMMIT;\n'
+
+
+def _dump(db: Path, *, dump_file: Path) -> Path:
+    # dumping also takes a bit of time for big databases...
+    with dump_file.open('wb') as fo:
+        subprocess.check_call(['sqlite3', '-readonly', f'file://{db}?immutable=1', '.dump'], stdout=fo)
+
+    ## one issue is that .dump dumps sometimes text columns as hex-encoded and prefixed with X
+    ## this makes sense if you're using .dump output to create another db
+    ## but in our case makes diffs very cryptic
+    dump_file_nohex = dump_file.parent / 'dump_nohex.sql'
+    # TODO hmm this might break if it's a legit binary BLOB?
+    # TODO maybe only do it in diff mode? not sure
+    dump_file = _postprocess_dump_hex(src=dump_file, dst=dump_file_nohex)
+    ##
+
+    # alternative way to dump database
+    # could be useful when you have multiline strings or jsons in TEXT/STRING fields
+    # in this case sqlite .dump prepends them with X and encodes
+    # however, this makes it much harder to spot differences
+    # if we ever use it this way, this should
+    # - pass a custom -newline to sqlite (e.g. \0)
+    # - replace \n in output with space or something
+    # - replace the -newline symbol with actual \n
+    # for table in master_info:
+    #     query_cmd = sqlite_cmd['-readonly', f'file://{cleaned_db}?immutable=1', f'SELECT "{table}", * FROM `{table}`']
+    #     cmd = query_cmd >> str(dump_file)
+    #     cmd()
+
+    # hmm seems necessary sometimes.. not sure why
+    sort_file(dump_file)
+    return dump_file
+
+
+def _dump_shards(db: Path) -> list[list[str]]:
+    """
+    Splits tables into shards, which can be dumped independently of each other via .dump LIKE patterns.
+
+    Returns LIKE patterns for each shard.
+    """
+    with closing(sqlite3.connect(f'file:{db}?immutable=1', uri=True)) as conn:
+        tables = [t for (t,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY name")]
+        # quotes and backslashes are awkward to pass to .dump, but _ will match them anyway
+        patterns = {t: re.sub(r'[\'"\\]', '_', t) for t in tables}
+
+        # pattern might match other tables as well (e.g. a_b also matches aXb)
+        # these need to end up in the same shard, otherwise they'd be dumped twice
+        shard_of = {t: t for t in tables}
+
+        def find(t: str) -> str:
+            while shard_of[t] != t:
+                t = shard_of[t]
+            return t
+
+        for t in tables:
+            for (m,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ? ESCAPE '\\'", (patterns[t],)
+            ):
+                shard_of[find(m)] = find(t)
+
+    shards: dict[str, list[str]] = {}
+    for t in tables:
+        shards.setdefault(find(t), []).append(patterns[t])
+    return list(shards.values())
+
+
+def _dump_parallel(db: Path, *, dump_file: Path, threads: int) -> None:
+    """
+    Same result as _dump, but tables are dumped concurrently.
+
+    Each shard of tables is dumped by a separate sqlite3 process, then the shards are concatenated and sorted.
+    Since the final dump is sorted, the order in which shards finish doesn't matter.
+    """
+    wdir = dump_file.parent / 'shards'
+    wdir.mkdir()
+
+    def dump_shard(idx: int, patterns: list[str]) -> Path:
+        shard = wdir / f'{idx}.sql'
+        args = ' '.join(f'"{p}"' for p in patterns)
+        cmd = ['sqlite3', '-readonly', f'file://{db}?immutable=1', f'.dump {args}']
+        # streaming, since shards of huge databases might not fit in memory
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc, shard.open('wb') as fo:
+            assert proc.stdout is not None
+            lines = iter(proc.stdout)
+            line = next(lines, b'')
+            if line.startswith(b'/* WARNING:'):
+                # sqlite3 emits it when given multiple patterns, but it's not there in the full .dump
+                while not line.endswith(b'*/\n'):
+                    line = next(lines)
+                line = next(lines, b'')
+            # otherwise they'd be repeated for each shard
+            header = line + next(lines, b'')
+            assert header == _DUMP_HEADER, (shard, header)
+            # lagging by one line, so the footer isn't written
+            prev = next(lines, b'')
+            for line in lines:
+                # hex postprocessing works line by line, so fine to do per shard
+                fo.write(_postprocess_dump_hex_line(prev))
+                prev = line
+            assert prev == _DUMP_FOOTER, (shard, prev)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        return shard
+
+    shards = _dump_shards(db)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        # these are mostly waiting for sqlite3 processes, so threads are enough
+        dumped = list(pool.map(dump_shard, range(len(shards)), shards))
+
+    with dump_file.open('wb') as fo:
+        fo.write(_DUMP_HEADER + _DUMP_FOOTER)
+        for shard in dumped:
+            with shard.open('rb') as fi:
+                shutil.copyfileobj(fi, fo)
+    shutil.rmtree(wdir)
+    # note: not using sort --merge on sorted shards, uutils sort 0.8.0 can corrupt long lines in --merge mode
+    sort_file(dump_file)
+
+
+# sqlite3 .dump formats values in C (see shell_callback/quoteChar in sqlite's shell.c)
+# _dump_canonical mirrors it in SQL, so it produces exactly the same lines as _dump, just without the extra passes.
+# This is checked against the installed sqlite3 on the first use, see _canonical_dump_matches_cli
+
+# table names which are keywords are quoted, https://www.sqlite.org/lang_keywords.html
+_SQLITE_KEYWORDS_LIST = """
+ABORT ACTION ADD AFTER ALL ALTER ALWAYS ANALYZE AND AS ASC ATTACH AUTOINCREMENT BEFORE BEGIN BETWEEN BY CASCADE CASE
+CAST CHECK COLLATE COLUMN COMMIT CONFLICT CONSTRAINT CREATE CROSS CURRENT CURRENT_DATE CURRENT_TIME CURRENT_TIMESTAMP
+DATABASE DEFAULT DEFERRABLE DEFERRED DELETE DESC DETACH DISTINCT DO DROP EACH ELSE END ESCAPE EXCEPT EXCLUDE EXCLUSIVE
+EXISTS EXPLAIN FAIL FILTER FIRST FOLLOWING FOR FOREIGN FROM FULL GENERATED GLOB GROUP GROUPS HAVING IF IGNORE
+IMMEDIATE IN INDEX INDEXED INITIALLY INNER INSERT INSTEAD INTERSECT INTO IS ISNULL JOIN KEY LAST LEFT LIKE LIMIT MATCH
+MATERIALIZED NATURAL NO NOT NOTHING NOTNULL NULL NULLS OF OFFSET ON OR ORDER OTHERS OUTER OVER PARTITION PLAN PRAGMA
+PRECEDING PRIMARY QUERY RAISE RANGE RECURSIVE REFERENCES REGEXP REINDEX RELEASE RENAME REPLACE RESTRICT RETURNING
+RIGHT ROLLBACK ROW ROWS SAVEPOINT SELECT SET TABLE TEMP TEMPORARY THEN TIES TO TRANSACTION TRIGGER UNBOUNDED UNION
+UNIQUE UPDATE USING VACUUM VALUES VIEW VIRTUAL WHEN WHERE WINDOW WITH WITHOUT
+"""
+_SQLITE_KEYWORDS = frozenset(_SQLITE_KEYWORDS_LIST.split())
+
+# compound SELECT can have at most 500 terms by default
+_CANONICAL_DUMP_TABLES_PER_QUERY = 200
+
+
+def _sql_string(s: str) -> str:
+    return "'" + s.replace("'", "''") + "'"
+
+
+def _sql_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _dump_table_name(name: str) -> str:
+    if re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', name) and name.upper() not in _SQLITE_KEYWORDS:
+        return name
+    return _sql_identifier(name)
+
+
+_UNISTR_ESCAPE_RE = re.compile(rb"[\\'\x01-\x1f]")
+
+
+def _dump_unistr(text: bytes) -> bytes:
+    """
+    Strings with control characters are dumped via unistr(), so backslashes need escaping as well.
+
+    Registered as an sql function in _dump_canonical: doing the same with nested replace() calls overflows the parser stack on older sqlite.
+    """
+
+    def escape(match: re.Match[bytes]) -> bytes:
+        c = match.group(0)
+        if c == b'\\':
+            return b'\\\\'
+        if c == b"'":
+            return b"''"
+        return b'\\u%04x' % ord(c)
+
+    return b"unistr('" + _UNISTR_ESCAPE_RE.sub(escape, text) + b"')"
+
+
+def _dump_text_sql(e: str) -> str:
+    plain = f"'''' || replace({e}, '''', '''''') || ''''"
+    return f"CASE WHEN {e} GLOB :control THEN bleanser_dump_unistr(CAST({e} AS BLOB)) ELSE {plain} END"
+
+
+def _dump_value_sql(column: str) -> str:
+    c = _sql_identifier(column)
+    # sqlite3 works with C strings, so text is cut off at the first NUL
+    nul = f"instr(CAST({c} AS BLOB), x'00')"
+    truncated = f'CAST(substr(CAST({c} AS BLOB), 1, {nul} - 1) AS TEXT)'
+    # same as _postprocess_dump_hex_bytes
+    newline = "'<NEWLINE>'"
+    newlines = f'replace(replace(replace(CAST({c} AS TEXT), char(13, 10), {newline}), char(13), {newline}), char(10), {newline})'
+    return f"""CASE typeof({c})
+    WHEN 'null' THEN 'NULL'
+    WHEN 'integer' THEN CAST({c} AS TEXT)
+    WHEN 'real' THEN CASE
+        WHEN {c} = 9e999 THEN '9.0e+999'
+        WHEN {c} = -9e999 THEN '-9.0e+999'
+        WHEN {c} = CAST({c} AS INTEGER) THEN CAST(CAST({c} AS INTEGER) AS TEXT) || '.0'
+        ELSE printf('%!.20g', {c})
+    END
+    WHEN 'blob' THEN CASE
+        WHEN length({c}) >= 2 AND substr({c}, 1, 1) = x'7b' AND substr({c}, -1, 1) = x'7d' THEN 'X''' || {newlines} || ''''
+        ELSE 'X''' || lower(hex({c})) || ''''
+    END
+    ELSE CASE WHEN {nul} > 0 THEN {_dump_text_sql(truncated)} ELSE {_dump_text_sql(c)} END
+END"""
+
+
+def _canonical_dump_tables(conn: Connection) -> dict[str, tuple[str, list[str]]] | None:
+    """
+    Returns CREATE statement and columns for each table, or None if there is anything _dump_canonical can't handle.
+    """
+    [(encoding,)] = conn.execute('PRAGMA encoding')
+    if encoding != 'UTF-8':
+        # otherwise sorting in sqlite would be different from sorting the utf-8 dump
+        return None
+    res: dict[str, tuple[str, list[str]]] = {}
+    for name, type_, sql in list(conn.execute('SELECT name, type, sql FROM sqlite_master')):
+        if type_ != 'table' or sql is None or name.startswith('sqlite_'):
+            return None
+        if sql.startswith('CREATE VIRTUAL TABLE') or '/*' in sql or '--' in sql:
+            # sqlite3 .dump handles these specially
+            return None
+        columns = [row[1] for row in conn.execute(f'PRAGMA table_info({_sql_identifier(name)})')]
+        res[name] = (sql, columns)
+    return res
+
+
+def _dump_canonical(conn: Connection, *, dump_file: Path) -> bool:
+    """
+    Same result as _dump, but rows are formatted and sorted by sqlite itself, and written straight into the dump file.
+
+    Returns False (without writing anything) if the database can't be dumped this way, then it's up to the caller to use _dump.
+    """
+    tables = _canonical_dump_tables(conn)
+    if tables is None:
+        return False
+
+    lines = [b'PRAGMA foreign_keys=OFF;', b'BEGIN TRANSACTION;', b'COMMIT;']
+    for sql, _ in tables.values():
+        if re.match(r'CREATE TABLE [\'"]', sql):
+            sql = 'CREATE TABLE IF NOT EXISTS ' + sql.removeprefix('CREATE TABLE ')
+        lines.extend(_postprocess_dump_hex_bytes(sql.encode() + b';').split(b'\n'))
+    lines.sort()
+
+    names = list(tables)
+    queries = []
+    for start in range(0, len(names), _CANONICAL_DUMP_TABLES_PER_QUERY):
+        terms = []
+        for name in names[start : start + _CANONICAL_DUMP_TABLES_PER_QUERY]:
+            (_, columns) = tables[name]
+            prefix = _sql_string(f'INSERT INTO {_dump_table_name(name)} VALUES(')
+            values = " || ',' || ".join(_dump_value_sql(c) for c in columns)
+            terms.append(f"SELECT {prefix} || {values} || ');' AS line FROM {_sql_identifier(name)}")
+        # BINARY collation is just memcmp, so it's the same order as sort with LC_ALL=C
+        queries.append('SELECT line FROM (' + ' UNION ALL '.join(terms) + ') ORDER BY line')
+
+    conn.create_function('bleanser_dump_unistr', 1, _dump_unistr, deterministic=True)
+    text_factory = conn.text_factory
+    # dumped lines aren't necessarily valid utf-8
+    conn.text_factory = bytes
+    try:
+        params = {'control': '*[\x01-\x1f]*'}
+        rows = [(line for (line,) in conn.execute(q, params)) for q in queries]
+        with dump_file.open('wb') as fo:
+            for line in heapq.merge(lines, *rows):
+                # JSON blobs are rewritten already, so it'd only match something inside a table name (quotes in text values are doubled)
+                # _dump would rewrite these as well (and sort afterwards), so leave it to _dump
+                if b"'7" in line and _JSON_HEX_BLOB_RE.search(line) is not None:
+                    break
+                fo.write(line + b'\n')
+            else:
+                return True
+    finally:
+        conn.text_factory = text_factory
+    dump_file.unlink()
+    return False
+
+
+@cache
+def _canonical_dump_matches_cli() -> bool:
+    """
+    sqlite3 .dump output changes between versions, so make sure _dump_canonical still produces exactly the same.
+    """
+    with TemporaryDirectory() as td:
+        tdir = Path(td)
+        db = tdir / 'probe.db'
+        with closing(sqlite3.connect(db)) as conn, conn:
+            conn.execute('CREATE TABLE `t` (`x`)')
+            conn.execute('CREATE TABLE "select" (x, y)')
+            values: list[object] = [
+                None, 0, -(2**63), 0.0, -0.0, 0.1, 1e20, -1e-300, 2.0**63, float('inf'), float('-inf'),
+                '', "it's", 'multi\nline\r\n', 'back\\slash\t', 'nul\x00after', 'unicode é ✓\x7f',
+                b'', b'\x00\xff', b'{"json": "blob",\r\n"x": 1}', b'{',
+            ]  # fmt: skip
+            conn.executemany('INSERT INTO `t` VALUES (?)', [(v,) for v in values])
+            conn.execute("INSERT INTO `t` VALUES (CAST(x'80ff41' AS TEXT))")
+            conn.execute('INSERT INTO "select" VALUES (\'a\', \'b\')')
+        canonical = tdir / 'canonical.sql'
+        try:
+            with closing(sqlite3.connect(f'file:{db}?immutable=1', uri=True)) as conn:
+                dumped = _dump_canonical(conn, dump_file=canonical)
+        except sqlite3.Error as e:
+            logger.warning("in-process dump doesn't work with this sqlite version (%s), using sqlite3 instead", e)
+            return False
+        assert dumped  # the probe database doesn't have anything unsupported
+        expected = _dump(db, dump_file=tdir / 'dump.sql')
+        matches = canonical.read_bytes() == expected.read_bytes()
+    if not matches:
+        logger.warning(
+            "in-process dump doesn't match 'sqlite3 .dump' (different sqlite version?), using sqlite3 instead"
+        )
+    return matches
+
+
 class SqliteNormaliser(BaseNormaliser):
     # FIXME need a test, i.e. with removing single row?
 
@@ -181,6 +525,42 @@ class SqliteNormaliser(BaseNormaliser):
     Dumben then removes virtual tables from a private copy, which still receives full integrity and BLOB checks.
     """
 
+    CHECK: SqliteCheck = 'full'
+    """
+    How thoroughly databases are checked for corruption (e.g. to avoid pruning a good file because it's identical to a corrupted one).
+
+    - full : quick_check on the original, integrity_check on the cleaned up copy
+    - quick: quick_check on both, which is O(N) in number of rows rather than O(N log N)
+    - none : no corruption checks, for huge databases where even quick_check takes minutes
+
+    BLOB columns are checked regardless (see _check_allowed_blobs), since that's about producing a faithful dump, not about corruption.
+    """
+
+    IN_MEMORY_MAX_BYTES: int = 128 * 1024 * 1024
+    """
+    Databases up to that size are dumbed down and cleaned up in memory, rather than in a copy on disk.
+
+    The cleaned up database is only written to disk once, for sqlite3 .dump, instead of copying the original and rewriting it on VACUUM.
+    Peak memory use is about twice the database size (per worker), so bigger databases are still processed on disk. Set to 0 to always use disk.
+    """
+
+    DUMP_THREADS: int = 1
+    """
+    Number of threads used to dump the cleaned database to text.
+
+    sqlite3 .dump is single threaded, so for huge databases (e.g. browser history) dumping a single file might be the bottleneck.
+    With more threads, tables are dumped concurrently by separate sqlite3 processes, and merged into exactly the same dump.
+    """
+
+    INPROCESS_DUMP: bool = True
+    """
+    Dump the cleaned database without sqlite3 .dump: rows are formatted the same way and sorted by sqlite itself, see _dump_canonical.
+
+    The dump is exactly the same, but it's written in one go, rather than dumped, postprocessed and sorted in separate passes over the file.
+    For databases processed in memory (see IN_MEMORY_MAX_BYTES), the cleaned database isn't written to disk at all then.
+    sqlite3 .dump is still used with DUMP_THREADS > 1, or if it formats things differently (e.g. another sqlite version).
+    """
+
     # TODO in principle we can get away with using only 'extract'?
     # 'cleanup' is just a sanity check? so you don't cleanup too much by accident?
     # guess it makes it easier to specify only one of them?
@@ -206,9 +586,19 @@ class SqliteNormaliser(BaseNormaliser):
         # first, do not check for blobs -- we might not even be able to get the table list in python due to virtual tables
         # NOTE: quick check (instead of integrity) is fine here -- we're going to drop all indices during dumben step anyway,
         #   and it does introduce substantial speedup for bigger databases (e.g. browser history).
+        check: Literal['integrity', 'quick'] | None
+        if self.CHECK == 'full':
+            check = 'integrity'
+        elif self.CHECK == 'quick':
+            check = 'quick'
+        elif self.CHECK == 'none':
+            check = None
+        else:
+            assert_never(self.CHECK)
+
         upath = _checked_db(
             upath,
-            check='quick',
+            check=None if check is None else 'quick',
             allowed_blobs=None,
             custom_tokenizers=self.CUSTOM_TOKENIZERS,
         )
@@ -219,76 +609,88 @@ class SqliteNormaliser(BaseNormaliser):
         cleaned_db = unique_file_in_tempdir(input_filepath=upath, dir=self.tmp_dir, suffix='.db')
         unique_tmp_dir = cleaned_db.parent
 
+        from bleanser.core.ext.sqlite_dumben import dumben_cache_enabled, dumben_in_memory
         from bleanser.core.ext.sqlite_dumben import run as dumben
 
-        dumben(db=upath, output=cleaned_db, output_as_db=True)
-
-        # eh.. not sure if really necessary
-        # but we don't wanna check for blobs yet, better to do this after the cleanup
-        cleaned_db = _checked_db(cleaned_db, check='integrity', allowed_blobs=None)
-
-        # ugh. in principle could use :memory: database here...
-        # but then dumping it via iterdump() takes much more time then sqlite3 .dump command..
-        with closing(sqlite3.connect(cleaned_db)) as conn, conn:
+        # dumben cache entries are files anyway, so no point loading them into memory
+        in_memory = upath.stat().st_size <= self.IN_MEMORY_MAX_BYTES and not dumben_cache_enabled()
+
+        # this also checks the dumbed down copy, so no need to do it again here
+        # we don't wanna check for blobs yet, better to do this after the cleanup
+        conn: Connection
+        if in_memory:
+            conn = dumben_in_memory(upath, check=check)
+        else:
+            dumben(db=upath, output=cleaned_db, output_as_db=True, check=check)
+            cleaned_db = _checked_no_wal(cleaned_db)
+            conn = sqlite3.connect(cleaned_db)
             # prevent it from generating unnecessary wal files
             conn.execute('PRAGMA journal_mode=MEMORY;')
 
-            # extra paranoid checks...
-            # TODO maybe also get create statements from sqlite_master and assert no constraints etc
-            # and double check it by passing something without dumbing down
-            tool = Tool(conn)
-            master_info = tool.get_sqlite_master()
-            assert all(x == 'table' for x in master_info.values()), master_info
-            # TODO how to check there are no more triggers etc for real? do we need to commit or smth?
-
-            # cleanup might take a bit of time, especially with UPDATE statements
-            # but probably unavoidable?
-            self.cleanup(conn)
+        ### dump to text file
+        ## prepare a fake path for dump, just to preserve original file paths at least to some extent
+        dump_file = unique_tmp_dir / 'dump.sql'
+        dumped = False
+
+        with closing(conn):
+            with conn:
+                # extra paranoid checks...
+                # TODO maybe also get create statements from sqlite_master and assert no constraints etc
+                # and double check it by passing something without dumbing down
+                tool = Tool(conn)
+                master_info = tool.get_sqlite_master()
+                assert all(x == 'table' for x in master_info.values()), master_info
+                # TODO how to check there are no more triggers etc for real? do we need to commit or smth?
+
+                # cleanup might take a bit of time, especially with UPDATE statements
+                # but probably unavoidable?
+                self.cleanup(conn)
+
+            if in_memory:
+                _check_conn(conn, check=check, allowed_blobs=self.ALLOWED_BLOBS)
+                dumped = self._dump_inprocess(conn, dump_file=dump_file)
+                if not dumped:
+                    # sqlite3 .dump needs it on disk (and dumping via iterdump() takes much more time)
+                    # still, that's the only time it's written, rather than copying the original and rewriting it on VACUUM
+                    with closing(sqlite3.connect(cleaned_db)) as dst:
+                        conn.backup(dst)
         # FIXME ugh annoying -- conn/tool can hold a reference to connection, so despite closing might hold the reference to the file (even though it's unlinked)
         # this can result in running out of file descriptors
         # really need to cover the whole things with tests more and then refactor...
         del tool
         del conn
 
-        cleaned_db = _checked_db(cleaned_db, check='integrity', allowed_blobs=self.ALLOWED_BLOBS)
-
-        ### dump to text file
-        ## prepare a fake path for dump, just to preserve original file paths at least to some extent
-        dump_file = unique_tmp_dir / 'dump.sql'
-
-        # dumping also takes a bit of time for big databases...
-        with dump_file.open('wb') as fo:
-            subprocess.check_call(['sqlite3', '-readonly', f'file://{cleaned_db}?immutable=1', '.dump'], stdout=fo)
-
-        ## one issue is that .dump dumps sometimes text columns as hex-encoded and prefixed with X
-        ## this makes sense if you're using .dump output to create another db
-        ## but in our case makes diffs very cryptic
-        dump_file_nohex = unique_tmp_dir / 'dump_nohex.sql'
-        # TODO hmm this might break if it's a legit binary BLOB?
-        # TODO maybe only do it in diff mode? not sure
-        dump_file = _postprocess_dump_hex(src=dump_file, dst=dump_file_nohex)
-        ##
-
-        # alternative way to dump database
-        # could be useful when you have multiline strings or jsons in TEXT/STRING fields
-        # in this case sqlite .dump prepends them with X and encodes
-        # however, this makes it much harder to spot differences
-        # if we ever use it this way, this should
-        # - pass a custom -newline to sqlite (e.g. \0)
-        # - replace \n in output with space or something
-        # - replace the -newline symbol with actual \n
-        # for table in master_info:
-        #     query_cmd = sqlite_cmd['-readonly', f'file://{cleaned_db}?immutable=1', f'SELECT "{table}", * FROM `{table}`']
-        #     cmd = query_cmd >> str(dump_file)
-        #     cmd()
-
-        # hmm seems necessary sometimes.. not sure why
-        sort_file(dump_file)
-
-        cleaned_db.unlink()
+        if not dumped:
+            if in_memory:
+                # already checked above
+                cleaned_db = _checked_no_wal(cleaned_db)
+            else:
+                cleaned_db = _checked_db(cleaned_db, check=check, allowed_blobs=self.ALLOWED_BLOBS)
+                with closing(sqlite3.connect(f'file:{cleaned_db}?immutable=1', uri=True)) as conn:
+                    dumped = self._dump_inprocess(conn, dump_file=dump_file)
+
+            if not dumped:
+                if self.DUMP_THREADS > 1:
+                    _dump_parallel(cleaned_db, dump_file=dump_file, threads=self.DUMP_THREADS)
+                else:
+                    dump_file = _dump(cleaned_db, dump_file=dump_file)
+
+            cleaned_db.unlink()
         ###
         yield dump_file
 
+    def _dump_inprocess(self, conn: Connection, *, dump_file: Path) -> bool:
+        if not self.INPROCESS_DUMP or self.DUMP_THREADS > 1:
+            return False
+        if not _canonical_dump_matches_cli():
+            return False
+        try:
+            return _dump_canonical(conn, dump_file=dump_file)
+        except sqlite3.Error as e:
+            logger.warning('%s: in-process dump failed (%s), using sqlite3 instead', self.original, e)
+            dump_file.unlink(missing_ok=True)
+            return False
+
     def cleanup(self, c: Connection) -> None:
         pass
 
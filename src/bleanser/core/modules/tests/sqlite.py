@@ -1,14 +1,27 @@
 from __future__ import annotations
 
 import sqlite3
+from contextlib import closing
 from pathlib import Path
 from typing import Any
 
 import pytest
 
 from ...common import Keep, Prune
-from ...processor import compute_groups, compute_instructions, groups_to_instructions
-from ..sqlite import SqliteNormaliser, _checked_db, _postprocess_dump_hex, _postprocess_dump_hex_line
+from ...ext import sqlite_dumben
+from ...processor import bleanser_tmp_directory, compute_groups, compute_instructions, groups_to_instructions
+from .. import sqlite as sqlite_module
+from ..sqlite import (
+    SqliteCheck,
+    SqliteNormaliser,
+    _canonical_dump_matches_cli,
+    _check_allowed_blobs,
+    _checked_db,
+    _dump,
+    _dump_canonical,
+    _postprocess_dump_hex,
+    _postprocess_dump_hex_line,
+)
 
 
 def _dict2db(d: dict, *, to: Path) -> Path:
@@ -254,6 +267,221 @@ def test_sqlite_many(*, tmp_path: Path, multiway: bool) -> None:
     )
 
 
+def test_sqlite_parallel_dump(tmp_path: Path) -> None:
+    db = tmp_path / 'db.sqlite'
+    with sqlite3.connect(db) as conn:
+        # a_b is also a LIKE pattern matching aXb, make sure they aren't dumped twice
+        for table in ['a_b', 'aXb', 'axb_2', 'other', 'empty']:
+            conn.execute(f'CREATE TABLE `{table}` (x, y)')
+            if table == 'empty':
+                continue
+            conn.executemany(
+                f'INSERT INTO `{table}` VALUES (?, ?)',
+                [
+                    (1, 'text'),
+                    (1, 'text'),  # duplicate rows should stay
+                    (2.5, 'multi\nline'),
+                    (None, b'{"json": "blob"}'),
+                    (table, b'\x00\xff'),
+                    (3, b'{"long": "' + b'x' * 100_000 + b'"}'),
+                ],
+            )
+    conn.close()
+
+    def dump(threads: int) -> bytes:
+        class TestNormaliser(SqliteNormaliser):
+            DUMP_THREADS = threads
+
+        with bleanser_tmp_directory() as base_tmp_dir:
+            normaliser = TestNormaliser(original=db, base_tmp_dir=base_tmp_dir)
+            with normaliser.do_normalise() as normalised:
+                return normalised.read_bytes()
+
+    serial = dump(threads=1)
+    assert b'INSERT INTO a_b VALUES(1,\'text\');\nINSERT INTO a_b VALUES(1,\'text\');\n' in serial  # just in case
+    assert dump(threads=4) == serial
+
+
+@pytest.mark.parametrize('tables_per_query', [200, 2])
+def test_sqlite_canonical_dump(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, tables_per_query: int) -> None:
+    if not _canonical_dump_matches_cli():
+        pytest.skip('installed sqlite3 formats dumps differently')
+    # with fewer tables per query, it needs to merge the queries as well
+    monkeypatch.setattr(sqlite_module, '_CANONICAL_DUMP_TABLES_PER_QUERY', tables_per_query)
+
+    db = tmp_path / 'db.sqlite'
+    values: list[Any] = [
+        None, 1, -(2**63), 2**63 - 1, 0.0, -0.0, 1.5, 0.1, 1 / 3, 1e20, 1e300, -1e-300, 2.0**63, float('inf'), float('-inf'),
+        '', 'plain', "it's", 'multi\nline', 'cr\r\nlf', 'tab\t', 'back\\slash\x01', 'nul\x00after', '\x00', 'del\x7f', 'unicode é ✓',
+        b'', b'\x00\xff', b'{}', b'{"json": 1}', b'{"json":\r\n"multiline"}', b'{', b'}{',
+    ]  # fmt: skip
+    with sqlite3.connect(db) as conn:
+        for table in ['t', 'a_b', 'aXb', 'a b', 'select', 'Order', 'quote"d', 'é', 'empty']:
+            qtable = table.replace('"', '""')
+            conn.execute(f'CREATE TABLE "{qtable}" (x, y TEXT, z BLOB)')
+            if table == 'empty':
+                continue
+            conn.executemany(f'INSERT INTO "{qtable}" VALUES (?, ?, ?)', [(v, v, v) for v in values])
+            conn.execute(f'INSERT INTO "{qtable}" VALUES (1, 2, 3)')  # duplicate rows should stay
+            conn.execute(f'INSERT INTO "{qtable}" VALUES (1, 2, 3)')
+        conn.execute("CREATE TABLE `multiline`\n(x)")
+        conn.execute("INSERT INTO `multiline` VALUES (CAST(x'80ff41' AS TEXT))")  # not valid utf-8
+    conn.close()
+
+    expected = _dump(db, dump_file=tmp_path / 'dump.sql').read_bytes()
+    canonical = tmp_path / 'canonical.sql'
+    with closing(sqlite3.connect(f'file:{db}?immutable=1', uri=True)) as conn:
+        assert _dump_canonical(conn, dump_file=canonical)
+    assert canonical.read_bytes() == expected
+
+
+def test_sqlite_canonical_dump_unsupported(tmp_path: Path) -> None:
+    db = _dict2db({'t': [['x'], [1]]}, to=tmp_path / 'db.sqlite')
+    with sqlite3.connect(db) as conn:
+        conn.execute('CREATE VIEW v AS SELECT * FROM t')
+    conn.close()
+
+    dump_file = tmp_path / 'dump.sql'
+    with closing(sqlite3.connect(db)) as conn:
+        assert not _dump_canonical(conn, dump_file=dump_file)
+    assert not dump_file.exists()
+
+    # post-processing sqlite3 .dump output would rewrite it (and sort afterwards)
+    db = _dict2db({"X'7b7d'": [['x'], [1]]}, to=tmp_path / 'name.sqlite')
+    with closing(sqlite3.connect(db)) as conn:
+        assert not _dump_canonical(conn, dump_file=dump_file)
+    assert not dump_file.exists()
+
+
+def test_sqlite_canonical_dump_fallback(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    db = _dict2db({'t': [['x', 'y'], [1, 'text'], [2, b'{"a": 1}']]}, to=tmp_path / 'db.sqlite')
+
+    def dump(Normaliser: type[SqliteNormaliser]) -> bytes:
+        with bleanser_tmp_directory() as base_tmp_dir:
+            normaliser = Normaliser(original=db, base_tmp_dir=base_tmp_dir)
+            with normaliser.do_normalise() as normalised:
+                return normalised.read_bytes()
+
+    class CliNormaliser(SqliteNormaliser):
+        INPROCESS_DUMP = False
+
+    expected = dump(CliNormaliser)
+
+    def failing_dump_canonical(_conn: sqlite3.Connection, *, dump_file: Path) -> bool:
+        dump_file.write_bytes(b'partial')
+        raise sqlite3.OperationalError('parser stack overflow')
+
+    monkeypatch.setattr(sqlite_module, '_dump_canonical', failing_dump_canonical)
+    monkeypatch.setattr(sqlite_module, '_canonical_dump_matches_cli', lambda: True)
+
+    assert dump(SqliteNormaliser) == expected
+
+    # the probe shouldn't crash either
+    _canonical_dump_matches_cli.cache_clear()
+    try:
+        assert not _canonical_dump_matches_cli()
+    finally:
+        _canonical_dump_matches_cli.cache_clear()
+
+
+def test_sqlite_in_memory(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    db = tmp_path / 'db.sqlite'
+    with sqlite3.connect(db) as conn:
+        conn.executescript('''
+CREATE TABLE requests (id INTEGER PRIMARY KEY);
+CREATE TABLE log (id INTEGER PRIMARY KEY AUTOINCREMENT, request_id INTEGER NOT NULL, note TEXT);
+CREATE INDEX log_by_request ON log(request_id);
+CREATE TRIGGER requests_ad AFTER DELETE ON requests BEGIN DELETE FROM log WHERE request_id = OLD.id; END;
+INSERT INTO requests VALUES (1), (2);
+INSERT INTO log VALUES (1, 1, 'first'), (2, 2, 'second');
+''')
+    conn.close()
+
+    in_memory_calls = 0
+    dumben_in_memory = sqlite_dumben.dumben_in_memory
+
+    def counting_dumben_in_memory(*args, **kwargs) -> sqlite3.Connection:
+        nonlocal in_memory_calls
+        in_memory_calls += 1
+        return dumben_in_memory(*args, **kwargs)
+
+    monkeypatch.setattr(sqlite_dumben, 'dumben_in_memory', counting_dumben_in_memory)
+
+    def dump(max_bytes: int) -> str:
+        class TestNormaliser(SqliteNormaliser):
+            IN_MEMORY_MAX_BYTES = max_bytes
+
+            def cleanup(self, c: sqlite3.Connection) -> None:
+                # would delete from log as well if the trigger was still there
+                c.execute('DELETE FROM requests WHERE id = 2')
+
+        with bleanser_tmp_directory() as base_tmp_dir:
+            normaliser = TestNormaliser(original=db, base_tmp_dir=base_tmp_dir)
+            with normaliser.do_normalise() as normalised:
+                return normalised.read_text()
+
+    on_disk = dump(max_bytes=0)
+    assert in_memory_calls == 0
+    assert "INSERT INTO log VALUES(2,2,'second');" in on_disk
+    assert 'INSERT INTO requests VALUES(2);' not in on_disk
+
+    assert dump(max_bytes=db.stat().st_size) == on_disk
+    assert in_memory_calls == 1
+
+
+@pytest.mark.parametrize(
+    ('check', 'expected'),
+    [
+        ('full', ['quick_check', 'integrity_check', 'integrity_check']),
+        ('quick', ['quick_check', 'quick_check', 'quick_check']),
+        ('none', []),
+    ],
+)
+def test_sqlite_check_levels(
+    *, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, check: SqliteCheck, expected: list[str]
+) -> None:
+    db = _dict2db({'t': [['x', 'y'], [1, b'\x00'], [2, 'text']]}, to=tmp_path / 'db.sqlite')
+
+    statements: list[str] = []
+    connect = sqlite3.connect
+
+    def traced_connect(*args, **kwargs) -> sqlite3.Connection:
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    monkeypatch.setattr(sqlite3, 'connect', traced_connect)
+
+    class TestNormaliser(SqliteNormaliser):
+        CHECK = check
+
+    with bleanser_tmp_directory() as base_tmp_dir:
+        normaliser = TestNormaliser(original=db, base_tmp_dir=base_tmp_dir)
+        with normaliser.do_normalise() as normalised:
+            dump = normalised.read_text()
+    assert "INSERT INTO t VALUES(2,'text');" in dump
+
+    checks = [st.removeprefix('PRAGMA ').rstrip(';') for st in statements if st.endswith('_check;')]
+    assert checks == expected
+
+
+def test_sqlite_blobs_multiple_columns(tmp_path: Path) -> None:
+    with sqlite3.connect(tmp_path / 'db.sqlite') as conn:
+        conn.execute('CREATE TABLE `t` (good BLOB, bad BLOB, nulls BLOB, txt TEXT)')
+        conn.execute('INSERT INTO `t` VALUES (?, ?, ?, ?)', (b'\x00', b'\x01', None, 'text'))
+        conn.execute('INSERT INTO `t` VALUES (?, ?, ?, ?)', (b'\x02', 'text', None, 'text'))
+        conn.execute('CREATE TABLE `empty` (b BLOB)')
+
+        with pytest.raises(RuntimeError) as e:
+            _check_allowed_blobs(conn=conn, allowed_blobs=frozenset())
+        [err] = str(e.value).splitlines()
+        assert err.startswith("('t', 'bad') : has type BLOB")
+
+        _check_allowed_blobs(conn=conn, allowed_blobs=frozenset({('t', 'bad')}))
+        _check_allowed_blobs(conn=conn, allowed_blobs=frozenset({('t', '*')}))
+    conn.close()
+
+
 # TODO add some tests for my own dbs? e.g. stashed
 
 
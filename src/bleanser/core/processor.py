@@ -1,14 +1,17 @@
 from __future__ import annotations
 
 import inspect
+import mmap
 import os
 import shutil
 import subprocess
 import sys
+import threading
 import warnings
-from collections.abc import Callable, Iterable, Iterator, Sequence
-from concurrent.futures import Future, ProcessPoolExecutor
-from contextlib import AbstractContextManager, ExitStack, contextmanager
+from collections.abc import Callable, Collection, Generator, Iterable, Iterator, Sequence
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import AbstractContextManager, ExitStack, contextmanager, nullcontext
+from dataclasses import dataclass
 from functools import cache
 from pathlib import Path
 from tempfile import NamedTemporaryFile, TemporaryDirectory, gettempdir
@@ -17,6 +20,7 @@ from typing import (
     TYPE_CHECKING,
     Any,
     ClassVar,
+    Literal,
     NoReturn,
     Self,
     assert_never,
@@ -27,6 +31,7 @@ import click
 import more_itertools
 from kompress import CPath, is_compressed
 
+from .cache import Cache, Relation, Verdicts, link_or_copy
 from .common import (
     Dry,
     Group,
@@ -40,12 +45,19 @@ from .common import (
     logger,
 )
 from .ext.dummy_executor import DummyExecutor
+from .subprocesses import Subprocesses
 
+if TYPE_CHECKING:
+    from .hashset import HashFileSet
 
-def run_sort(*args: str | Path) -> None:
+
+def _sort_env() -> dict[str, str]:
     # Use bytewise collation for internal canonicalisation sorts; locale-aware sort can be much slower and may vary across environments, and bleanser compares exact dump lines rather than human-collated text.
-    env = {**os.environ, 'LC_ALL': 'C'}
-    subprocess.run(['sort', *(str(a) for a in args)], env=env, check=True)
+    return {**os.environ, 'LC_ALL': 'C'}
+
+
+def run_sort(*args: str | Path) -> None:
+    subprocess.run(['sort', *(str(a) for a in args)], env=_sort_env(), check=True)
 
 
 @contextmanager
@@ -93,6 +105,80 @@ def sort_file(filepath: str | Path) -> None:
 Input = Path
 Normalised = Path
 
+type Engine = Literal['exact', 'hash']
+"""
+How sets of normalised files are represented and compared:
+- exact: sorted runs of lines, compared via merge walk, see FileSet
+- hash : sorted arrays of 64-bit line hashes, compared in-process (needs numpy), see hashset.py
+"""
+
+type Parallel = Literal['pipeline', 'chunks']
+"""
+How work is split between processes when using threads:
+- pipeline: workers normalise files ahead of time, while files are compared in order in the main process.
+            Results are the same as for a serial run.
+- chunks  : inputs are split into contiguous chunks processed independently.
+            Comparisons are parallel too. Groups at chunk boundaries are recomputed afterwards, so results are the same as for a serial run.
+"""
+
+type PoolKind = Literal['thread', 'process']
+"""
+What runs the workers when using threads:
+- process: separate processes, the only way to run python code in parallel when the GIL is enabled.
+- thread : threads in the main process, so no pickling and no importing heavy modules in each worker.
+           Enough when normalisers mostly wait on subprocesses (sort, sqlite3) or sqlite itself, since these release the GIL.
+By default threads are only used on free-threaded python builds.
+"""
+
+
+def _gil_enabled() -> bool:
+    # only present since python 3.13
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', None)
+    return True if is_gil_enabled is None else is_gil_enabled()
+
+
+# normalisers which already ran worker_setup in the current process
+_worker_setup_done: set[type[BaseNormaliser]] = set()
+_worker_setup_lock = threading.Lock()
+
+
+def _worker_setup(Normalisers: Sequence[type[BaseNormaliser]]) -> None:
+    """
+    Runs BaseNormaliser.worker_setup, at most once per process.
+    """
+    with _worker_setup_lock:
+        for Normaliser in Normalisers:
+            if Normaliser in _worker_setup_done:
+                continue
+            Normaliser.worker_setup()
+            _worker_setup_done.add(Normaliser)
+
+
+def _make_pool(
+    *,
+    threads: int | None,
+    executor: PoolKind | None,
+    Normalisers: Sequence[type[BaseNormaliser]] = (),
+) -> Executor:
+    """
+    Normalisers: ones which are going to run in the pool, so they are set up in each worker once it starts
+    """
+    if threads is None:
+        _worker_setup(Normalisers)
+        return DummyExecutor()
+    if executor is None:
+        executor = 'process' if _gil_enabled() else 'thread'
+    if executor == 'thread':
+        # all threads share the current process, so enough to set up once
+        _worker_setup(Normalisers)
+        # ThreadPoolExecutor defaults to more workers than cpus, which is meant for io bound work
+        return ThreadPoolExecutor(max_workers=os.cpu_count() if threads == 0 else threads)
+    return ProcessPoolExecutor(
+        max_workers=None if threads == 0 else threads,
+        initializer=_worker_setup,
+        initargs=(Normalisers,),
+    )
+
 
 class BaseNormaliser:
     ## user overridable configs
@@ -139,6 +225,15 @@ class BaseNormaliser:
         assert not rpath.is_absolute()  # just in case
         return rpath
 
+    @classmethod
+    def worker_setup(cls) -> None:
+        '''
+        Runs once in each worker process (or once in the current process when using threads), before it normalises anything.
+
+        subclasses could override this for expensive one-off setup, e.g. importing heavy modules or warming up some caches,
+        so it happens when the workers start rather than while normalising the first file
+        '''
+
     @contextmanager
     def normalise(self, *, path: Path) -> Iterator[Normalised]:
         '''
@@ -156,30 +251,40 @@ class BaseNormaliser:
         # for an example, see modules/json.py
 
     @contextmanager
-    def do_normalise(self) -> Iterator[Normalised]:
-        """
-        This method does set up for normalise method, and generally shouldn't require overriding
-        """
+    def _with_tmp_dir(self) -> Iterator[Path]:
+        # tmp_dir is unique per original file, so concurrent workers (threads or processes) never step on each other
+        # parents are shared, but mkdir tolerates them being created concurrently
         self.tmp_dir.mkdir(parents=True)
         try:
-            # FIXME write a test for compressed stuff
-            with self.unpacked(path=self.original, wdir=self.tmp_dir) as unpacked:
-                ## backwards compatibility -- do_cleanup used to take input path and tmp dir
-                do_cleanup = getattr(self, 'do_cleanup', None)
-                if do_cleanup is None:
-                    with self.normalise(path=unpacked) as normalised:
-                        yield normalised
-                else:
-                    warnings.warn(
-                        "'do_cleanup' is deprecated. Remove wdir argument and rename it to 'normalise'", stacklevel=2
-                    )
-                    with do_cleanup(path=unpacked, wdir=self.tmp_dir) as normalised:
-                        yield normalised
+            yield self.tmp_dir
         finally:
             # ugh, kinda annoying that TemporaryDirectory doesn't allow creating a dir with exact name
             # so here we at least reuse its cleanup method
             TemporaryDirectory._rmtree(str(self.tmp_dir))  # type: ignore[attr-defined]  # ty: ignore[unresolved-attribute]
 
+    @contextmanager
+    def do_normalise(self, *, unpacked: Path | None = None) -> Iterator[Normalised]:
+        """
+        This method does set up for normalise method, and generally shouldn't require overriding
+
+        unpacked: already unpacked original (e.g. shared with other normalisers), otherwise it's unpacked here
+        """
+        with self._with_tmp_dir(), ExitStack() as stack:
+            if unpacked is None:
+                # FIXME write a test for compressed stuff
+                unpacked = stack.enter_context(self.unpacked(path=self.original, wdir=self.tmp_dir))
+            ## backwards compatibility -- do_cleanup used to take input path and tmp dir
+            do_cleanup = getattr(self, 'do_cleanup', None)
+            if do_cleanup is None:
+                with self.normalise(path=unpacked) as normalised:
+                    yield normalised
+            else:
+                warnings.warn(
+                    "'do_cleanup' is deprecated. Remove wdir argument and rename it to 'normalise'", stacklevel=2
+                )
+                with do_cleanup(path=unpacked, wdir=self.tmp_dir) as normalised:
+                    yield normalised
+
     if TYPE_CHECKING:
         # deliberately keep this during type checking to indicate users need to migrate to normalise()
         def do_cleanup(self) -> None: ...
@@ -226,52 +331,529 @@ class BaseNormaliser:
         run_main(Normaliser=cls)
 
 
+@contextmanager
+def _do_normalise_cached(
+    normaliser: BaseNormaliser,
+    *,
+    cache: Cache | None,
+    unpack: Callable[[], Path] | None = None,
+) -> Iterator[Normalised]:
+    """
+    unpack: provides the unpacked original, if it's shared with other normalisers.
+            Only called on cache miss, so cached inputs don't need to be unpacked at all.
+    """
+    if cache is None:
+        with normaliser.do_normalise(unpacked=None if unpack is None else unpack()) as normalised:
+            yield normalised
+        return
+
+    key = cache.normalised_key(normaliser)
+    with normaliser._with_tmp_dir() as tmp_dir:
+        # link into tmp dir, so the rest of the code can treat it as any other normalised file (e.g. unlink it)
+        normalised = unique_file_in_tempdir(input_filepath=normaliser.original, dir=tmp_dir)
+        if cache.fetch('normalised', key, normalised):
+            logger.debug('%s: using cached normalised file', normaliser.original)
+            cache.verdicts.ids[normalised] = key
+            yield normalised
+            return
+
+    with normaliser.do_normalise(unpacked=None if unpack is None else unpack()) as normalised:
+        if normalised != normaliser.original:
+            # 'identity' normalisers don't do any work, so no point caching
+            cache.put('normalised', key, normalised)
+            cache.verdicts.ids[normalised] = key
+        else:
+            cache.verdicts.ids[normalised] = 'file:' + cache.digests.digest(normalised)
+        yield normalised
+
+
+@dataclass
+class _WorkerResult:
+    normalised: Normalised
+    content_id: str | None  # see Verdicts
+    worker: int  # native thread id, unique across processes too
+    took: float  # seconds
+
+
+class _SharedInput(AbstractContextManager):
+    """
+    Original file unpacked at most once, and shared between multiple normalisers.
+
+    Normalisers never modify their input (otherwise they'd modify user files when it's not compressed), so that's safe.
+    """
+
+    def __init__(self, original: Path, *, wdir: Path) -> None:
+        self.original = original
+        self.wdir = wdir
+        self.unpacked: Path | None = None
+        self._stack = ExitStack()
+
+    def get(self, normaliser: BaseNormaliser) -> Path:
+        if self.unpacked is None:
+            self.wdir.mkdir(parents=True, exist_ok=True)
+            self.unpacked = self._stack.enter_context(normaliser.unpacked(path=self.original, wdir=self.wdir))
+        return self.unpacked
+
+    @override
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._stack.close()
+
+
+def _normalise_in_worker(
+    *,
+    Normaliser: type[BaseNormaliser],
+    path: Path,
+    base_tmp_dir: Path,
+    cache_dir: Path | None,
+    out_dir: Path,
+    shared: _SharedInput | None = None,
+) -> _WorkerResult:
+    """
+    Runs in pool workers in 'pipeline' mode.
+
+    The normalised file is moved out of the normaliser's temporary directory, so it outlives the normaliser.
+    """
+    before = time()
+    cache = None if cache_dir is None else Cache(cache_dir)
+    normaliser = Normaliser(original=path, base_tmp_dir=base_tmp_dir)
+    unpack = None if shared is None else (lambda: shared.get(normaliser))
+    with _do_normalise_cached(normaliser, cache=cache, unpack=unpack) as normalised:
+        content_id = None if cache is None else cache.verdicts.ids.get(normalised)
+        if normalised == path:
+            # 'identity' cleanup -- shouldn't move user files
+            detached = normalised
+        else:
+            # separate dir for each normaliser, in case there are multiple ones for the same input
+            detached = unique_file_in_tempdir(input_filepath=path, dir=out_dir / Normaliser._relative_base_tmp_dir())
+            if shared is not None and normalised == shared.unpacked:
+                # 'identity' cleanup of a compressed file, other normalisers might still need it
+                link_or_copy(normalised, detached)
+            else:
+                # same filesystem, so just a rename
+                shutil.move(normalised, detached)
+    return _WorkerResult(
+        normalised=detached, content_id=content_id, worker=threading.get_native_id(), took=time() - before
+    )
+
+
+def _normalise_many_in_worker(
+    *,
+    Normalisers: Sequence[type[BaseNormaliser]],
+    path: Path,
+    base_tmp_dir: Path,
+    cache_dir: Path | None,
+    out_dir: Path,
+) -> list[_WorkerResult | Exception]:
+    """
+    Same as _normalise_in_worker, but for multiple normalisers at once, so the input is only unpacked once.
+
+    Errors are returned rather than raised, so one failing normaliser doesn't affect results of the others.
+    """
+    res: list[_WorkerResult | Exception] = []
+    with TemporaryDirectory(dir=base_tmp_dir, prefix='unpacked') as tdir, ExitStack() as stack:
+        # normalisers might customise unpacking, so only share between ones which unpack the same way
+        shared: dict[Callable, _SharedInput] = {}
+        for Normaliser in Normalisers:
+            si = shared.get(Normaliser.unpacked)
+            if si is None:
+                si = stack.enter_context(_SharedInput(path, wdir=Path(tdir) / str(len(shared))))
+                shared[Normaliser.unpacked] = si
+            try:
+                r = _normalise_in_worker(
+                    Normaliser=Normaliser,
+                    path=path,
+                    base_tmp_dir=base_tmp_dir,
+                    cache_dir=cache_dir,
+                    out_dir=out_dir,
+                    shared=si,
+                )
+            except Exception as e:
+                res.append(e)
+            else:
+                res.append(r)
+    return res
+
+
+@dataclass
+class Lookahead:
+    """
+    Limits on normalised files kept around in 'pipeline' mode: normalised (or being normalised) ahead of time,
+    or waiting to be compared and unlinked. Bounds the scratch disk usage regardless of the number of workers.
+    Sorted copies of normalised files made in the background count against the limits as well.
+
+    files: defaults to two per worker, plus three held by the comparison loop itself (pivots and the next file)
+    bytes: no limit by default
+    """
+
+    files: int | None = None
+    bytes: int | None = None
+
+
+class _Prefetcher:
+    """
+    Submits files for normalisation to the pool ahead of time, as long as it fits in the lookahead limits.
+
+    Files are consumed in order, but within the horizon the biggest files are submitted first (LPT scheduling).
+    So a huge file starts early and is normalised while other workers get through the smaller ones,
+    rather than stalling everything once the comparison gets to it.
+
+    The file needed next is always submitted regardless of limits, otherwise comparison couldn't make progress.
+
+    Sorted copies made in the background (see SortedRuns.prefetch) take up space as well, so they count against the limits too.
+
+    consumers: number of normalisers sharing each task (see _normalise_many_in_worker), each consuming files in order.
+    They might run in different threads, hence the lock.
+    """
+
+    def __init__(
+        self,
+        paths: Sequence[Path],
+        *,
+        workers: int,
+        lookahead: Lookahead,
+        submit: Callable[[Path], Future],
+        consumers: int = 1,
+    ) -> None:
+        self.paths = paths
+        self.sizes = [p.stat().st_size for p in paths]
+        self.consumers = consumers
+        self.max_files = (2 * workers + 3) * consumers if lookahead.files is None else lookahead.files
+        self.max_bytes = lookahead.bytes
+        self.horizon = 2 * self.max_files
+        self.submit = submit
+        self.lock = threading.RLock()
+        # index of the file needed next, for each consumer
+        self.cursors = [0 for _ in range(consumers)]
+        # submitted, but not consumed by all consumers yet
+        self.submitted: dict[int, Future] = {}
+        # normalised files produced by workers, which aren't unlinked yet
+        self.live: dict[Path, int] = {}
+        # normalised file -> (estimated) size of its sorted copy, made in the background
+        self.runs: dict[Path, int] = {}
+        self.biggest = 0
+        # worker -> seconds spent normalising
+        self.busy: dict[int, float] = {}
+        self.started = time()
+        self.reported = False
+
+    @property
+    def consumed(self) -> int:
+        return min(self.cursors)
+
+    def _fits(self, idx: int) -> bool:
+        # each task produces a file for each consumer
+        if len(self.submitted) * self.consumers + len(self.live) + len(self.runs) >= self.max_files:
+            return False
+        if self.max_bytes is not None:
+            # don't know the output size in advance, so assume the worst from what we've seen so far
+            estimate = self.biggest if self.biggest > 0 else self.sizes[idx]
+            projected = self._used_bytes() + (len(self.submitted) + 1) * self.consumers * estimate
+            if projected > self.max_bytes:
+                return False
+        return True
+
+    def _used_bytes(self) -> int:
+        return sum(self.live.values()) + sum(self.runs.values())
+
+    def fits_run(self, normalised: Path) -> bool:
+        """
+        Whether there is space to make a sorted copy of the normalised file in the background.
+        """
+        if self.max_bytes is None:
+            return True
+        with self.lock:
+            size = self.live.get(normalised)
+            if size is None:
+                size = normalised.stat().st_size
+            return self._used_bytes() + size <= self.max_bytes
+
+    def sorting(self, normalised: Path, fut: Future[Path]) -> None:
+        """
+        Accounts for the sorted copy being made in the background, until the normalised file is released.
+        """
+
+        def done(fut: Future[Path]) -> None:
+            with self.lock:
+                if normalised not in self.runs:
+                    # released already
+                    return
+                if fut.cancelled() or fut.exception() is not None or fut.result() == normalised:
+                    # no copy after all, e.g. it was sorted already
+                    del self.runs[normalised]
+                    return
+                try:
+                    self.runs[normalised] = fut.result().stat().st_size
+                except FileNotFoundError:
+                    # forgotten in the meantime, about to be released
+                    del self.runs[normalised]
+
+        with self.lock:
+            size = self.live.get(normalised)
+            # sorted copy is at most as big as the file itself
+            self.runs[normalised] = normalised.stat().st_size if size is None else size
+        fut.add_done_callback(done)
+
+    def _submit(self, idx: int) -> None:
+        self.submitted[idx] = self.submit(self.paths[idx])
+
+    def fill(self) -> None:
+        with self.lock:
+            total = len(self.paths)
+            consumed = self.consumed
+            if consumed < total and consumed not in self.submitted:
+                self._submit(consumed)
+            candidates = [
+                idx for idx in range(consumed, min(consumed + self.horizon, total)) if idx not in self.submitted
+            ]
+            candidates.sort(key=lambda idx: self.sizes[idx], reverse=True)
+            for idx in candidates:
+                if not self._fits(idx):
+                    # not letting smaller files jump the queue, otherwise the big one might never get its turn
+                    return
+                self._submit(idx)
+
+    def next(self, consumer: int = 0) -> tuple[int, Path, Future] | None:
+        with self.lock:
+            idx = self.cursors[consumer]
+            if idx == len(self.paths):
+                if self.consumed == len(self.paths) and not self.reported:
+                    self.reported = True
+                    self.report()
+                return None
+            self.fill()
+            if idx not in self.submitted:
+                # consumers ahead of others might get past the window
+                self._submit(idx)
+            fut = self.submitted[idx]
+            self.cursors[consumer] += 1
+            if self.consumed > idx:
+                # everyone is done with it
+                del self.submitted[idx]
+            return idx, self.paths[idx], fut
+
+    def ready(self, consumer: int, *, limit: int) -> list[Future]:
+        """
+        Finished tasks among the next few the consumer is going to need.
+        """
+        with self.lock:
+            idx = self.cursors[consumer]
+            futs = [self.submitted.get(i) for i in range(idx, min(idx + limit, len(self.paths)))]
+            return [f for f in futs if f is not None and f.done() and not f.cancelled()]
+
+    def received(self, res: _WorkerResult, *, original: Path) -> None:
+        with self.lock:
+            self.busy[res.worker] = self.busy.get(res.worker, 0.0) + res.took
+            if res.normalised == original:
+                # 'identity' cleanup, doesn't take any extra space
+                return
+            size = res.normalised.stat().st_size
+            self.live[res.normalised] = size
+            self.biggest = max(self.biggest, size)
+
+    def released(self, normalised: Path) -> None:
+        with self.lock:
+            live = self.live.pop(normalised, None)
+            run = self.runs.pop(normalised, None)
+            if live is not None or run is not None:
+                self.fill()
+
+    def drain(self) -> None:
+        """
+        For when the consumer stops early: waits for tasks which are still running and removes their outputs.
+        """
+        with self.lock:
+            assert self.consumers == 1, self.consumers
+            for idx, fut in self.submitted.items():
+                if fut.cancel() or fut.exception() is not None:
+                    continue
+                res: _WorkerResult = fut.result()
+                if res.normalised != self.paths[idx]:
+                    res.normalised.unlink(missing_ok=True)
+            self.submitted.clear()
+
+    def report(self) -> None:
+        took = time() - self.started
+        for worker, busy in sorted(self.busy.items()):
+            logger.info(
+                'worker %d: normalising for %.1fs out of %.1fs (%.0f%% utilisation)',
+                worker,
+                busy,
+                took,
+                100 * busy / took if took > 0 else 100,
+            )
+
+
 def compute_groups(
     paths: Sequence[Path],
     *,
     Normaliser: type[BaseNormaliser],
     threads: int | None = None,
+    cache_dir: Path | None = None,
+    engine: Engine = 'exact',
+    parallel: Parallel = 'pipeline',
+    lookahead: Lookahead | None = None,
+    speculate: int = 0,
+    executor: PoolKind | None = None,
+    pool: Executor | None = None,
 ) -> Iterator[Group]:
+    """
+    pool: existing pool to run workers in (e.g. shared between multiple normalisers), it's left running afterwards.
+          Otherwise a new one is made according to threads/executor
+    """
     assert len(paths) == len(set(paths)), paths  # just in case
     assert len(paths) > 0  # just in case
 
-    pool = DummyExecutor() if threads is None else ProcessPoolExecutor(max_workers=None if threads == 0 else threads)
-    with pool, bleanser_tmp_directory() as base_tmp_dir:
+    pool_cm: AbstractContextManager[object]
+    if pool is None:
+        pool = _make_pool(threads=threads, executor=executor, Normalisers=[Normaliser])
+        pool_cm = pool
+    else:
+        # owned by the caller, so shouldn't shut it down
+        pool_cm = nullcontext()
+    with pool_cm, bleanser_tmp_directory() as base_tmp_dir:
         workers = getattr(pool, '_max_workers')
         workers = min(workers, len(paths))  # no point in using too many workers
-        logger.info('using %d workers', workers)
+        logger.info('using %d workers (%s)', workers, type(pool).__name__)
 
-        futures: list[Future] = []
-        for paths_chunk in divide_by_size(buckets=workers, paths=paths):
-            pp = list(paths_chunk)
-            if len(pp) == 0:
-                continue
-            # force iterator if we're using more than one thread
-            # otherwise it'll still be basically serial execution
-            # in addition, multiprocess would fail to pickle returned iterator
-            func: Callable[..., Iterable[Group]]
-            # note: separate declaration and if statement makes mypy happy
-            if threads is not None:
-                func = _compute_groups_serial_as_list
-            else:
-                func = _compute_groups_serial
-            futures.append(
-                pool.submit(
+        emitted: set[Path] = set()
+        if threads is not None and parallel == 'pipeline':
+            # normalise in the pool, but compare in order here, so the results are the same as for a serial run
+            for r in _compute_groups_serial(
+                paths,
+                Normaliser=Normaliser,
+                base_tmp_dir=base_tmp_dir,
+                cache_dir=cache_dir,
+                engine=engine,
+                pool=pool,
+                workers=workers,
+                lookahead=lookahead,
+                speculate=speculate,
+            ):
+                emitted |= set(r.items)
+                yield r
+        else:
+            futures: list[tuple[list[Path], Future]] = []
+            for paths_chunk in divide_by_size(buckets=workers, paths=paths):
+                pp = list(paths_chunk)
+                if len(pp) == 0:
+                    continue
+                # force iterator if we're using more than one thread
+                # otherwise it'll still be basically serial execution
+                # in addition, multiprocess would fail to pickle returned iterator
+                func: Callable[..., Iterable[Group]]
+                # note: separate declaration and if statement makes mypy happy
+                if threads is not None:
+                    func = _compute_groups_serial_as_list
+                else:
+                    func = _compute_groups_serial
+                fut = pool.submit(
                     func,
                     paths=pp,
                     Normaliser=Normaliser,
                     base_tmp_dir=base_tmp_dir,
+                    cache_dir=cache_dir,
+                    engine=engine,
+                )
+                futures.append((pp, fut))
+            if len(futures) == 1:
+                [(_, f)] = futures
+                rit = f.result()
+            else:
+                # chunks are done in parallel, now fix up the boundaries between them (using the pool as in 'pipeline' mode)
+                rit = _reconcile_chunks(
+                    ((pp, f.result()) for pp, f in futures),
+                    Normaliser=Normaliser,
+                    base_tmp_dir=base_tmp_dir,
+                    cache_dir=cache_dir,
+                    engine=engine,
+                    pool=pool,
+                    workers=workers,
+                    lookahead=lookahead,
+                    speculate=speculate,
                 )
-            )
-        emitted: set[Path] = set()
-        for f in futures:
-            rit = f.result()
             for r in rit:
                 emitted |= set(r.items)
                 yield r
     assert emitted == set(paths), (paths, emitted)  # just in case
 
 
+def compute_groups_shared(
+    paths: Sequence[Path],
+    *,
+    Normalisers: Sequence[type[BaseNormaliser]],
+    threads: int | None = None,
+    cache_dir: Path | None = None,
+    engine: Engine = 'exact',
+    lookahead: Lookahead | None = None,
+    speculate: int = 0,
+    executor: PoolKind | None = None,
+) -> list[list[Group]]:
+    """
+    Same as compute_groups in 'pipeline' mode, but for multiple normalisers at once.
+
+    Each input is unpacked once, and normalised by all normalisers in the same pool task.
+    Each normaliser then compares its results in its own thread, so it takes about as long as running the slowest one.
+    """
+    assert len(paths) == len(set(paths)), paths  # just in case
+    assert len(paths) > 0  # just in case
+
+    pool = _make_pool(threads=threads, executor=executor, Normalisers=Normalisers)
+    consumers = ThreadPoolExecutor(max_workers=len(Normalisers))
+    with pool, consumers, bleanser_tmp_directory() as base_tmp_dir:
+        workers = getattr(pool, '_max_workers')
+        workers = min(workers, len(paths))  # no point in using too many workers
+        logger.info('using %d workers (%s) for %d normalisers', workers, type(pool).__name__, len(Normalisers))
+
+        out_dir = base_tmp_dir / 'normalised'
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        def submit(input: Path) -> Future:  # noqa: A002
+            # run constructor sanity checks here, so they fail the same way as in serial mode
+            for Normaliser in Normalisers:
+                Normaliser(original=input, base_tmp_dir=base_tmp_dir)
+            return pool.submit(
+                _normalise_many_in_worker,
+                Normalisers=Normalisers,
+                path=input,
+                base_tmp_dir=base_tmp_dir,
+                cache_dir=cache_dir,
+                out_dir=out_dir,
+            )
+
+        prefetcher = _Prefetcher(
+            paths,
+            workers=workers,
+            lookahead=Lookahead() if lookahead is None else lookahead,
+            submit=submit,
+            consumers=len(Normalisers),
+        )
+        # start off in the main thread, since process pool might fork worker processes on the first submit
+        prefetcher.fill()
+        futures = [
+            consumers.submit(
+                _compute_groups_serial_as_list,
+                paths,
+                Normaliser=Normaliser,
+                base_tmp_dir=base_tmp_dir,
+                cache_dir=cache_dir,
+                engine=engine,
+                pool=pool,
+                workers=workers,
+                speculate=speculate,
+                shared=(prefetcher, i),
+            )
+            for i, Normaliser in enumerate(Normalisers)
+        ]
+        res = [list(f.result()) for f in futures]
+    for groups in res:
+        emitted = {i for g in groups for i in g.items}
+        assert emitted == set(paths), (paths, emitted)  # just in case
+    return res
+
+
 @cache
 def _get_gnu_diff_binary() -> str:
     diff = 'diff'
@@ -285,9 +867,110 @@ def _get_gnu_diff_binary() -> str:
     return diff
 
 
+# start small, so a mismatch right away doesn't cost much
+_MIN_CHUNK = 4 * 1024
+_MAX_CHUNK = 1024 * 1024
+
+
+def _last_line(m: mmap.mmap) -> bytes:
+    end = len(m)
+    if m[end - 1 : end] == b'\n':
+        end -= 1
+    start = m.rfind(b'\n', 0, end) + 1
+    return m[start:end]
+
+
+def _is_contained(lfile: Path, *rfiles: Path) -> bool:
+    """
+    Checks whether every line of lfile is present in (the union of) rfiles.
+
+    All files must be sorted bytewise (LC_ALL=C) and deduplicated, i.e. what FileSet keeps as runs.
+    Then it's a linear merge walk, which stops at the first line missing from rfiles,
+    whereas diff would compute LCS and produce the whole difference.
+    """
+    lsize = lfile.stat().st_size
+    if lsize == 0:
+        return True
+    with ExitStack() as stack:
+
+        def open_mmap(f: Path) -> mmap.mmap:
+            fo = stack.enter_context(f.open('rb'))
+            return stack.enter_context(mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ))
+
+        lm = open_mmap(lfile)
+        # can't mmap empty files, but they don't contribute any lines anyway
+        rms = [open_mmap(r) for r in rfiles if r.stat().st_size > 0]
+        if len(rms) == 0:
+            return False
+
+        # most comparisons fail, so first check some necessary conditions which don't require reading whole files
+        # +1 for each file since the last line might be missing a newline
+        if lsize > sum(len(rm) + 1 for rm in rms):
+            return False
+        # the last line is the biggest, so it can't be contained if it's bigger than everything on the right
+        # (otherwise the walk would only find out at the very end)
+        if _last_line(lm) > max(_last_line(rm) for rm in rms):
+            return False
+        # positions of the next unconsumed line in each of rfiles
+        rposs = [0 for _ in rms]
+
+        lpos = 0
+        chunk = _MIN_CHUNK
+        while lpos < lsize:
+            # fast path: files usually share long runs of lines, so compare big chunks without splitting them into lines
+            # NOTE: slicing mmap copies, but comparing memoryviews is way slower since it's elementwise
+            skipped = False
+            for i, rm in enumerate(rms):
+                rpos = rposs[i]
+                n = min(chunk, lsize - lpos, len(rm) - rpos)
+                if n > 0 and lm[lpos : lpos + n] == rm[rpos : rpos + n]:
+                    # only skip up to the last complete line, the rest might continue differently
+                    nl = lm.rfind(b'\n', lpos, lpos + n)
+                    if nl != -1:
+                        skip = nl + 1 - lpos
+                        lpos += skip
+                        rposs[i] += skip
+                        skipped = True
+                        break
+            if skipped:
+                chunk = min(chunk * 2, _MAX_CHUNK)
+                continue
+            chunk = _MIN_CHUNK
+
+            lend = lm.find(b'\n', lpos)
+            if lend == -1:
+                lend = lsize
+            lline = lm[lpos:lend]
+            found = False
+            for i, rm in enumerate(rms):
+                rsize = len(rm)
+                rpos = rposs[i]
+                while rpos < rsize:
+                    rend = rm.find(b'\n', rpos)
+                    if rend == -1:
+                        rend = rsize
+                    rline = rm[rpos:rend]
+                    if rline > lline:
+                        # rfile is sorted, so lline can't be further down
+                        break
+                    rpos = rend + 1
+                    if rline == lline:
+                        found = True
+                        break
+                rposs[i] = rpos
+                if found:
+                    break
+            if not found:
+                return False
+            lpos = lend + 1
+        return True
+
+
 def _subtract_files(lfile: Path, rfile: Path) -> str | None:
     """
     If lfile is fully contained in rfile, returns None. Otherwise returns the diff.
+
+    NOTE: this is fairly expensive, for the containment check itself use _is_contained
     """
     # Use custom group format to only show actual changes without the line number ranges/action codes
     #  %< means lines only in left file, %> means lines only in right file
@@ -321,91 +1004,222 @@ def _subtract_files(lfile: Path, rfile: Path) -> str | None:
     return res.stdout
 
 
-# TODO shit. it has to own tmp dir...
-# we do need a temporary copy after all?
+def _is_same(lfile: Path, rfile: Path) -> bool:
+    # TODO meh. maybe get rid of cmp, it's not really faster
+    # even on exactly same file (copy) it seemed to be slower
+    # https://unix.stackexchange.com/questions/153286/is-cmp-faster-than-diff-q
+    res = subprocess.run(['cmp', '--silent', lfile, rfile], check=False)
+    if res.returncode not in (0, 1):
+        res.check_returncode()
+    return res.returncode == 0
+
+
+def _check_in_worker(*, relation: Relation, left: Path, right: Sequence[Path]) -> bool:
+    """
+    Runs in pool workers for speculative checks, left and right are sorted runs (see SortedRuns).
+    """
+    if relation == 'same':
+        [rfile] = right
+        return _is_same(left, rfile)
+    elif relation == 'subset':
+        return _is_contained(left, *right)
+    else:
+        assert_never(relation)
+
+
+def _is_sorted_unique(path: Path) -> bool:
+    res = subprocess.run(['sort', '--check=quiet', '--unique', str(path)], env=_sort_env(), check=False)
+    if res.returncode not in (0, 1):
+        res.check_returncode()
+    return res.returncode == 0
+
+
+class SortedRuns:
+    """
+    Sorted (LC_ALL=C) and deduplicated versions of normalised files, shared by FileSets.
+
+    Each normalised file is sorted at most once, regardless of how many sets it takes part in.
+    If it's already sorted (e.g. normaliser called sort_file), it's used as is.
+
+    subprocesses: if passed, files can be sorted in the background ahead of time, see prefetch
+    """
+
+    def __init__(self, wdir: Path, *, subprocesses: Subprocesses | None = None) -> None:
+        self.wdir = wdir
+        self.subprocesses = subprocesses
+        self._runs: dict[Path, Path] = {}
+        self._pending: dict[Path, Future[Path]] = {}
+
+    def _tmp_run(self) -> Path:
+        tfile = NamedTemporaryFile(dir=self.wdir, delete=False)  # noqa: SIM115
+        tfile.close()
+        return Path(tfile.name)
+
+    def get(self, path: Path) -> Path:
+        run = self._runs.get(path)
+        if run is None:
+            pending = self._pending.pop(path, None)
+            if pending is not None:
+                run = pending.result()
+            elif _is_sorted_unique(path):
+                run = path
+            else:
+                run = self._tmp_run()
+                run_sort('--unique', path, '-o', run)
+            self._runs[path] = run
+        return run
+
+    def prefetch(self, path: Path) -> Future[Path] | None:
+        """
+        Starts sorting the file in the background, so it's hopefully ready by the time it's compared.
+
+        Returns None if it's not started, e.g. if it's sorted already.
+        """
+        if self.subprocesses is None or path in self._runs or path in self._pending:
+            return None
+        fut = self.subprocesses.submit(self._sort_async(self.subprocesses, path))
+        self._pending[path] = fut
+        return fut
+
+    async def _sort_async(self, subprocesses: Subprocesses, path: Path) -> Path:
+        # same as in get
+        env = _sort_env()
+        res = await subprocesses.run('sort', '--check=quiet', '--unique', path, env=env)
+        if res.returncode not in (0, 1):
+            res.check_returncode()
+        if res.returncode == 0:
+            return path
+        run = self._tmp_run()
+        res = await subprocesses.run('sort', '--unique', path, '-o', run, env=env)
+        res.check_returncode()
+        return run
+
+    def forget(self, path: Path) -> None:
+        pending = self._pending.pop(path, None)
+        if pending is not None:
+            # wait for it, so the sorted copy isn't left behind
+            try:
+                self._runs[path] = pending.result()
+            except Exception as e:
+                logger.exception(e)
+        run = self._runs.pop(path, None)
+        if run is not None and run != path:
+            run.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        for path in [*self._pending, *self._runs]:
+            self.forget(path)
+
+
 class FileSet(AbstractContextManager):
-    def __init__(self, items: Sequence[Path] = (), *, wdir: Path) -> None:
+    """
+    Set of lines in normalised files.
+
+    It's kept as a list of sorted runs (one per file), which are only merged lazily while comparing.
+    So union is cheap and doesn't need to copy/re-sort everything, which matters for long groups of similar files.
+
+    NOTE: unions share sorted runs with the set they are derived from, so the original set should be closed last
+    (unless runs are managed by the caller).
+    """
+
+    def __init__(
+        self,
+        items: Sequence[Path] = (),
+        *,
+        wdir: Path,
+        verdicts: Verdicts | None = None,
+        runs: SortedRuns | None = None,
+    ) -> None:
         self.wdir = wdir
+        self.verdicts = verdicts
+        self._own_runs = runs is None
+        self.runs = SortedRuns(wdir) if runs is None else runs
         self.items: list[Path] = []
-        tfile = NamedTemporaryFile(dir=self.wdir, delete=False)  # noqa: SIM115
-        self.merged = Path(tfile.name)
+        self._merged: Path | None = None
         self._union(*items)
 
-    def _copy(self) -> FileSet:
-        fs = FileSet(wdir=self.wdir)
-        fs.items = list(self.items)
-        shutil.copy(str(self.merged), str(fs.merged))
-        return fs
-
     def union(self, *paths: Path) -> FileSet:
-        u = self._copy()
+        u = FileSet(wdir=self.wdir, verdicts=self.verdicts, runs=self.runs)
+        u.items = list(self.items)
         u._union(*paths)
         return u
 
     def _union(self, *paths: Path) -> None:
         extra = [p for p in paths if p not in self.items]
         extra = list(more_itertools.unique_everseen(extra))
+        for p in extra:
+            # sort straightaway, so it happens while the normalised file is still around
+            self.runs.get(p)
+        self.items.extend(extra)
 
-        if len(extra) == 0:
-            # short circuit
-            return
-
-        # todo so we could also sort individual dumps... then could use sort --merged to just merge...
-        # it seems to be marginally better, like 25% maybe
-        # makes it a bit more compliacted on
-        # if I do implement it:
-        # - add '--merge' flag below
-        # - add sort --unique in sqlite.py
-        # - add sort --check after we got cleaned file
-        #   NOTE: can't make it in-place either because might modify the input file in case of 'idenity' cleaner
-
-        # note:
-        # safe to reuse the same file as input & output
-        # 'This file can be the same as one of the input files.'
-        # https://pubs.opengroup.org/onlinepubs/9699919799/utilities/sort.html
-
-        # allow it not to have merged file if set is empty
-        tomerge = ([] if len(self.items) == 0 else [self.merged]) + extra
+    def _runs(self) -> list[Path]:
+        return [self.runs.get(i) for i in self.items]
 
-        # If every input is already sorted, sort --unique --merge can be a nice optimization because merge is linear and avoids re-sorting all lines from scratch.
-        # In practice it also needs a sort --check pass, and with LC_ALL=C the full sort --unique path is already cheap for current sqlite dumps: about 0.10s for one ~70MB dump and about 0.16-0.20s for two ~70MB dumps on observed Firefox history data.
-        # TODO: re-evaluate --merge if useful; uutils sort 0.8.0 can corrupt long lines in --merge mode.
-        run_sort('--unique', *tomerge, '-o', self.merged)
+    @property
+    def merged(self) -> Path:
+        """
+        All lines in the set as a single sorted file.
 
-        self.items.extend(extra)
+        Only materialised on demand (e.g. for diffing), comparisons work on runs directly.
+        """
+        if self._merged is None:
+            tfile = NamedTemporaryFile(dir=self.wdir, delete=False)  # noqa: SIM115
+            tfile.close()
+            merged = Path(tfile.name)
+            runs = self._runs()
+            if len(runs) > 0:
+                # note: not using --merge, uutils sort 0.8.0 can corrupt long lines in --merge mode
+                run_sort('--unique', *runs, '-o', merged)
+            self._merged = merged
+        return self._merged
+
+    def _single(self) -> Path:
+        runs = self._runs()
+        return runs[0] if len(runs) == 1 else self.merged
+
+    def _memoised(self, relation: Relation, other: FileSet, compute: Callable[[], bool]) -> bool:
+        verdicts = self.verdicts
+        if verdicts is None:
+            return compute()
+        lids = verdicts.item_ids(self.items)
+        rids = verdicts.item_ids(other.items)
+        if lids is None or rids is None:
+            return compute()
+        # e.g. runs of unchanged snapshots -- no need to even look at the files
+        if relation == 'same' and lids == rids:
+            return True
+        if relation == 'subset' and lids <= rids:
+            return True
+        lid = verdicts.set_id(lids)
+        rid = verdicts.set_id(rids)
+        cached = verdicts.get(relation, lid, rid)
+        if cached is not None:
+            return cached
+        res = compute()
+        verdicts.put(relation, lid, rid, result=res, members={lid: lids, rid: rids})
+        return res
 
     def issame(self, other: FileSet) -> bool:
-        lfile = self.merged
-        rfile = other.merged
-        # TODO meh. maybe get rid of cmp, it's not really faster
-        # even on exactly same file (copy) it seemed to be slower
-        # https://unix.stackexchange.com/questions/153286/is-cmp-faster-than-diff-q
-        res = subprocess.run(['cmp', '--silent', lfile, rfile], check=False)
-        if res.returncode not in (0, 1):
-            res.check_returncode()
-        return res.returncode == 0
+        return self._memoised('same', other, lambda: self._issame(other))
 
     def issubset(self, other: FileSet) -> bool:
-        # short circuit
-        # this doesn't really speed up much though? so guess better to keep the code more uniform..
-        # if set(self.items) <= set(other.items):
-        #     return True
-        lfile = self.merged
-        rfile = other.merged
-        # upd: hmm, this function is actually super fast... guess diff is quite a bit optimized
-
-        # TODO tbh should just use cmp/comm for the rest... considering it's all sorted
-        # first check if they are identical (should be super fast, stops at the first byte difference)
-        # TODO this is more or less usefless ATM.. because files in fileset are always different
-        if self.issame(other):
-            # short circuit
+        return self._memoised('subset', other, lambda: self._issubset(other))
+
+    def _issame(self, other: FileSet) -> bool:
+        return _is_same(self._single(), other._single())
+
+    def _issubset(self, other: FileSet) -> bool:
+        lfile = self._single()
+        if _is_contained(lfile, *other._runs()):
             return True
 
-        difference = _subtract_files(lfile, rfile)
-        return difference is None
+        if sys.stdin.isatty():
+            # only to show the difference in debug logs, the verdict is already known
+            _subtract_files(lfile, other.merged)
+        return False
 
     def __repr__(self) -> str:
-        return repr((self.items, self.merged))
+        return repr(self.items)
 
     @override
     def __enter__(self) -> Self:
@@ -416,7 +1230,11 @@ class FileSet(AbstractContextManager):
         self.close()
 
     def close(self) -> None:
-        self.merged.unlink(missing_ok=True)
+        if self._merged is not None:
+            self._merged.unlink(missing_ok=True)
+            self._merged = None
+        if self._own_runs:
+            self.runs.close()
 
 
 # just for process pool
@@ -434,13 +1252,38 @@ def _compute_groups_serial(
     *,
     Normaliser: type[BaseNormaliser],
     base_tmp_dir: Path,
-) -> Iterable[Group]:
+    cache_dir: Path | None = None,
+    engine: Engine = 'exact',
+    pool: Executor | None = None,
+    workers: int = 1,
+    lookahead: Lookahead | None = None,
+    speculate: int = 0,
+    shared: tuple[_Prefetcher, int] | None = None,
+    stop_at: Collection[Path] = (),
+) -> Generator[Group, None, Path | None]:
+    """
+    pool: if passed, files are normalised in the pool (ahead of time), see Parallel
+    speculate: if using pool, check that many next files in parallel (only for 'exact' engine)
+    shared: prefetcher (and consumer index in it) shared with other normalisers, see compute_groups_shared
+    stop_at: stop before starting a group at any of these files (except the first one), and return where it stopped.
+             See _reconcile_chunks
+    """
     assert len(paths) > 0
 
+    cache = None if cache_dir is None else Cache(cache_dir)
+
     cleaned2orig: dict[IRes, Path] = {}
     cleaned = []
 
-    def iter_results() -> Iterator[IRes]:
+    def record(input: Path, res: IRes) -> IRes:  # noqa: A002
+        # TODO ugh. Exception isn't hashable in general, so at least assert to avoid ambiguity
+        # not sure what would be the proper fix...
+        assert res not in cleaned2orig, res
+        cleaned2orig[res] = input
+        cleaned.append(res)
+        return res
+
+    def iter_results() -> Generator[IRes, None, None]:
         with ExitStack() as exit_stack:
             for idx, input in enumerate(paths):  # noqa: A001
                 normaliser = Normaliser(original=input, base_tmp_dir=base_tmp_dir)
@@ -452,53 +1295,215 @@ def _compute_groups_serial(
                 # logger.debug('total wdir(%s) size: %s', wdir, ds)
                 before = time()
                 try:
-                    res = exit_stack.enter_context(normaliser.do_normalise())
+                    res = exit_stack.enter_context(_do_normalise_cached(normaliser, cache=cache))
                 except Exception as e:
                     logger.exception(e)
                     res = e
                 after = time()
                 logger.debug('cleanup(%s): took %.2f seconds', input, after - before)
-                # TODO ugh. Exception isn't hashable in general, so at least assert to avoid ambiguity
-                # not sure what would be the proper fix...
-                assert res not in cleaned2orig, res
-                cleaned2orig[res] = input
-                cleaned.append(res)
-                yield res
+                yield record(input, res)
+
+    prefetcher: _Prefetcher | None = None
+    consumer = 0
+    subprocesses: Subprocesses | None = None
+
+    def iter_results_pipelined(pool: Executor) -> Generator[IRes, None, None]:
+        nonlocal prefetcher, consumer
+        out_dir = base_tmp_dir / 'normalised'
+        out_dir.mkdir(parents=True, exist_ok=True)
+
+        def submit(input: Path) -> Future:  # noqa: A002
+            # run constructor sanity checks here, so they fail the same way as in serial mode
+            Normaliser(original=input, base_tmp_dir=base_tmp_dir)
+            return pool.submit(
+                _normalise_in_worker,
+                Normaliser=Normaliser,
+                path=input,
+                base_tmp_dir=base_tmp_dir,
+                cache_dir=cache_dir,
+                out_dir=out_dir,
+            )
+
+        if shared is None:
+            prefetcher = _Prefetcher(
+                paths,
+                workers=workers,
+                lookahead=Lookahead() if lookahead is None else lookahead,
+                submit=submit,
+            )
+        else:
+            (prefetcher, consumer) = shared
+
+        def worker_result(fut: Future) -> _WorkerResult:
+            if shared is None:
+                return fut.result()
+            # see _normalise_many_in_worker
+            res: _WorkerResult | Exception = fut.result()[consumer]
+            if isinstance(res, Exception):
+                raise res
+            return res
+
+        def prefetch_sorts() -> None:
+            # files normalised ahead of time are sorted in the background, while the current one is being compared
+            if subprocesses is None:
+                return
+            assert prefetcher is not None
+            for fut in prefetcher.ready(consumer, limit=subprocesses.limit):
+                if fut.exception() is not None:
+                    continue
+                wres = fut.result() if shared is None else fut.result()[consumer]
+                if not isinstance(wres, _WorkerResult) or not prefetcher.fits_run(wres.normalised):
+                    continue
+                sorting = sorted_runs.prefetch(wres.normalised)
+                if sorting is not None:
+                    prefetcher.sorting(wres.normalised, sorting)
+
+        while (nxt := prefetcher.next(consumer)) is not None:
+            (idx, input, fut) = nxt  # noqa: A001
+            logger.info('processing %s (%d/%d)', input, idx, len(paths))
+            res: IRes
+            try:
+                wres = worker_result(fut)
+            except Exception as e:
+                logger.exception(e)
+                res = e
+            else:
+                prefetcher.received(wres, original=input)
+                if cache is not None and wres.content_id is not None:
+                    cache.verdicts.ids[wres.normalised] = wres.content_id
+                res = wres.normalised
+            prefetch_sorts()
+            yield record(input, res)
 
     fileset_wdir = base_tmp_dir / 'fileset'
     fileset_wdir.mkdir(parents=True, exist_ok=True)
 
-    def fset(*paths: Path) -> FileSet:
-        return FileSet(paths, wdir=fileset_wdir)
+    verdicts = None if cache is None else cache.verdicts
+
+    sorted_runs = SortedRuns(fileset_wdir)
+
+    def exact_fset(*paths: Path) -> FileSet:
+        return FileSet(paths, wdir=fileset_wdir, verdicts=verdicts, runs=sorted_runs)
+
+    fset: Callable[..., FileSet | HashFileSet]
+    if engine == 'exact':
+        hash_registry = None
+        fset = exact_fset
+    elif engine == 'hash':
+        from .hashset import HashFileSet, HashRegistry
+
+        hash_registry = HashRegistry()
+
+        def fset(*paths: Path) -> HashFileSet:
+            return HashFileSet(paths, registry=hash_registry)
+    else:
+        assert_never(engine)
+
+    def verify(inner: Path, *pivots: Path) -> bool:
+        """
+        Double checks the verdict of a non-exact engine against the actual normalised text.
+        """
+        with exact_fset(inner) as si, exact_fset(*pivots) as sp:
+            ok = si.issame(sp) if not Normaliser.PRUNE_DOMINATED else si.issubset(sp)
+        if not ok:
+            logger.warning(
+                '%s: %s engine verdict failed exact verification (hash collision?)', cleaned2orig[inner], engine
+            )
+        return ok
 
     def unlink_tmp_output(cleaned: Path) -> None:
         # meh. unlink is a bit manual, but bounds the filesystem use by two dumps
         # todo maybe unlink whole tmp_dir for normaliser?
+        sorted_runs.forget(cleaned)
+        if hash_registry is not None:
+            hash_registry.forget(cleaned)
         orig = cleaned2orig[cleaned]
-        if orig == cleaned:
-            # handle 'identity' cleanup -- shouldn't try to remove user files
-            return
-        # meh... just in case
-        assert str(cleaned.resolve()).startswith(str(Path(gettempdir()).resolve())), cleaned
-        # todo no need to unlink in debug mode?
-        cleaned.unlink(missing_ok=True)
+        # handle 'identity' cleanup -- shouldn't try to remove user files
+        if orig != cleaned:
+            # meh... just in case
+            assert str(cleaned.resolve()).startswith(str(Path(gettempdir()).resolve())), cleaned
+            # todo no need to unlink in debug mode?
+            cleaned.unlink(missing_ok=True)
+        if prefetcher is not None:
+            # frees up space for more files to be normalised ahead
+            prefetcher.released(cleaned)
 
     total = len(paths)
 
+    relation: Relation = 'subset' if Normaliser.PRUNE_DOMINATED else 'same'
+    speculating = pool is not None and speculate > 0 and engine == 'exact'
+    # checks submitted to the pool ahead of time, (inner, *pivots) -> verdict
+    speculative: dict[tuple[Path, ...], Future] = {}
+
+    def discard_speculative() -> None:
+        for fut in speculative.values():
+            fut.cancel()
+        speculative.clear()
+
+    def speculate_from(right: int, *, lpfile: Path) -> None:
+        """
+        Submits checks for right, right + 1, ... to the pool, as if all of them were going to be dominated.
+
+        Each check only involves neighbouring files (and lpfile in multiway mode), so they are independent of each other.
+        Verdicts are still consumed in order, so the groups are exactly the same as without speculation.
+        """
+        assert pool is not None
+        for j in range(right, min(right + speculate, total)):
+            inner = ires[j - 1]
+            nxt = ires[j]
+            if isinstance(inner, Exception) or isinstance(nxt, Exception):
+                break
+            if inner == lpfile:
+                # trivially dominated
+                continue
+            pivots = (lpfile, nxt) if Normaliser.MULTIWAY else (nxt,)
+            key = (inner, *pivots)
+            if key in speculative:
+                continue
+            speculative[key] = pool.submit(
+                _check_in_worker,
+                relation=relation,
+                left=sorted_runs.get(inner),
+                right=[sorted_runs.get(p) for p in pivots],
+            )
+
+    def check(inner: Path, *pivots: Path) -> bool:
+        with ExitStack() as stack:
+            si = stack.enter_context(fset(inner))
+            sp = stack.enter_context(fset(*pivots))
+            fut = speculative.pop((inner, *pivots), None)
+            if fut is not None:
+                assert isinstance(si, FileSet), si
+                assert isinstance(sp, FileSet), sp
+                return si._memoised(relation, sp, fut.result)
+            return si.issubset(sp) if relation == 'subset' else si.issame(sp)
+
     # ok. this is a bit hacky
     # ... but making it properly iterative would be complicated and error prone
     # since sometimes we do need lookahead (for right + 1)
     # so using peekable seems like a good compromise
-    ires = more_itertools.peekable(iter_results())
+    results = iter_results() if pool is None else iter_results_pipelined(pool)
+    ires = more_itertools.peekable(results)
     # it would be nice to also release older iterator entries (calling next())
     # but it seems to change indexing... so a bit of a mess.
 
     ires[0]  # ugh. a bit crap, but we're nudging it to initialize wdir...
 
+    if pool is not None and engine == 'exact':
+        # every file needs to be sorted before it's compared, so might as well start early
+        # only starting it now, since process pool might fork worker processes on the first submit
+        subprocesses = Subprocesses(limit=workers)
+        sorted_runs.subprocesses = subprocesses
+
     left = 0
+    stopped: Path | None = None
     # empty fileset is easier than optional
     items = fset()
     while left < total:
+        if left > 0 and paths[left] in stop_at:
+            stopped = paths[left]
+            break
+
         lfile = ires[left]
 
         if isinstance(lfile, Exception):
@@ -559,30 +1564,42 @@ def _compute_groups_serial(
                 # else try to advance right while maintaining invariants
                 right_res = ires[right]
 
-                next_state: tuple[FileSet, Path] | None
+                next_state: tuple[FileSet | HashFileSet, Path] | None
                 if isinstance(right_res, Exception):
                     # short circuit... error itself will be handled when right_res is the leftmost element
                     next_state = None
                 else:
                     nitems = items.union(right_res)
+                    before_right = nitems.items[-2]
 
                     if Normaliser.MULTIWAY:
                         # otherwise doesn't make sense?
                         assert Normaliser.PRUNE_DOMINATED
 
                         # in multiway mode we check if the boundaries (pivots) contain the rest
-                        npivots = rstack.enter_context(fset(lpfile, right_res))
-                        dominated = nitems.issubset(npivots)
+                        # by the invariant, the rest of items are contained in lpfile + rpfile
+                        # so it's equivalent to checking nitems, but only reads rpfile instead of the whole group
+                        if rpfile == lpfile:
+                            dominated = True
+                        else:
+                            if speculating:
+                                speculate_from(right, lpfile=lpfile)
+                            dominated = check(rpfile, lpfile, right_res)
                     else:
                         # in two-way mode we check if successive paths include each other
-                        before_right = nitems.items[-2]
-                        s1 = rstack.enter_context(fset(before_right))
-                        s2 = rstack.enter_context(fset(right_res))
-
-                        if not Normaliser.PRUNE_DOMINATED:
-                            dominated = s1.issame(s2)
+                        if speculating:
+                            speculate_from(right, lpfile=lpfile)
+                        dominated = check(before_right, right_res)
+
+                    if dominated and engine != 'exact':
+                        # non-exact engines might be wrong, so verify before anything becomes prunable.
+                        # it's enough to check the file that's about to become an inner item:
+                        # previous inner items were contained in it (or in lpfile), so they are contained transitively
+                        if Normaliser.MULTIWAY:
+                            if rpfile != lpfile:
+                                dominated = verify(rpfile, lpfile, right_res)
                         else:
-                            dominated = s1.issubset(s2)
+                            dominated = verify(before_right, right_res)
 
                     if dominated:
                         next_state = (nitems, right_res)
@@ -591,6 +1608,9 @@ def _compute_groups_serial(
                         rstack.push(nitems)  # won't need it anymore, recycle
 
                 if next_state is None:
+                    if Normaliser.MULTIWAY:
+                        # these were relying on the current lpfile
+                        discard_speculative()
                     # ugh. a bit crap, but seems that a special case is necessary
                     # otherwise left won't ever get advanced?
                     if len(pivots.items) == 2:
@@ -616,16 +1636,109 @@ def _compute_groups_serial(
 
                 right += 1
 
-    items.close()
-
     # meh. hacky but sort of does the trick
     cached = len(getattr(ires, '_cache'))
-    assert cached == total, 'Iterator should be fully processed!'
+
+    items.close()
+    discard_speculative()
+    if stopped is not None:
+        # these were read ahead, but won't be compared anymore
+        for idx in range(left, cached):
+            r = ires[idx]
+            if not isinstance(r, Exception):
+                unlink_tmp_output(r)
+        results.close()
+        if prefetcher is not None:
+            prefetcher.drain()
+    sorted_runs.close()
+    if subprocesses is not None:
+        subprocesses.close()
+
+    assert stopped is not None or cached == total, 'Iterator should be fully processed!'
 
     # TODO: this is not thread safe, should check this above the call stack when Pool is finished
     # stale_files = [p for p in base_tmp_dir.rglob('*') if p.is_file()]
     # TODO at the moment this assert fails sometimes -- need to investigate
     # assert len(stale_files) == 0, stale_files
+    return stopped
+
+
+def _reconcile_chunks(
+    chunks: Iterable[tuple[Sequence[Path], Sequence[Group]]],
+    *,
+    Normaliser: type[BaseNormaliser],
+    base_tmp_dir: Path,
+    cache_dir: Path | None,
+    engine: Engine,
+    pool: Executor | None,
+    workers: int,
+    lookahead: Lookahead | None,
+    speculate: int,
+) -> Iterator[Group]:
+    """
+    Recomputes groups across chunk boundaries in 'chunks' mode, so the results are the same as for a serial run.
+
+    A group only depends on the file it starts at and the ones after it (see incremental.py).
+    So the last group of a chunk is recomputed, continuing into the next chunk,
+    until a group starts at the same file as some group computed for the next chunk: from there on they are the same.
+
+    Continuing the last group only needs its pivots: the files in between are dominated by them, so aren't normalised again.
+    However the next chunk is normalised again until the groups line up,
+    so if a single group spans the whole next chunk, that chunk is normalised twice.
+    """
+    pending: Sequence[Group] = ()
+    for paths, groups in chunks:
+        if len(pending) == 0:
+            pending = groups
+            continue
+
+        *settled, last = pending
+        yield from settled
+
+        if last.error:
+            # error groups always consist of a single file, so the next chunk starts a new group anyway
+            yield last
+            pending = groups
+            continue
+
+        # the last group always extends to the end of the chunk
+        # comparisons only involve the pivots and the next file, so starting from just [first, end] gets to the same state
+        # (in two-way mode first is contained in end transitively, in multiway mode that step is trivial)
+        (first, end) = (last.items[0], last.items[-1])
+        inner = last.items[1:-1]
+        window = [*dict.fromkeys([first, end]), *paths]
+        logger.info('reconciling chunk boundary at %s, starting from %s', paths[0], window[0])
+        it = _compute_groups_serial(
+            window,
+            Normaliser=Normaliser,
+            base_tmp_dir=base_tmp_dir,
+            cache_dir=cache_dir,
+            engine=engine,
+            pool=pool,
+            workers=workers,
+            lookahead=lookahead,
+            speculate=speculate,
+            stop_at={g.items[0] for g in groups},
+        )
+        reconciled: list[Group] = []
+        stopped: Path | None = None
+        while True:
+            try:
+                reconciled.append(next(it))
+            except StopIteration as e:
+                stopped = e.value
+                break
+        if stopped is not None:
+            [sidx] = [i for i, g in enumerate(groups) if g.items[0] == stopped]
+            reconciled.extend(groups[sidx:])
+        if len(inner) > 0:
+            # put the skipped files back
+            r = reconciled[0]
+            assert not r.error, (r, last)
+            assert list(r.items[:2]) == [first, end], (r, last)
+            reconciled[0] = Group(items=[first, *inner, *r.items[1:]], pivots=r.pivots, error=False)
+        pending = reconciled
+    yield from pending
 
 
 # todo config is unused here?
@@ -661,12 +1774,45 @@ def compute_instructions(
     *,
     Normaliser: type[BaseNormaliser],
     threads: int | None,
+    cache_dir: Path | None = None,
+    journal: Path | None = None,
+    engine: Engine = 'exact',
+    parallel: Parallel = 'pipeline',
+    lookahead: Lookahead | None = None,
+    speculate: int = 0,
+    executor: PoolKind | None = None,
+    pool: Executor | None = None,
 ) -> Iterator[Instruction]:
-    groups: Iterable[Group] = compute_groups(
-        paths=paths,
-        Normaliser=Normaliser,
-        threads=threads,
-    )
+    groups: Iterable[Group]
+    if journal is None:
+        groups = compute_groups(
+            paths=paths,
+            Normaliser=Normaliser,
+            threads=threads,
+            cache_dir=cache_dir,
+            engine=engine,
+            parallel=parallel,
+            lookahead=lookahead,
+            speculate=speculate,
+            executor=executor,
+            pool=pool,
+        )
+    else:
+        from .incremental import compute_groups_incremental
+
+        groups = compute_groups_incremental(
+            paths=paths,
+            Normaliser=Normaliser,
+            journal=journal,
+            threads=threads,
+            cache_dir=cache_dir,
+            engine=engine,
+            parallel=parallel,
+            lookahead=lookahead,
+            speculate=speculate,
+            executor=executor,
+            pool=pool,
+        )
     instructions: Iterable[Instruction] = groups_to_instructions(groups)
     total = len(paths)
     # TODO eh. could at least dump dry mode stats here...
@@ -678,6 +1824,38 @@ def compute_instructions(
     assert done == len(paths)  # just in case
 
 
+def compute_instructions_shared(
+    paths: Sequence[Path],
+    *,
+    Normalisers: Sequence[type[BaseNormaliser]],
+    threads: int | None,
+    cache_dir: Path | None = None,
+    engine: Engine = 'exact',
+    lookahead: Lookahead | None = None,
+    speculate: int = 0,
+    executor: PoolKind | None = None,
+) -> list[list[Instruction]]:
+    """
+    Instructions for each of Normalisers, see compute_groups_shared.
+    """
+    all_groups = compute_groups_shared(
+        paths,
+        Normalisers=Normalisers,
+        threads=threads,
+        cache_dir=cache_dir,
+        engine=engine,
+        lookahead=lookahead,
+        speculate=speculate,
+        executor=executor,
+    )
+    res = []
+    for groups in all_groups:
+        instructions = list(groups_to_instructions(groups))
+        assert len(instructions) == len(paths)  # just in case
+        res.append(instructions)
+    return res
+
+
 def apply_instructions(
     instructions: Iterable[Instruction],
     *,
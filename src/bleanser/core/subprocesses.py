@@ -0,0 +1,70 @@
+"""
+Running external tools (sort, cmp, etc.) in the background, so they overlap with each other and with python code.
+
+Tools are started from an asyncio event loop in a separate thread, so waiting on them doesn't need a thread/process each.
+Callers get concurrent.futures.Future back, same as for everything submitted to pools elsewhere.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import subprocess
+import threading
+from collections.abc import Coroutine
+from concurrent.futures import Future
+from contextlib import AbstractContextManager
+from pathlib import Path
+from typing import Any, Self, override
+
+
+class Subprocesses(AbstractContextManager):
+    """
+    limit: at most that many tools are running at the same time, the rest wait for their turn
+    """
+
+    def __init__(self, *, limit: int) -> None:
+        assert limit > 0, limit
+        self.limit = limit
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = asyncio.Semaphore(limit)
+        self._thread = threading.Thread(target=self._loop.run_forever, name='bleanser-subprocesses', daemon=True)
+        self._thread.start()
+
+    async def run(self, *args: str | Path, env: dict[str, str] | None = None) -> subprocess.CompletedProcess:
+        """
+        Runs the command once there is a free slot. Same as subprocess.run(check=False), it's up to the caller to check the code.
+        """
+        cmd = [str(a) for a in args]
+        async with self._semaphore:
+            proc = await asyncio.create_subprocess_exec(*cmd, env=env)
+            code = await proc.wait()
+        return subprocess.CompletedProcess(cmd, code)
+
+    def submit[T](self, coro: Coroutine[Any, Any, T]) -> Future[T]:
+        """
+        Can be called from any thread.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    @override
+    def __enter__(self) -> Self:
+        return self
+
+    @override
+    def __exit__(self, type, value, tb) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._loop.is_closed():
+            return
+
+        async def drain() -> None:
+            # otherwise tools might still be writing into temporary directories which are about to be removed
+            current = asyncio.current_task()
+            tasks = [t for t in asyncio.all_tasks() if t is not current]
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.submit(drain()).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,261 @@
+import os
+import sqlite3
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+from .. import cache as cache_module
+from ..cache import Cache, CacheStats, DigestIndex, file_digest
+from ..processor import BaseNormaliser, FileSet, Normalised, compute_groups
+
+
+def test_cache_put_fetch(tmp_path: Path) -> None:
+    cache = Cache(tmp_path / 'cache')
+
+    src = tmp_path / 'src'
+    src.write_text('whatever\n')
+    key = file_digest(src)
+
+    dst = tmp_path / 'dst'
+    assert not cache.fetch('normalised', key, dst)
+    assert not dst.exists()
+
+    entry = cache.put('normalised', key, src)
+    assert entry.read_text() == 'whatever\n'
+    # no temporary files left behind
+    assert [p.name for p in entry.parent.iterdir()] == [key]
+
+    assert cache.fetch('normalised', key, dst)
+    assert dst.read_text() == 'whatever\n'
+
+
+def test_cache_gc(tmp_path: Path) -> None:
+    cache = Cache(tmp_path / 'cache')
+
+    src = tmp_path / 'src'
+    entries = []
+    for i in range(5):
+        src.write_text(str(i) * 100)
+        entry = cache.put('normalised', f'key{i}', src)
+        # make sure mtimes are distinct regardless of filesystem resolution
+        os.utime(entry, ns=(i * 10**9, i * 10**9))
+        entries.append(entry)
+
+    # accessing the entry makes it most recently used
+    assert cache.fetch('normalised', 'key0', tmp_path / 'dst')
+
+    assert cache.stats()['normalised'] == CacheStats(entries=5, bytes=500)
+
+    verdicts = cache.verdicts
+    verdicts.put('same', 'l0', 'r', result=True, members={'l0': ['key0', 'key4'], 'r': ['key4']})
+    verdicts.put('subset', 'l1', 'r', result=False, members={'l1': ['key1'], 'r': ['key4']})
+
+    evicted = cache.gc(max_bytes=250)
+    assert evicted == CacheStats(entries=3, bytes=300)
+    assert [e.exists() for e in entries] == [True, False, False, False, True]
+    # verdicts about evicted normalised files are gone as well
+    assert verdicts.get('same', 'l0', 'r') is True
+    assert verdicts.get('subset', 'l1', 'r') is None
+
+    cache.clear()
+    assert cache.stats()['normalised'] == CacheStats(entries=0, bytes=0)
+
+
+def test_digest_index(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    hashed: list[Path] = []
+
+    def counting_file_digest(path: Path) -> str:
+        hashed.append(path)
+        return file_digest(path)
+
+    monkeypatch.setattr(cache_module, 'file_digest', counting_file_digest)
+
+    index = DigestIndex(tmp_path / 'digests.sqlite')
+    f = tmp_path / 'file'
+    f.write_text('first')
+
+    d1 = index.digest(f)
+    assert d1 == file_digest(f)
+    assert hashed == [f]
+
+    # unchanged metadata -- shouldn't read the file again
+    assert index.digest(f) == d1
+    assert hashed == [f]
+
+    f.write_text('second, different size')
+    d2 = index.digest(f)
+    assert d2 != d1
+    assert d2 == file_digest(f)
+    assert hashed == [f, f]
+
+    g = tmp_path / 'other'
+    g.write_text('other')
+    index.digest(g)
+    g.unlink()
+    assert index.prune() == 1
+    assert index.digest(f) == d2
+    assert hashed == [f, f, g]
+
+
+def test_index_connections(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    connected: list[str] = []
+    connect = sqlite3.connect
+
+    def counting_connect(db: Path, **kwargs) -> sqlite3.Connection:
+        connected.append(Path(db).name)
+        return connect(db, **kwargs)
+
+    monkeypatch.setattr(cache_module.sqlite3, 'connect', counting_connect)
+
+    cache = Cache(tmp_path / 'cache')
+    f = tmp_path / 'file'
+    f.write_text('whatever')
+    for _ in range(10):
+        cache.digests.digest(f)
+        cache.verdicts.get('same', 'a', 'b')
+    # reused for all lookups, even by other instances
+    Cache(tmp_path / 'cache').digests.digest(f)
+    assert connected == ['digests.sqlite', 'verdicts.sqlite']
+
+    # sqlite connections can't be shared between threads
+    thread = threading.Thread(target=cache.digests.digest, args=(f,))
+    thread.start()
+    thread.join()
+    assert connected == ['digests.sqlite', 'verdicts.sqlite', 'digests.sqlite']
+
+
+def test_normalised_cache(tmp_path: Path) -> None:
+    normalised_inputs: list[str] = []
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = True
+        PRUNE_DOMINATED = True
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Normalised]:
+            normalised_inputs.append(path.name)
+            normalised = self.tmp_dir / 'normalised'
+            normalised.write_text(path.read_text().upper())
+            yield normalised
+
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+    paths = []
+    for i, s in enumerate(['a', 'a\nb', 'a\nb', 'c']):
+        p = idir / f'{i}.txt'
+        p.write_text(s + '\n')
+        paths.append(p)
+
+    cache_dir = tmp_path / 'cache'
+    groups1 = list(compute_groups(paths, Normaliser=TestNormaliser, cache_dir=cache_dir))
+    # 2.txt has exactly the same content as 1.txt, so it's already cached by the time we get to it
+    assert normalised_inputs == ['0.txt', '1.txt', '3.txt']
+
+    normalised_inputs.clear()
+    extra = idir / '4.txt'
+    extra.write_text('c\nd\n')
+    groups2 = list(compute_groups([*paths, extra], Normaliser=TestNormaliser, cache_dir=cache_dir))
+    # only the new file should be normalised
+    assert normalised_inputs == ['4.txt']
+    # cached entries are still intact after the run cleaned up its temporary files
+    assert groups2[:-1] == groups1[:-1]
+
+    normalised_inputs.clear()
+    groups3 = list(compute_groups([*paths, extra], Normaliser=TestNormaliser))
+    assert normalised_inputs == ['0.txt', '1.txt', '2.txt', '3.txt', '4.txt']
+    assert groups3 == groups2
+
+
+def test_verdicts(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = True
+        PRUNE_DOMINATED = True
+
+    paths = []
+    for i, s in enumerate(['a', 'a\nb', 'b\nc', 'a\nb\nc', 'd']):
+        p = tmp_path / f'{i}.txt'
+        p.write_text(s + '\n')
+        paths.append(p)
+
+    compared: list[str] = []
+    orig_issubset = FileSet._issubset
+
+    def counting_issubset(self: FileSet, other: FileSet) -> bool:
+        compared.append('subset')
+        return orig_issubset(self, other)
+
+    monkeypatch.setattr(FileSet, '_issubset', counting_issubset)
+
+    cache_dir = tmp_path / 'cache'
+    groups1 = list(compute_groups(paths, Normaliser=TestNormaliser, cache_dir=cache_dir))
+    assert len(compared) > 0
+
+    compared.clear()
+    groups2 = list(compute_groups(paths, Normaliser=TestNormaliser, cache_dir=cache_dir))
+    assert groups2 == groups1
+    # all verdicts are memoised now
+    assert compared == []
+
+    # sanity check: without cache, results are the same
+    groups3 = list(compute_groups(paths, Normaliser=TestNormaliser))
+    assert groups3 == groups1
+    assert len(compared) > 0
+
+
+def test_identical_snapshots(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = True
+        PRUNE_DOMINATED = True
+
+    paths = []
+    for i, s in enumerate(['a', *(['a\nb'] * 20), 'c']):
+        p = tmp_path / f'{i:03}.txt'
+        p.write_text(s + '\n')
+        paths.append(p)
+
+    compared: list[str] = []
+    orig_issubset = FileSet._issubset
+
+    def counting_issubset(self: FileSet, other: FileSet) -> bool:
+        compared.append('subset')
+        return orig_issubset(self, other)
+
+    monkeypatch.setattr(FileSet, '_issubset', counting_issubset)
+
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser, cache_dir=tmp_path / 'cache'))
+    assert [len(g.items) for g in groups] == [21, 2]
+    # unchanged snapshots are dominated by the next one without reading them
+    assert len(compared) == 1
+
+
+def test_fingerprint_hpi(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    import importlib
+    import sys
+
+    from ..cache import normaliser_fingerprint
+
+    # fake HPI package, and a normaliser using it like the ones in bleanser.modules.hpi
+    (tmp_path / 'my' / 'fake').mkdir(parents=True)
+    (tmp_path / 'my' / '__init__.py').write_text('')
+    (tmp_path / 'my' / 'fake' / '__init__.py').write_text('from .dal import DAL\n')
+    dal = tmp_path / 'my' / 'fake' / 'dal.py'
+    dal.write_text('class DAL:\n    pass\n')
+    (tmp_path / 'bleanser_test_hpi.py').write_text(
+        'from my.fake import DAL\nfrom bleanser.core.processor import BaseNormaliser\n\nclass Normaliser(BaseNormaliser):\n    pass\n'
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(cache_module, '_fingerprints', {})
+
+    try:
+        Normaliser = importlib.import_module('bleanser_test_hpi').Normaliser
+        before = normaliser_fingerprint(Normaliser)
+        # e.g. HPI was upgraded
+        dal.write_text('class DAL:\n    version = 2\n')
+        cache_module._fingerprints.clear()
+        assert normaliser_fingerprint(Normaliser) != before
+    finally:
+        for name in ['my', 'my.fake', 'my.fake.dal', 'bleanser_test_hpi']:
+            sys.modules.pop(name, None)
@@ -0,0 +1,137 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+
+from ..common import Prune
+from ..incremental import compute_groups_incremental
+from ..processor import BaseNormaliser, Normalised, compute_groups, groups_to_instructions
+
+
+@pytest.mark.parametrize('multiway', [False, True])
+def test_incremental(*, tmp_path: Path, multiway: bool) -> None:
+    normalised_inputs: list[str] = []
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = multiway
+        PRUNE_DOMINATED = True
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Normalised]:
+            normalised_inputs.append(path.name)
+            yield path
+
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+
+    # retention of 3 items, so there are some groups
+    data = [[str(x) for x in range(i // 3, i // 3 + 3 + i % 3)] for i in range(12)]
+
+    def add(i: int) -> None:
+        (idir / f'{i:03}.txt').write_text(''.join(x + '\n' for x in data[i]))
+
+    def paths() -> list[Path]:
+        return sorted(idir.iterdir())
+
+    journal = tmp_path / 'journal.json'
+
+    def incremental() -> list:
+        normalised_inputs.clear()
+        return list(compute_groups_incremental(paths(), Normaliser=TestNormaliser, journal=journal))
+
+    for i in range(8):
+        add(i)
+    groups1 = incremental()
+    assert groups1 == list(compute_groups(paths(), Normaliser=TestNormaliser))
+
+    for i in range(8, 12):
+        add(i)
+    groups2 = incremental()
+    # only the last group of the previous run + new files are processed
+    last_start = groups1[-1].items[0].name
+    assert normalised_inputs == [p.name for p in paths() if p.name >= last_start]
+    assert len(normalised_inputs) < len(paths())
+    assert groups2 == list(compute_groups(paths(), Normaliser=TestNormaliser))
+
+    # now actually prune files, the next run should still reuse the journal
+    for ins in groups_to_instructions(groups2):
+        if isinstance(ins, Prune):
+            ins.path.unlink()
+    groups3 = incremental()
+    assert normalised_inputs == [p.name for p in paths() if p.name >= groups2[-1].items[0].name]
+    assert {i for g in groups3 for i in g.items} == set(paths())
+
+    # if a kept file is modified, the journal isn't valid anymore
+    first = paths()[0]
+    first.write_text(first.read_text() + 'extra\n')
+    groups4 = incremental()
+    assert normalised_inputs == [p.name for p in paths()]
+    assert groups4 == list(compute_groups(paths(), Normaliser=TestNormaliser))
+
+
+def test_incremental_retries_errors(tmp_path: Path) -> None:
+    failing: set[str] = set()
+    normalised_inputs: list[str] = []
+
+    class TestNormaliser(BaseNormaliser):
+        PRUNE_DOMINATED = True
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Normalised]:
+            normalised_inputs.append(path.name)
+            if path.name in failing:
+                raise RuntimeError('transient error')
+            yield path
+
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+    for i in range(6):
+        # first three files and last three files are separate groups
+        (idir / f'{i:03}.txt').write_text(''.join(f'{i // 3}-{x}\n' for x in range(i % 3 + 1)))
+    paths = sorted(idir.iterdir())
+    journal = tmp_path / 'journal.json'
+
+    def incremental() -> list:
+        normalised_inputs.clear()
+        return list(compute_groups_incremental(paths, Normaliser=TestNormaliser, journal=journal))
+
+    failing.add('004.txt')
+    groups1 = incremental()
+    [eidx] = [i for i, g in enumerate(groups1) if g.error]
+    assert groups1[eidx].items == [paths[4]]
+
+    # the error is gone now, so the file is processed again (along with the group it cut short)
+    failing.clear()
+    groups2 = incremental()
+    before = groups1[eidx - 1].items[0]
+    restart = min(g.items[0] for g in groups1 if before in g.items)
+    assert normalised_inputs == [p.name for p in paths if p >= restart]
+    assert len(normalised_inputs) < len(paths)
+    assert not any(g.error for g in groups2)
+    assert groups2 == list(compute_groups(paths, Normaliser=TestNormaliser))
+
+
+def test_incremental_modified_item(tmp_path: Path) -> None:
+    class TestNormaliser(BaseNormaliser):
+        PRUNE_DOMINATED = True
+
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+    for i, s in enumerate(['a', 'a b', 'a b c', 'x', 'x y', 'x y z']):
+        (idir / f'{i}.txt').write_text(s.replace(' ', '\n') + '\n')
+
+    def paths() -> list[Path]:
+        return sorted(idir.iterdir())
+
+    journal = tmp_path / 'journal.json'
+    groups1 = list(compute_groups_incremental(paths(), Normaliser=TestNormaliser, journal=journal))
+    modified = idir / '1.txt'
+    # dominated by the next file, so it's not a pivot
+    assert all(modified not in g.pivots for g in groups1)
+
+    modified.write_text('UNIQUE-DATA\n')
+    (idir / '6.txt').write_text('x\ny\nz\nw\n')
+    groups2 = list(compute_groups_incremental(paths(), Normaliser=TestNormaliser, journal=journal))
+    assert groups2 == list(compute_groups(paths(), Normaliser=TestNormaliser))
+    assert any(modified in g.pivots for g in groups2)
@@ -0,0 +1,134 @@
+import multiprocessing
+import os
+import threading
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from time import sleep, time
+
+from .. import jobqueue as jobqueue_module
+from ..cache import Cache
+from ..jobqueue import Job, JobQueue, distribute, queue_path, work
+from ..processor import BaseNormaliser, Normalised, compute_groups
+
+
+# defined at the top level, so workers can import it
+class _SlowNormaliser(BaseNormaliser):
+    PRUNE_DOMINATED = True
+
+    @contextmanager
+    def normalise(self, *, path: Path) -> Iterator[Normalised]:
+        # slow enough so all workers get some jobs
+        sleep(0.1)
+        normalised = self.tmp_dir / 'normalised'
+        normalised.write_text(path.read_text())
+        yield normalised
+
+
+def _inputs(tmp_path: Path) -> list[Path]:
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+    paths = []
+    for i in range(20):
+        p = idir / f'{i:03}.txt'
+        # every 5 files start from scratch, so there are a few groups
+        p.write_text(''.join(f'{j}\n' for j in range(i - i % 5, i + 1)))
+        paths.append(p)
+    return paths
+
+
+def test_distribute(tmp_path: Path) -> None:
+    paths = _inputs(tmp_path)
+    cache_dir = tmp_path / 'cache'
+
+    # as if they were running on other hosts
+    workers = [
+        multiprocessing.Process(target=work, args=(cache_dir,), kwargs={'exit_when_empty': False}) for _ in range(2)
+    ]
+    for w in workers:
+        w.start()
+    try:
+        distribute(paths, Normalisers=[_SlowNormaliser], cache_dir=cache_dir)
+    finally:
+        for w in workers:
+            w.terminate()
+            w.join()
+
+    cache = Cache(cache_dir)
+    assert cache.stats()['normalised'].entries == len(paths)
+    queue = JobQueue(queue_path(cache_dir))
+    for d in [queue.pending, queue.claimed, queue.done]:
+        assert list(d.iterdir()) == []
+
+    expected = list(compute_groups(paths, Normaliser=_SlowNormaliser))
+    # everything is cached already, so shouldn't call normalise at all
+    before = time()
+    assert list(compute_groups(paths, Normaliser=_SlowNormaliser, cache_dir=cache_dir)) == expected
+    assert time() - before < 0.1 * len(paths) / 2
+
+    # nothing to do the second time
+    distribute(paths, Normalisers=[_SlowNormaliser], cache_dir=cache_dir)
+
+
+def test_requeue_stale(tmp_path: Path) -> None:
+    queue = JobQueue(tmp_path / 'queue')
+    job = Job(key='key', module=__name__, qualname=_SlowNormaliser.__qualname__, path=tmp_path / 'input')
+    queue.publish(job)
+
+    claimed = queue.claim()
+    assert claimed == job
+    assert queue.claim() is None  # already claimed
+
+    assert queue.requeue_stale() == 0
+    # as if the worker was killed a while ago
+    old = time() - 2 * jobqueue_module._STALE_SECONDS
+    os.utime(queue.claimed / 'key.json', (old, old))
+    assert queue.requeue_stale() == 1
+    assert queue.claim() == job
+
+    queue.complete(job, error=None)
+    assert queue.result('key') is not None
+    assert list(queue.claimed.iterdir()) == []
+
+
+def test_distribute_two_coordinators(tmp_path: Path) -> None:
+    paths = _inputs(tmp_path)
+    cache_dir = tmp_path / 'cache'
+
+    # e.g. two cron jobs sharing the cache, each gets to normalise some of the inputs
+    coordinators = [
+        threading.Thread(
+            target=distribute,
+            args=(paths,),
+            kwargs={'Normalisers': [_SlowNormaliser], 'cache_dir': cache_dir},
+            daemon=True,  # so the test doesn't hang if it's stuck
+        )
+        for _ in range(2)
+    ]
+    for c in coordinators:
+        c.start()
+    for c in coordinators:
+        c.join(timeout=30)
+        assert not c.is_alive()
+
+    cache = Cache(cache_dir)
+    assert cache.stats()['normalised'].entries == len(paths)
+    queue = JobQueue(queue_path(cache_dir))
+    for d in [queue.pending, queue.claimed, queue.done]:
+        assert list(d.iterdir()) == []
+
+
+def test_expire_done(tmp_path: Path) -> None:
+    queue = JobQueue(tmp_path / 'queue')
+    job = Job(key='key', module=__name__, qualname=_SlowNormaliser.__qualname__, path=tmp_path / 'input')
+    assert queue.publish(job)
+    assert queue.claim() == job
+    queue.complete(job, error='RuntimeError()')
+    assert not queue.publish(job)  # failed recently
+
+    assert queue.expire_done() == 0
+    old = time() - 2 * jobqueue_module._DONE_EXPIRE_SECONDS
+    os.utime(queue.done / 'key.json', (old, old))
+    assert queue.expire_done() == 1
+    assert queue.result('key') is None
+    assert queue.publish(job)
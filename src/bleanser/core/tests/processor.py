@@ -1,11 +1,27 @@
+import os
+import subprocess
 from collections.abc import Iterator, Sequence
 from contextlib import contextmanager
 from pathlib import Path
+from time import sleep, time
 
 import pytest
 
 from ..common import Group, Keep, Prune
-from ..processor import BaseNormaliser, FileSet, Normalised, compute_groups, groups_to_instructions
+from ..processor import (
+    BaseNormaliser,
+    FileSet,
+    Lookahead,
+    Normalised,
+    Parallel,
+    SortedRuns,
+    _make_pool,
+    _Prefetcher,
+    compute_groups,
+    compute_groups_shared,
+    groups_to_instructions,
+)
+from ..subprocesses import Subprocesses
 from ..utils import total_dir_size
 
 
@@ -52,6 +68,496 @@ def test_fileset(tmp_path: Path) -> None:
     fa = lines(['a'])
     fscea = fsce.union(fa)
     assert fsce.issubset(fscea)
+    assert fsac.issubset(fscea)
+    assert fscea.merged.read_text() == 'a\nc\ne\n'
+
+    # already sorted inputs are used as is, union shouldn't write anything
+    wdir_before = set(wdir.iterdir())
+    fsceac = fscea.union(lines(['c', 'a', 'a']))  # not sorted
+    assert len(set(wdir.iterdir()) - wdir_before) == 1
+    assert fsceac.issame(fscea)
+
+
+def test_sorted_runs_prefetch(tmp_path: Path) -> None:
+    wdir = tmp_path / 'wdir'
+    wdir.mkdir()
+    sorted_ = tmp_path / 'sorted'
+    sorted_.write_text('a\nb\n')
+    unsorted = tmp_path / 'unsorted'
+    unsorted.write_text('b\na\nb\n')
+    missing = tmp_path / 'missing'
+
+    with Subprocesses(limit=2) as subprocesses:
+        runs = SortedRuns(wdir, subprocesses=subprocesses)
+        for p in [sorted_, unsorted, missing]:
+            runs.prefetch(p)
+        assert runs.get(sorted_) == sorted_  # used as is
+        assert runs.get(unsorted).read_text() == 'a\nb\n'
+        assert len(list(wdir.iterdir())) == 1
+        with pytest.raises(subprocess.CalledProcessError):
+            runs.get(missing)
+        runs.prefetch(unsorted)  # already sorted, shouldn't do anything
+        runs.close()
+        assert list(wdir.iterdir()) == []
+        assert sorted_.exists()
+
+
+def test_subprocesses_limit(tmp_path: Path) -> None:
+    started = tmp_path / 'started'
+    started.mkdir()
+    release = tmp_path / 'release'
+    # marks that it started, then blocks until released
+    script = 'touch "$1" && while [ ! -e "$2" ]; do sleep 0.01; done'
+
+    with Subprocesses(limit=2) as subprocesses:
+        futs = [
+            subprocesses.submit(subprocesses.run('sh', '-c', script, 'sh', started / str(i), release)) for i in range(4)
+        ]
+        deadline = time() + 10
+        while len(list(started.iterdir())) < 2:
+            assert time() < deadline
+            sleep(0.01)
+        # none of the first two can finish until released, so the rest have to wait for them
+        assert not any(f.done() for f in futs)
+        assert len(list(started.iterdir())) == 2
+        release.touch()
+        assert [f.result().returncode for f in futs] == [0, 0, 0, 0]
+    assert len(list(started.iterdir())) == 4
+
+
+def test_is_contained(tmp_path: Path) -> None:
+    from random import Random
+
+    from ..processor import _is_contained, _subtract_files, run_sort
+
+    r = Random(0)
+    # some long lines so chunked comparison kicks in, and some short to make mismatches likely
+    universe = ['', 'a', 'ab', 'b', *(f'{i:05}' * r.randint(1, 2000) for i in range(200))]
+
+    def sorted_file(name: str, lines: list[str]) -> Path:
+        f = tmp_path / name
+        f.write_text(''.join(x + '\n' for x in lines))
+        run_sort('--unique', f, '-o', f)
+        return f
+
+    for i in range(200):
+        right = r.sample(universe, k=r.randint(0, len(universe)))
+        left = r.sample(right, k=r.randint(0, len(right)))
+        if r.random() < 0.5 and len(left) > 0:
+            left.append(r.choice(universe))
+        lf = sorted_file(f'{i}.left', left)
+        rf = sorted_file(f'{i}.right', right)
+        expected = _subtract_files(lf, rf) is None
+        assert _is_contained(lf, rf) == expected, i
+        assert expected == set(left).issubset(right)
+
+    # fmt: off
+    assert not _is_contained(sorted_file('big', ['a', 'b', 'c']), sorted_file('small', ['a', 'b']))
+    assert not _is_contained(sorted_file('last', ['a', 'z']), sorted_file('other', ['a', 'b', 'c', 'd']))
+    assert     _is_contained(sorted_file('split', ['a', 'z']), sorted_file('r1', ['a']), sorted_file('r2', ['z']))
+    # no trailing newline
+    (tmp_path / 'nonl').write_text('a\nz')
+    assert     _is_contained(tmp_path / 'nonl', sorted_file('r3', ['a', 'z']))
+    assert     _is_contained(sorted_file('l4', ['a', 'z']), tmp_path / 'nonl')
+    # fmt: on
+
+
+def test_hash_fileset(tmp_path: Path) -> None:
+    from ..hashset import HashFileSet, HashRegistry
+
+    registry = HashRegistry()
+
+    def FS(*paths: Path) -> HashFileSet:
+        return HashFileSet(paths, registry=registry)
+
+    fid = 0
+
+    def lines(ss) -> Path:
+        nonlocal fid
+        f = tmp_path / str(fid)
+        f.write_text(''.join(s + '\n' for s in ss))
+        fid += 1
+        return f
+
+    # fmt: off
+    assert     FS(lines([])).issubset(FS(lines([])))
+    assert     FS(lines([])).issame(FS(lines([])))
+
+    fsac = FS(lines(['a', 'c']))
+    assert     fsac.issame(FS(lines(['c', 'a', 'a'])))
+    assert not fsac.issame(FS(lines(['a', 'c', 'b'])))
+    assert     fsac.issubset(FS(lines(['a', 'c', 'b'])))
+    assert not FS(lines(['a', 'c', 'b'])).issubset(fsac)
+    assert not FS(lines(['z'])).issubset(fsac)
+    assert not FS(lines(['0'])).issubset(fsac)
+    # empty line is a legit line
+    assert not FS(lines(['a', ''])).issubset(fsac)
+    # fmt: on
+
+    fc = lines(['c'])
+    fe = lines(['e'])
+    fsce = FS(fc, fe)
+    assert not fsce.issubset(fsac)
+    assert not fsac.issubset(fsce)
+
+    fscea = fsce.union(lines(['a']))
+    assert fsce.issubset(fscea)
+    assert fsac.issubset(fscea)
+    assert fsce.items == [fc, fe]  # union shouldn't modify the original
+
+
+@pytest.mark.parametrize('chunk_bytes', [1, 3, 16, 2**20])
+def test_line_hashes_chunks(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, chunk_bytes: int) -> None:
+    from .. import hashset
+    from ..hashset import _line_hashes
+
+    f = tmp_path / 'file'
+    for data in [
+        b'',
+        b'\n',
+        b'a',
+        b'a\n',
+        b'\n\n',
+        b'abc\nde\n\nabc\nlonger line\nxyz',
+        b'x' * 100 + b'\ny\n' + b'x' * 100,
+    ]:
+        f.write_bytes(data)
+        monkeypatch.setattr(hashset, '_CHUNK_BYTES', 2**30)
+        expected = _line_hashes(f)
+        monkeypatch.setattr(hashset, '_CHUNK_BYTES', chunk_bytes)
+        assert list(_line_hashes(f)) == list(expected), data
+        # empty line is a legit line, but there is nothing after the last newline
+        assert len(expected) == len(set(data.split(b'\n')[: -1 if data.endswith(b'\n') or data == b'' else None]))
+
+
+def _random_snapshots(tmp_path: Path) -> list[Path]:
+    from random import Random
+
+    r = Random(0)
+    paths = []
+    items = list(range(5))
+    for i in range(100):
+        # mostly growing, but sometimes items are removed or changed
+        x = r.random()
+        if x < 0.5:
+            items.append(max(items) + 1)
+        elif x < 0.7:
+            items.remove(r.choice(items))
+        elif x < 0.8:
+            items = items[len(items) // 2 :]
+        p = tmp_path / f'{i:03}.txt'
+        p.write_text(''.join(f'{item}\n' for item in r.sample(items, k=len(items))))
+        paths.append(p)
+    return paths
+
+
+@pytest.mark.parametrize('multiway', [False, True])
+@pytest.mark.parametrize('prune_dominated', [False, True])
+def test_engines_agree(*, tmp_path: Path, multiway: bool, prune_dominated: bool) -> None:
+    if multiway and not prune_dominated:
+        pytest.skip("multiway doesn't make sense without prune_dominated")
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = multiway
+        PRUNE_DOMINATED = prune_dominated
+
+    paths = _random_snapshots(tmp_path)
+    exact = list(compute_groups(paths, Normaliser=TestNormaliser, engine='exact'))
+    hashed = list(compute_groups(paths, Normaliser=TestNormaliser, engine='hash'))
+    assert hashed == exact
+    assert len(exact) > 5  # just in case
+
+
+@pytest.mark.parametrize('multiway', [False, True])
+def test_hash_engine_verification(*, tmp_path: Path, multiway: bool, monkeypatch: pytest.MonkeyPatch) -> None:
+    from ..hashset import HashFileSet
+
+    class TestNormaliser(BaseNormaliser):
+        MULTIWAY = multiway
+        PRUNE_DOMINATED = True
+
+    paths = _random_snapshots(tmp_path)
+    exact = list(compute_groups(paths, Normaliser=TestNormaliser, engine='exact'))
+
+    # simulate the worst case: as if every comparison was a hash collision
+    monkeypatch.setattr(HashFileSet, 'issubset', lambda _self, _other: True)
+    monkeypatch.setattr(HashFileSet, 'issame', lambda _self, _other: True)
+    hashed = list(compute_groups(paths, Normaliser=TestNormaliser, engine='hash'))
+    # exact verification should still prevent from pruning anything extra
+    assert hashed == exact
+
+
+# defined at the top level, so they can be pickled and passed to worker processes
+class _CopyingNormaliser(BaseNormaliser):
+    PRUNE_DOMINATED = True
+
+    @contextmanager
+    def normalise(self, *, path: Path) -> Iterator[Normalised]:
+        normalised = self.tmp_dir / 'normalised'
+        normalised.write_text(path.read_text())
+        yield normalised
+
+
+class _CopyingMultiwayNormaliser(_CopyingNormaliser):
+    MULTIWAY = True
+
+
+class _CopyingExactNormaliser(_CopyingNormaliser):
+    PRUNE_DOMINATED = False
+
+
+@pytest.mark.parametrize('Normaliser', [_CopyingNormaliser, _CopyingMultiwayNormaliser, _CopyingExactNormaliser])
+def test_pipeline(*, tmp_path: Path, Normaliser: type[BaseNormaliser]) -> None:
+    paths = _random_snapshots(tmp_path)
+    serial = list(compute_groups(paths, Normaliser=Normaliser))
+    pipeline = list(compute_groups(paths, Normaliser=Normaliser, threads=4, parallel='pipeline'))
+    assert pipeline == serial
+
+    speculative = list(compute_groups(paths, Normaliser=Normaliser, threads=4, speculate=5))
+    assert speculative == serial
+
+    threaded = list(compute_groups(paths, Normaliser=Normaliser, threads=4, executor='thread', speculate=5))
+    assert threaded == serial
+
+    # chunk boundaries are reconciled afterwards
+    chunks = list(compute_groups(paths, Normaliser=Normaliser, threads=4, parallel='chunks'))
+    assert chunks == serial
+
+
+@pytest.mark.parametrize('multiway', [False, True])
+def test_chunks_long_group(*, tmp_path: Path, multiway: bool) -> None:
+    normalised: list[Path] = []
+
+    class TestNormaliser(_CopyingNormaliser):
+        MULTIWAY = multiway
+
+        @contextmanager
+        def normalise(self, *, path: Path) -> Iterator[Normalised]:
+            normalised.append(path)  # list.append is thread safe
+            with super().normalise(path=path) as res:
+                yield res
+
+    paths = []
+    for i in range(40):
+        p = tmp_path / f'{i:03}.txt'
+        p.write_text('same\n')
+        paths.append(p)
+
+    groups = list(compute_groups(paths, Normaliser=TestNormaliser, threads=4, executor='thread', parallel='chunks'))
+    assert groups == [Group(items=paths, pivots=[paths[0], paths[-1]], error=False)]
+
+    # reconciling chunk boundaries shouldn't normalise the group all over again from its start
+    # each file is normalised by its chunk and at most once more while reconciling, plus the two pivots at each boundary
+    boundaries = 3
+    assert len(normalised) <= 2 * len(paths) + 2 * boundaries
+    assert normalised.count(paths[1]) == 1
+
+
+class _SpaceCheckingNormaliser(_CopyingMultiwayNormaliser):
+    @contextmanager
+    def normalise(self, *, path: Path) -> Iterator[Normalised]:
+        with super().normalise(path=path) as normalised:
+            base_tmp_dir = self._base_tmp_dir
+            for _ in self._relative_base_tmp_dir().parts:
+                base_tmp_dir = base_tmp_dir.parent
+            # runs in worker processes, so communicate via file
+            with Path(os.environ['BLEANSER_TEST_SPACE_LOG']).open('a') as fo:
+                fo.write(f'{total_dir_size(base_tmp_dir)}\n')
+            yield normalised
+
+
+def test_pipeline_bounded_resources(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    one_mb = 1_000_000
+    idir = tmp_path / 'inputs'
+    idir.mkdir()
+    paths = []
+    for i in range(40):
+        p = idir / f'{i:03}.txt'
+        # sorted already, so comparison doesn't need to make sorted copies
+        p.write_text(''.join(f'{j:03}\n' for j in range(i + 1)) + 'x' * one_mb + '\n')
+        paths.append(p)
+
+    space_log = tmp_path / 'space.log'
+    monkeypatch.setenv('BLEANSER_TEST_SPACE_LOG', str(space_log))
+
+    groups = list(
+        compute_groups(
+            paths,
+            Normaliser=_SpaceCheckingNormaliser,
+            threads=8,
+            lookahead=Lookahead(bytes=3 * one_mb),
+        )
+    )
+    assert len(groups) == 1
+
+    spaces = [int(x) for x in space_log.read_text().splitlines()]
+    assert len(spaces) == len(paths)
+    # budget, plus the file currently being normalised which might not fit in the budget yet
+    assert max(spaces) < 5 * one_mb
+
+
+def test_shared_normalisers(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    import gzip
+
+    paths = []
+    for p in _random_snapshots(tmp_path):
+        gz = p.with_suffix('.txt.gz')
+        gz.write_bytes(gzip.compress(p.read_bytes()))
+        p.unlink()
+        paths.append(gz)
+
+    # identity normaliser yields the unpacked file itself, so checks that it's not moved away from other normalisers
+    Normalisers = [BaseNormaliser, _CopyingNormaliser, _CopyingExactNormaliser]
+    separate = [list(compute_groups(paths, Normaliser=N)) for N in Normalisers]
+    assert separate[0] != separate[1]  # just in case, to make sure the test is meaningful
+
+    unpacked: list[Path] = []
+    original_unpacked = BaseNormaliser.unpacked
+
+    @contextmanager
+    def counting_unpacked(self: BaseNormaliser, path: Path, *, wdir: Path) -> Iterator[Path]:
+        unpacked.append(path)
+        with original_unpacked(self, path, wdir=wdir) as res:
+            yield res
+
+    # without threads it's all in-process, so we can count
+    monkeypatch.setattr(BaseNormaliser, 'unpacked', counting_unpacked)
+    shared = compute_groups_shared(paths, Normalisers=Normalisers)
+    assert shared == separate
+    assert sorted(unpacked) == paths  # each input unpacked exactly once
+    monkeypatch.undo()
+
+    shared = compute_groups_shared(paths, Normalisers=Normalisers, threads=4)
+    assert shared == separate
+
+
+class _SetupCheckingNormaliser(_CopyingNormaliser):
+    _set_up = False
+
+    @classmethod
+    def worker_setup(cls) -> None:
+        assert not cls._set_up
+        cls._set_up = True
+        # runs in worker processes, so communicate via file
+        with Path(os.environ['BLEANSER_TEST_SETUP_LOG']).open('a') as fo:
+            fo.write(f'{os.getpid()}\n')
+
+    @contextmanager
+    def normalise(self, *, path: Path) -> Iterator[Normalised]:
+        assert self._set_up
+        with super().normalise(path=path) as normalised:
+            yield normalised
+
+
+def test_worker_setup(*, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    paths = _random_snapshots(tmp_path)
+    setup_log = tmp_path / 'setup.log'
+    monkeypatch.setenv('BLEANSER_TEST_SETUP_LOG', str(setup_log))
+
+    def setups() -> list[int]:
+        return [int(x) for x in setup_log.read_text().splitlines()]
+
+    expected = list(compute_groups(paths, Normaliser=_CopyingNormaliser))
+
+    # same pool reused for multiple runs
+    with _make_pool(threads=2, executor='process', Normalisers=[_SetupCheckingNormaliser]) as pool:
+        parallels: list[Parallel] = ['pipeline', 'chunks', 'pipeline']
+        for parallel in parallels:
+            groups = compute_groups(paths, Normaliser=_SetupCheckingNormaliser, threads=2, parallel=parallel, pool=pool)
+            assert list(groups) == expected
+    # once per worker, regardless of the number of runs
+    workers = setups()
+    assert 1 <= len(workers) <= 2
+    assert len(set(workers)) == len(workers)
+    assert os.getpid() not in workers
+
+    for _ in range(2):
+        assert list(compute_groups(paths, Normaliser=_SetupCheckingNormaliser)) == expected
+    assert setups() == [*workers, os.getpid()]
+
+
+def test_prefetcher_biggest_first(tmp_path: Path) -> None:
+    from concurrent.futures import Future
+
+    sizes = [1, 2, 100, 3, 50, 4]
+    paths = []
+    for i, size in enumerate(sizes):
+        p = tmp_path / f'{i}.txt'
+        p.write_text('x' * size)
+        paths.append(p)
+
+    submitted: list[Path] = []
+
+    def submit(path: Path) -> Future:
+        submitted.append(path)
+        return Future()
+
+    prefetcher = _Prefetcher(paths, workers=1, lookahead=Lookahead(files=3), submit=submit)
+    res = prefetcher.next()
+    assert res is not None
+    (idx, path, _fut) = res
+    assert (idx, path) == (0, paths[0])
+    # the file needed next goes first, then the biggest ones within the horizon
+    assert submitted == [paths[0], paths[2], paths[4]]
+
+    consumed = [path]
+    while (res := prefetcher.next()) is not None:
+        consumed.append(res[1])
+    assert consumed == paths
+    assert sorted(submitted) == sorted(paths)
+
+
+def test_prefetcher_counts_sorted_runs(tmp_path: Path) -> None:
+    from concurrent.futures import Future
+
+    from ..processor import _WorkerResult
+
+    paths = []
+    for i in range(6):
+        p = tmp_path / f'{i}.txt'
+        p.write_text('x' * 10)
+        paths.append(p)
+
+    def wres(path: Path) -> _WorkerResult:
+        return _WorkerResult(normalised=path, content_id=None, worker=0, took=0.0)
+
+    submitted: list[Path] = []
+
+    def submit(path: Path) -> Future:
+        submitted.append(path)
+        return Future()
+
+    prefetcher = _Prefetcher(paths, workers=1, lookahead=Lookahead(files=3), submit=submit)
+    assert prefetcher.next() is not None
+    assert submitted == paths[:3]
+    prefetcher.received(wres(paths[0]), original=tmp_path)
+
+    # file 1 is normalised ahead of time, and is sorted in the background
+    sorting: Future[Path] = Future()
+    prefetcher.sorting(paths[1], sorting)
+    prefetcher.released(paths[0])
+    assert submitted == paths[:3]  # the sorted copy takes up the freed space
+
+    # turns out it was sorted already, so there is no copy after all
+    sorting.set_result(paths[1])
+    assert prefetcher.next() is not None
+    assert submitted == paths[:4]
+
+    prefetcher = _Prefetcher(paths, workers=1, lookahead=Lookahead(bytes=25), submit=submit)
+    assert prefetcher.next() is not None
+    prefetcher.received(wres(paths[0]), original=tmp_path)
+    assert prefetcher.fits_run(paths[1])
+    sorting = Future()
+    prefetcher.sorting(paths[1], sorting)
+    assert not prefetcher.fits_run(paths[2])
+
+    sorted_copy = tmp_path / 'sorted'
+    sorted_copy.write_text('x' * 5)
+    sorting.set_result(sorted_copy)
+    assert prefetcher.runs == {paths[1]: 5}
+    assert prefetcher.fits_run(paths[2])
+    prefetcher.released(paths[1])
+    assert prefetcher.runs == {}
 
 
 @pytest.mark.parametrize(